@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import argparse
+import numpy as np
+import cv2
+
+import oak_yolo_spacial
+from perf_helpers import StageTimer
+from overlay_helpers import DETAIL_LEVELS
+from replay_helpers import (HostImgFrame, HostDetections, HostSpatialDetection,
+                            HostLocationConfig, HostConfigData, HostRect, ReplayFinished)
+from tracking_helpers import Tracker
+from wpi_helpers import ConfigParser, WPINetworkTables, StreamOutput
+
+'''
+Spatial detection host loop benchmark
+  Drives oak_yolo_spacial.loop_and_detect with synthetic frames, depth maps
+  and detections so it can run on any machine without an OAK camera.
+  Reports the time spent in each stage of the loop along with the
+  throughput and the p50/p99 frame times.  Use --output to save the results
+  as JSON and --baseline to compare them with an earlier run made with the
+  same options.
+'''
+
+FRAME_WIDTH = 416
+FRAME_HEIGHT = 416
+LABEL_MAP = {0: "BlueBall", 1: "Redball"}
+
+# The options of a run saved with its results, which a baseline has to match
+RUN_OPTIONS = ("frames", "warmup", "network_tables", "depth_stream", "overlay", "track")
+
+def parse_args():
+    """Parse input arguments."""
+    desc = 'Benchmark the spatial detection host loop with synthetic data'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument(
+        '-d', '--detections', type=str, default='0,1,5,10,25,50',
+        help='comma separated detection counts to benchmark [0,1,5,10,25,50]')
+    parser.add_argument(
+        '-f', '--frames', type=int, default=300,
+        help='frames to time for each detection count [300]')
+    parser.add_argument(
+        '-w', '--warmup', type=int, default=20,
+        help='frames to run before timing starts [20]')
+    parser.add_argument(
+        '-n', '--no_network_tables', action='store_true',
+        help='leave the Network Tables publish out of the loop [False]')
+    parser.add_argument(
+        '--depth_stream', action='store_true',
+        help='benchmark with a client watching the depth stream [False]')
+    parser.add_argument(
+        '--overlay', type=str, default='full', choices=DETAIL_LEVELS,
+        help='detail drawn for each detection: box, label or full [full]')
+    parser.add_argument(
+        '--track', action='store_true',
+        help='run the tracker in the loop [False]')
+    parser.add_argument(
+        '-o', '--output', type=str, default=None,
+        help='write the results to this JSON file')
+    parser.add_argument(
+        '-b', '--baseline', type=str, default=None,
+        help='compare with the results in this JSON file')
+    parser.add_argument(
+        '--tolerance', type=float, default=10.0,
+        help='percent slowdown of the p50 frame time that counts as a regression [10]')
+    args = parser.parse_args()
+    return args
+
+# -------------------------------------------------------------------------
+# Synthetic device output
+# -------------------------------------------------------------------------
+class SyntheticImgFrame(HostImgFrame):
+    """A planar BGR frame.  Like the device, getCvFrame() converts it to interleaved."""
+    def getCvFrame(self):
+        return np.ascontiguousarray(self.frame.transpose(1, 2, 0))
+
+
+class SyntheticQueue:
+    """Returns a new message from make(seq) on every get() until frames run out."""
+    def __init__(self, name, make, frames):
+        self.name = name
+        self.make = make
+        self.frames = frames
+        self.seq = 0
+
+    def get(self):
+        if self.seq >= self.frames:
+            raise ReplayFinished(f"Synthetic '{self.name}' queue finished")
+        self.seq += 1
+        return self.make(self.seq)
+
+    def tryGet(self):
+        return self.get() if self.has() else None
+
+    def tryGetAll(self):
+        return [self.get()] if self.has() else []
+
+    def has(self):
+        return self.seq < self.frames
+
+    def getName(self):
+        return self.name
+
+
+def synthetic_queues(num_detections, frames, seed=2928):
+    """Create the four queues that loop_and_detect reads, filled with synthetic data."""
+    rng = np.random.default_rng(seed)
+    pool = 8
+
+    images = [rng.integers(0, 256, (3, FRAME_HEIGHT, FRAME_WIDTH), dtype=np.uint8) for _ in range(pool)]
+    gradient = np.linspace(300, 6000, FRAME_HEIGHT, dtype=np.float32)[:, None]
+    depths = [(gradient + rng.normal(0, 200, (FRAME_HEIGHT, FRAME_WIDTH))).clip(0, 65535).astype(np.uint16)
+              for _ in range(pool)]
+
+    boxes = []
+    for _ in range(pool):
+        xmin = rng.uniform(0, 0.8, num_detections)
+        ymin = rng.uniform(0, 0.8, num_detections)
+        size = rng.uniform(0.05, 0.2, num_detections)
+        spatial = rng.uniform(-2000, 2000, (num_detections, 3))
+        boxes.append([(int(rng.integers(0, 2)), float(rng.uniform(0.5, 1.0)),
+                       xmin[i], ymin[i], xmin[i] + size[i], ymin[i] + size[i], tuple(spatial[i]))
+                      for i in range(num_detections)])
+
+    def stamps(seq):
+        return {"seq": seq, "timestamp": seq / 30.0}
+
+    def rgb(seq):
+        return SyntheticImgFrame(images[seq % pool], **stamps(seq))
+
+    def detections(seq):
+        return HostDetections([HostSpatialDetection(*b) for b in boxes[seq % pool]], **stamps(seq))
+
+    def depth(seq):
+        return HostImgFrame(depths[seq % pool], **stamps(seq))
+
+    def mapping(seq):
+        rois = [HostConfigData(HostRect(b[2], b[3], b[4] - b[2], b[5] - b[3])) for b in boxes[seq % pool]]
+        return HostLocationConfig(rois, **stamps(seq))
+
+    return (SyntheticQueue("rgb", rgb, frames),
+            SyntheticQueue("detections", detections, frames),
+            SyntheticQueue("depth", depth, frames),
+            SyntheticQueue("boundingBoxDepthMapping", mapping, frames))
+
+
+class CopySource:
+    """Stands in for cs.CvSource when cscore isn't installed.  putFrame copies the frame like cscore does."""
+    def putFrame(self, frame):
+        self.frame = frame.copy()
+
+    def isEnabled(self):
+        return True
+
+
+def create_cv_source():
+    """A stream that takes every frame, so each one is drawn and scaled."""
+    try:
+        import cscore as cs
+        source = cs.CvSource("benchmark", cs.VideoMode.PixelFormat.kMJPEG, 320, 240, 30)
+    except ImportError:
+        source = CopySource()
+    return StreamOutput(source, width=320, height=240, fps=0)
+
+# -------------------------------------------------------------------------
+# Benchmark
+# -------------------------------------------------------------------------
+def run_loop(num_detections, frames, networkTables, cvSource, depthSource, overlay, track, timer=None):
+    queues = synthetic_queues(num_detections, frames)
+    tracker = Tracker() if track else None
+    try:
+        oak_yolo_spacial.loop_and_detect(*queues, LABEL_MAP, networkTables, cvSource,
+                                         depthSource=depthSource, overlayDetail=overlay,
+                                         tracker=tracker, timer=timer)
+    except ReplayFinished:
+        pass
+
+
+def run_benchmark(counts, frames, warmup, networkTables, cvSource, depthSource=None, overlay="full",
+                  track=False):
+    results = []
+    for num_detections in counts:
+        run_loop(num_detections, warmup, networkTables, cvSource, depthSource, overlay, track)
+        timer = StageTimer()
+        run_loop(num_detections, frames, networkTables, cvSource, depthSource, overlay, track, timer)
+        result = {"detections": num_detections}
+        result.update(timer.summary())
+        results.append(result)
+    return results
+
+
+def git_version():
+    """The git version of this script's checkout, wherever it is run from."""
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    stages = list(results[0]["stages_ms"])
+    header = "{:>10} {:>8} {:>8} {:>8}".format("detections", "fps", "p50 ms", "p99 ms")
+    header += "".join(" {:>14}".format(stage) for stage in stages)
+    print(header)
+    for r in results:
+        line = "{:>10} {:>8.1f} {:>8.2f} {:>8.2f}".format(
+            r["detections"], r["fps"], r["frame_ms"]["p50"], r["frame_ms"]["p99"])
+        line += "".join(" {:>14.3f}".format(r["stages_ms"][stage]["mean"]) for stage in stages)
+        print(line)
+    print("Stage times are the mean in milliseconds")
+
+
+def mismatched_options(report, baseline):
+    """The RUN_OPTIONS that differ between a report and a baseline, as "name a -> b" strings."""
+    return ["{} {} -> {}".format(name, baseline.get(name), report[name])
+            for name in RUN_OPTIONS if baseline.get(name) != report[name]]
+
+
+def compare_results(results, baseline, tolerance):
+    """Print the change from the baseline.  Returns True if any run regressed."""
+    previous = {r["detections"]: r for r in baseline["results"]}
+    regressed = False
+    print(f"Compared with {baseline.get('version')}:")
+    for r in results:
+        old = previous.get(r["detections"])
+        if old is None:
+            continue
+        change = (r["frame_ms"]["p50"] / old["frame_ms"]["p50"] - 1) * 100
+        flag = ""
+        if change > tolerance:
+            flag = "REGRESSION"
+            regressed = True
+        print("{:>10} detections: p50 {:.2f} -> {:.2f} ms ({:+.1f}%) {}".format(
+            r["detections"], old["frame_ms"]["p50"], r["frame_ms"]["p50"], change, flag))
+    return regressed
+
+# -------------------------------------------------------------------------
+# Main Program Start
+# -------------------------------------------------------------------------
+def main(args):
+    counts = [int(c) for c in args.detections.split(',')]
+
+    if args.no_network_tables:
+        networkTables = False
+    else:
+        config_parser = ConfigParser()
+        networkTables = WPINetworkTables(config_parser.team, "Benchmark", LABEL_MAP)
+
+    depthSource = create_cv_source() if args.depth_stream else None
+    results = run_benchmark(counts, args.frames, args.warmup, networkTables,
+                            create_cv_source(), depthSource, args.overlay, args.track)
+    print_results(results)
+
+    report = {"version": git_version(),
+              "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "platform": platform.platform(),
+              "machine": platform.machine(),
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "opencv": cv2.__version__,
+              "frames": args.frames,
+              "warmup": args.warmup,
+              "network_tables": not args.no_network_tables,
+              "depth_stream": args.depth_stream,
+              "overlay": args.overlay,
+              "track": args.track,
+              "results": results}
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Results written to", args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        mismatched = mismatched_options(report, baseline)
+        if mismatched:
+            raise SystemExit("ERROR: the baseline was run with other options, {}".format(
+                ", ".join(mismatched)))
+        if compare_results(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    print("Running benchmark_spacial.py")
+    args = parse_args()
+
+    main(args)
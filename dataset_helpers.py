@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+- This module stores recorded driving data in a few large shard files
+instead of one JPEG file per frame.
+- A dataset is a folder with dataset.json and numbered shards.  Each shard
+has a .data file with the frames and a .index file with one fixed size
+record per frame: the offset and length of the frame in the .data file,
+the speed and rotate labels and the time it was recorded.
+- The raw format stores the frames as arrays of the same shape one after
+another, so a shard can be memory-mapped as one array.  The jpeg format
+stores JPEG blobs, which are about ten times smaller.
+- Records are appended to the index as frames are written, so a shard can be
+read after a crash, up to the last complete frame.
+- DatasetReader memory-maps each shard once and reads any sample without
+opening a file.
+- convert_data_collected copies the DataCollected folders and logs written
+by img_helpers into a dataset.  JPEGs are copied without decoding them.
+- If runs independent, converts DataCollected into a dataset.
+"""
+
+import argparse
+import bisect
+import csv
+import json
+import os
+import time
+import cv2
+import numpy as np
+
+from img_helpers import AsyncImageWriter
+
+FORMATS = ("jpeg", "raw")
+
+INDEX_DTYPE = np.dtype([("offset", "<i8"), ("length", "<i8"),
+                        ("speed", "<f4"), ("rotate", "<f4"), ("timestamp", "<f8")])
+
+
+def shard_name(number):
+    return "shard_{:05d}".format(number)
+
+
+class DatasetWriter:
+    """
+        Appends frames and their labels to the shards of a dataset.
+
+    # Arguments
+        path: the dataset folder.  It is created if needed.  New shards are
+            added after the ones already there.
+        format: jpeg or raw.
+        shardSize: the number of frames in each shard.
+        quality: the JPEG quality for the jpeg format.
+    """
+    def __init__(self, path, format="jpeg", shardSize=1000, quality=95):
+        if format not in FORMATS:
+            raise ValueError("format must be one of {}".format(FORMATS))
+        self.path = path
+        self.shardSize = shardSize
+        self.quality = quality
+        os.makedirs(path, exist_ok=True)
+
+        self.metaPath = os.path.join(path, "dataset.json")
+        if os.path.exists(self.metaPath):
+            with open(self.metaPath) as f:
+                self.meta = json.load(f)
+            if self.meta["format"] != format:
+                raise ValueError("{} holds a {} dataset".format(path, self.meta["format"]))
+        else:
+            self.meta = {"version": 1, "format": format, "shard_size": shardSize,
+                         "shape": None, "dtype": None}
+            self._write_meta()
+
+        self.format = format
+        self.shardNumber = len(list_shards(path))
+        self.dataFile = None
+        self.indexFile = None
+        self.count = 0
+        self.offset = 0
+        self.written = 0
+
+    def _write_meta(self):
+        with open(self.metaPath, "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+    def _open_shard(self):
+        base = os.path.join(self.path, shard_name(self.shardNumber))
+        self.dataFile = open(base + ".data", "wb")
+        self.indexFile = open(base + ".index", "wb")
+        self.shardNumber += 1
+        self.count = 0
+        self.offset = 0
+
+    def _close_shard(self):
+        if self.dataFile is not None:
+            self.dataFile.close()
+            self.indexFile.close()
+            self.dataFile = self.indexFile = None
+
+    def append(self, img, speed, rotate, timestamp=None):
+        """Add a frame.  In the jpeg format it is encoded here."""
+        if self.format == "raw":
+            img = np.ascontiguousarray(img)
+            shape, dtype = list(img.shape), img.dtype.str
+            if self.meta["shape"] is None:
+                self.meta["shape"], self.meta["dtype"] = shape, dtype
+                self._write_meta()
+            elif shape != self.meta["shape"] or dtype != self.meta["dtype"]:
+                raise ValueError("raw frames must all be {} {}".format(self.meta["shape"], self.meta["dtype"]))
+            data = img.data
+        else:
+            ok, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            if not ok:
+                raise ValueError("could not encode the frame")
+            data = buffer.data
+        self._append_bytes(data, speed, rotate, timestamp)
+
+    def append_jpeg(self, jpeg, speed, rotate, timestamp=None):
+        """Add an already encoded JPEG frame to a jpeg dataset."""
+        if self.format != "jpeg":
+            raise ValueError("append_jpeg needs a jpeg dataset")
+        self._append_bytes(jpeg, speed, rotate, timestamp)
+
+    def _append_bytes(self, data, speed, rotate, timestamp):
+        if self.dataFile is None or self.count >= self.shardSize:
+            self._close_shard()
+            self._open_shard()
+        length = len(memoryview(data).cast("B"))
+        record = np.array([(self.offset, length, speed, rotate,
+                            time.time() if timestamp is None else timestamp)], dtype=INDEX_DTYPE)
+        # The frame goes in first, so an index record always has its data
+        self.dataFile.write(data)
+        self.dataFile.flush()
+        self.indexFile.write(record.tobytes())
+        self.indexFile.flush()
+        self.offset += length
+        self.count += 1
+        self.written += 1
+
+    def close(self):
+        self._close_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncDatasetWriter(AsyncImageWriter):
+    """
+        Appends frames to a DatasetWriter on a background thread with the
+        same bounded queue and drop policies as AsyncImageWriter.  One thread
+        keeps the frames in order.
+
+    # Arguments
+        dataset: the DatasetWriter.  It is closed with the writer.
+        maxQueue, policy: as for AsyncImageWriter.
+    """
+    def __init__(self, dataset, maxQueue=32, policy="drop_oldest"):
+        self.dataset = dataset
+        super().__init__(None, workers=1, maxQueue=maxQueue, policy=policy)
+
+    def write_item(self, fileName, img, speed, rotate):
+        if img.ndim == 1:
+            self.dataset.append_jpeg(img, speed, rotate)
+        else:
+            self.dataset.append(img, speed, rotate)
+        return True
+
+    def close(self):
+        super().close()
+        self.dataset.close()
+
+
+def list_shards(path):
+    """The shard names of a dataset in order."""
+    return sorted(name[:-len(".index")] for name in os.listdir(path) if name.endswith(".index"))
+
+
+class DatasetReader:
+    """
+        Reads any frame of a dataset.  dataset[i] returns (img, speed, rotate).
+
+    # Arguments
+        path: the dataset folder.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "dataset.json")) as f:
+            self.meta = json.load(f)
+        self.format = self.meta["format"]
+
+        self.shards = list_shards(path)
+        self.indexes = []
+        self.data = [None] * len(self.shards)
+        for name in self.shards:
+            base = os.path.join(path, name)
+            index = np.fromfile(base + ".index", dtype=INDEX_DTYPE)
+            # Skip frames cut short by a crash
+            dataSize = os.path.getsize(base + ".data")
+            self.indexes.append(index[index["offset"] + index["length"] <= dataSize])
+        self.starts = np.cumsum([0] + [len(index) for index in self.indexes]).tolist()
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def _shard_data(self, shard):
+        """Memory-map a shard's data the first time it is read."""
+        data = self.data[shard]
+        if data is None:
+            base = os.path.join(self.path, self.shards[shard])
+            if os.path.getsize(base + ".data") == 0:
+                data = np.zeros(0, dtype=np.uint8)
+            elif self.format == "raw":
+                shape = tuple(self.meta["shape"])
+                count = len(self.indexes[shard])
+                data = np.memmap(base + ".data", dtype=np.dtype(self.meta["dtype"]), mode="r",
+                                 shape=(count,) + shape)
+            else:
+                data = np.memmap(base + ".data", dtype=np.uint8, mode="r")
+            self.data[shard] = data
+        return data
+
+    def locate(self, i):
+        """The shard and row of frame i."""
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("frame {} out of range".format(i))
+        shard = bisect.bisect_right(self.starts, i) - 1
+        return shard, i - self.starts[shard]
+
+    def image(self, i):
+        """Frame i.  Raw frames are read-only views of the memory map."""
+        shard, row = self.locate(i)
+        data = self._shard_data(shard)
+        if self.format == "raw":
+            return data[row]
+        record = self.indexes[shard][row]
+        start = int(record["offset"])
+        return cv2.imdecode(data[start:start + int(record["length"])], cv2.IMREAD_UNCHANGED)
+
+    def labels(self):
+        """All of the index records as one array with offset, length, speed, rotate and timestamp fields."""
+        if not self.indexes:
+            return np.zeros(0, dtype=INDEX_DTYPE)
+        return np.concatenate(self.indexes)
+
+    def __getitem__(self, i):
+        shard, row = self.locate(i)
+        record = self.indexes[shard][row]
+        return self.image(i), float(record["speed"]), float(record["rotate"])
+
+
+def convert_data_collected(source, destination, format="jpeg", shardSize=1000):
+    """
+    Convert the DataCollected folder written by img_helpers into a dataset.
+
+    Each log_n.csv lists the images of the IMGn folder with their speed and
+    rotate.  The image paths in the logs are relative to the folder that
+    holds DataCollected.  Returns the number of frames converted.
+    """
+    root = os.path.dirname(os.path.abspath(source))
+    logs = sorted((name for name in os.listdir(source) if name.startswith("log_") and name.endswith(".csv")),
+                  key=lambda name: int(name[len("log_"):-len(".csv")]))
+    missing = 0
+    with DatasetWriter(destination, format, shardSize) as writer:
+        for log in logs:
+            with open(os.path.join(source, log), newline="") as f:
+                for row in csv.reader(f):
+                    if len(row) < 3:
+                        continue
+                    fileName, speed, rotate = row[0], float(row[1]), float(row[2])
+                    imagePath = fileName if os.path.isabs(fileName) else os.path.join(root, fileName)
+                    if not os.path.exists(imagePath):
+                        missing += 1
+                        continue
+                    if format == "jpeg":
+                        with open(imagePath, "rb") as image:
+                            writer.append_jpeg(image.read(), speed, rotate, os.path.getmtime(imagePath))
+                    else:
+                        writer.append(cv2.imread(imagePath), speed, rotate, os.path.getmtime(imagePath))
+        converted = writer.written
+    if missing:
+        print("Skipped", missing, "images missing from", source)
+    return converted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert DataCollected into a sharded dataset')
+    parser.add_argument('source', nargs='?', default='DataCollected',
+                        help='the DataCollected folder [DataCollected]')
+    parser.add_argument('destination', help='the dataset folder to write')
+    parser.add_argument('-f', '--format', type=str, default='jpeg', choices=FORMATS,
+                        help='store JPEG blobs or raw arrays [jpeg]')
+    parser.add_argument('-s', '--shard_size', type=int, default=1000,
+                        help='frames in each shard [1000]')
+    args = parser.parse_args()
+
+    count = convert_data_collected(args.source, args.destination, args.format, args.shard_size)
+    print("Converted", count, "frames to", args.destination)
@@ -0,0 +1,240 @@
+"""
+- This module holds the host side processing of OAK depth frames.
+- DepthColorizer turns a depth frame in millimeters into a color image
+for display.  The depth range and the color lookup table are fixed when it is
+created, so a frame is colored with two table lookups and no per-frame
+histogram.
+- SpatialCalculator does on the host what the spatial detection network
+does on the device, for detections decoded on the host.  Each box is
+shrunk by the bounding box scale factor and the depth inside it, between
+the depth thresholds, gives Z.  X and Y come from the center of the box and
+the camera intrinsics, with Y up like the device.
+- By default the depth of a box is a trimmed mean, the mean of the middle
+half of its depths, so the background and the holes around an object
+don't pull it away.  It reads a grid of at most 16 x 16 pixels spread over
+each box, every pixel of the smaller boxes, and sorts the grids of all the
+boxes at once, so the time doesn't grow with the size of the boxes.
+- The plain mean depth of every box is read from integral images of the
+depth frame and of its valid pixels, which are made once per frame.  The
+median of every pixel is taken box by box.
+"""
+
+import cv2
+import numpy as np
+
+from replay_helpers import HostSpatialDetection
+
+# The depth thresholds used by the spatial detection network
+DEPTH_LOWER_THRESHOLD = 100
+DEPTH_UPPER_THRESHOLD = 5000
+
+# The part of each box the spatial detection network reads the depth from
+BOUNDING_BOX_SCALE_FACTOR = 0.5
+
+# The horizontal field of view in degrees of the OAK-D rgb camera, for when
+# there is no calibration to read, like in a replay
+RGB_HFOV = 68.8
+
+SPATIAL_METHODS = ("trimmed", "mean", "median")
+
+# The pixels read from each box along each side for the trimmed mean, and
+# the part of its depths dropped at each end
+SAMPLE_GRID = 16
+TRIM_FRACTION = 0.25
+
+
+class DepthColorizer:
+    """
+        Colors depth frames over a fixed range of distances.
+
+    # Arguments
+        lower: depth in mm shown with the first color of the map.  Closer
+            depths, including invalid zero depths, are shown black.
+        upper: depth in mm shown with the last color of the map.
+        colormap: an OpenCV colormap.
+    """
+    def __init__(self, lower=DEPTH_LOWER_THRESHOLD, upper=DEPTH_UPPER_THRESHOLD,
+                 colormap=cv2.COLORMAP_HOT):
+        self.lower = lower
+        self.alpha = 255.0 / (upper - lower)
+        levels = np.arange(256, dtype=np.uint8).reshape(256, 1)
+        self.lut = cv2.applyColorMap(levels, colormap)
+        self.lut[0] = 0
+
+    def colorize(self, depthFrame):
+        # Saturating subtract so closer depths become zero instead of wrapping
+        levels = cv2.convertScaleAbs(cv2.subtract(depthFrame, self.lower), alpha=self.alpha)
+        return cv2.applyColorMap(levels, self.lut)
+
+
+def depth_consumer_attached(cvSource, depthSource):
+    """Return True when something will show the colored depth frame.
+
+    A desktop window always shows it.  A depth MJPEG stream only needs it while
+    a client is connected to the stream and the stream's next frame is due.
+    """
+    if cvSource is False:
+        return True
+    return depthSource is not None and depthSource.wants_frame()
+
+
+def scale_boxes(boxes, factor):
+    """Shrink or grow rows of xmin, ymin, xmax, ymax around their centers."""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    center = (boxes[:, :2] + boxes[:, 2:]) / 2
+    half = (boxes[:, 2:] - boxes[:, :2]) * factor / 2
+    return np.concatenate([center - half, center + half], axis=1)
+
+
+def fov_intrinsics(width, height, hfov=RGB_HFOV):
+    """The intrinsics of an ideal camera with square pixels and its center in the middle."""
+    f = width / 2 / np.tan(np.radians(hfov) / 2)
+    return np.array([[f, 0, width / 2], [0, f, height / 2], [0, 0, 1]])
+
+
+def rgb_intrinsics(device, width, height):
+    """
+    The intrinsics of the rgb camera at a resolution, which are those of
+    depth frames aligned to it.  A device without a calibration to read,
+    like a Replay, gets those of the nominal field of view.
+    """
+    if not hasattr(device, "readCalibration"):
+        return fov_intrinsics(width, height)
+    import depthai as dai
+
+    calibration = device.readCalibration()
+    return np.array(calibration.getCameraIntrinsics(dai.CameraBoardSocket.RGB, width, height))
+
+
+class SpatialCalculator:
+    """
+        Finds the X, Y, Z in mm of boxes from a depth frame, like the
+        spatial detection network.
+
+    # Arguments
+        intrinsics: the 3x3 camera matrix of the depth frame.  Aligned depth
+            uses the rgb camera's, see rgb_intrinsics.
+        size: the width and height the intrinsics are for.  They are scaled
+            to the size of each depth frame.  None if they are for the
+            depth frame size.
+        lower, upper: depths in mm outside of which pixels are ignored.
+        scaleFactor: the part of each box the depth is read from.
+        method: trimmed mean, mean or median of the depths inside the box.
+        crop: the normalized xmin, ymin, xmax, ymax of the depth frame the
+            boxes are normalized to, like the part of the view a preview
+            shows.  None if it is the whole frame.
+    """
+    def __init__(self, intrinsics, size=None, lower=DEPTH_LOWER_THRESHOLD, upper=DEPTH_UPPER_THRESHOLD,
+                 scaleFactor=BOUNDING_BOX_SCALE_FACTOR, method="trimmed", crop=None):
+        if method not in SPATIAL_METHODS:
+            raise ValueError("method must be one of {}".format(SPATIAL_METHODS))
+        self.intrinsics = np.asarray(intrinsics, dtype=np.float64).reshape(3, 3)
+        self.size = size
+        self.lower = lower
+        self.upper = upper
+        self.scaleFactor = scaleFactor
+        self.method = method
+        self.crop = crop
+
+    def rois(self, boxes, width, height):
+        """
+        The pixel rows of xmin, ymin, xmax, ymax the depth of each normalized
+        box is read from.  The max is exclusive and every ROI has a pixel.
+        """
+        scaled = scale_boxes(boxes, self.scaleFactor)
+        if self.crop is not None:
+            xmin, ymin, xmax, ymax = self.crop
+            scaled = scaled * [xmax - xmin, ymax - ymin, xmax - xmin, ymax - ymin] + [xmin, ymin, xmin, ymin]
+        scaled *= [width, height, width, height]
+        rois = np.empty(scaled.shape, dtype=np.intp)
+        rois[:, 0] = np.clip(np.floor(scaled[:, 0]), 0, width - 1)
+        rois[:, 1] = np.clip(np.floor(scaled[:, 1]), 0, height - 1)
+        rois[:, 2] = np.clip(np.ceil(scaled[:, 2]), rois[:, 0] + 1, width)
+        rois[:, 3] = np.clip(np.ceil(scaled[:, 3]), rois[:, 1] + 1, height)
+        return rois
+
+    def samples(self, depthFrame, rois):
+        """
+        The depths of a grid of at most SAMPLE_GRID x SAMPLE_GRID pixels
+        spread over each ROI, as the rows of an array.  Pixels outside the
+        thresholds, and the grid places a small ROI doesn't use, are inf.
+        """
+        steps = np.arange(SAMPLE_GRID)
+
+        def grid(start, end):
+            size = end - start
+            count = np.minimum(size, SAMPLE_GRID)[:, None]
+            # The middle pixel of each of count equal parts of the side.  The
+            # places past count are kept inside the ROI and left unused.
+            middle = start[:, None] + (size[:, None] * (2 * steps + 1)) // (2 * count)
+            return np.minimum(middle, end[:, None] - 1), steps < count
+
+        xs, usedX = grid(rois[:, 0], rois[:, 2])
+        ys, usedY = grid(rois[:, 1], rois[:, 3])
+        depths = depthFrame[ys[:, :, None], xs[:, None, :]].astype(np.float32)
+        valid = (depths >= self.lower) & (depths <= self.upper) & usedY[:, :, None] & usedX[:, None, :]
+        depths[~valid] = np.inf
+        return depths.reshape(len(rois), -1)
+
+    def trimmed_means(self, depthFrame, rois):
+        """The mean of the middle depths of each ROI's samples, 0 where none is valid."""
+        samples = np.sort(self.samples(depthFrame, rois), axis=1)
+        counts = np.isfinite(samples).sum(axis=1)
+        trim = (counts * TRIM_FRACTION).astype(int)
+        ranks = np.arange(samples.shape[1])
+        middle = (ranks >= trim[:, None]) & (ranks < (counts - trim)[:, None])
+        total = np.where(middle, samples, 0).sum(axis=1, dtype=np.float64)
+        return np.divide(total, counts - 2 * trim, out=np.zeros(len(rois)), where=counts > 0)
+
+    def depths(self, depthFrame, rois):
+        """The depth of each ROI in mm, 0 where no pixel is within the thresholds."""
+        if len(rois) == 0:
+            return np.zeros(0)
+        if self.method == "trimmed":
+            return self.trimmed_means(depthFrame, rois)
+        valid = cv2.inRange(depthFrame, self.lower, self.upper)
+        if self.method == "median":
+            z = np.zeros(len(rois))
+            for i, (x1, y1, x2, y2) in enumerate(rois.tolist()):
+                inRange = depthFrame[y1:y2, x1:x2][valid[y1:y2, x1:x2] > 0]
+                if len(inRange):
+                    z[i] = np.median(inRange)
+            return z
+
+        # The sum over a ROI is found from the integral at its four corners
+        sums = cv2.integral(cv2.bitwise_and(depthFrame, depthFrame, mask=valid), sdepth=cv2.CV_64F)
+        counts = cv2.integral(valid // 255, sdepth=cv2.CV_32S)
+        x1, y1, x2, y2 = rois.T
+        total = sums[y2, x2] - sums[y1, x2] - sums[y2, x1] + sums[y1, x1]
+        count = counts[y2, x2] - counts[y1, x2] - counts[y2, x1] + counts[y1, x1]
+        return np.divide(total, count, out=np.zeros(len(rois)), where=count > 0)
+
+    def calculate(self, depthFrame, boxes):
+        """
+        The X, Y, Z in mm of normalized boxes from a depth frame in mm.
+        Returns an (N, 3) array and the ROIs read.
+        """
+        height, width = depthFrame.shape[:2]
+        rois = self.rois(boxes, width, height)
+        z = self.depths(depthFrame, rois)
+
+        fx, fy = self.intrinsics[0, 0], self.intrinsics[1, 1]
+        cx, cy = self.intrinsics[0, 2], self.intrinsics[1, 2]
+        if self.size is not None:
+            scaleX, scaleY = width / self.size[0], height / self.size[1]
+            fx, cx, fy, cy = fx * scaleX, cx * scaleX, fy * scaleY, cy * scaleY
+        # The center of the ROI in pixel coordinates
+        u = (rois[:, 0] + rois[:, 2] - 1) / 2
+        v = (rois[:, 1] + rois[:, 3] - 1) / 2
+        coordinates = np.stack([z * (u - cx) / fx, -z * (v - cy) / fy, z], axis=1)
+        return coordinates, rois
+
+    def locate(self, detections, depthFrame):
+        """
+        Copies of detections with the spatialCoordinates found from the depth
+        frame, ready for put_spacial_detections.
+        """
+        boxes = [(d.xmin, d.ymin, d.xmax, d.ymax) for d in detections]
+        coordinates, _ = self.calculate(depthFrame, boxes)
+        return [HostSpatialDetection(d.label, d.confidence, d.xmin, d.ymin, d.xmax, d.ymax, tuple(c))
+                for d, c in zip(detections, coordinates.tolist())]
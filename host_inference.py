@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+"""
+- This module runs YOLO models on the host with OpenCV DNN, so the
+detection stack runs on a machine without an OAK camera, like a laptop
+with a USB webcam.
+- HostInference stands in for a dai.Device.  Its getOutputQueue returns
+queues with the rgb frames, detections, depth and bounding box mappings
+that oak_yolo_spacial.loop_and_detect reads, so the loop runs unchanged.
+- Frames are read from the camera on one thread.  Worker threads each take
+up to a batch of the waiting frames and run them through their own copy of
+the network in one forward pass.  Results are passed on in frame order.
+- There is no depth, so the spatial coordinates are 0 and the depth frame is
+blank.  The tracker matches the detections by their boxes.
+- Timestamps are taken from time.monotonic(), the clock dai.Clock.now()
+reads, so the latency is measured the same way as with a device.
+- Models that OpenCV reads are supported: ONNX, or OpenVINO IR when OpenCV
+was built with it.  The output can be decoded YOLO rows: N rows of box
+center, size, objectness and class scores (YOLOv5 style) or box and class
+scores (YOLOv8 style, either way round).  Raw output heads, like those the
+OAK's YOLO node decodes, are decoded by yolo_helpers with the anchors of
+the model config.
+- If runs independent, runs oak_yolo_spacial's detection loop on a webcam
+or a video file.
+"""
+
+import argparse
+import threading
+import time
+from collections import deque
+from pathlib import Path
+import cv2
+import numpy as np
+
+from overlay_helpers import DETAIL_LEVELS
+from replay_helpers import (HostImgFrame, HostDetections, HostSpatialDetection,
+                            HostLocationConfig, HostConfigData, HostRect, ReplayFinished)
+from yolo_helpers import class_nms, decoder_from_config
+
+STREAMS = ("rgb", "detections", "depth", "boundingBoxDepthMapping")
+
+
+def yolo_rows(output, numClasses):
+    """
+    Return a network output as (batch, N, columns) rows of box, [objectness]
+    and class scores.  Outputs with the rows as columns are transposed.
+    """
+    columns = (4 + numClasses, 5 + numClasses)
+    if output.ndim == 2:
+        output = output[None]
+    if output.ndim != 3:
+        raise ValueError("can't decode an output of shape {}.  Raw YOLO heads "
+                         "need anchors in the model config".format(output.shape))
+    if output.shape[2] not in columns and output.shape[1] in columns:
+        output = output.transpose(0, 2, 1)
+    if output.shape[2] not in columns:
+        raise ValueError("expected {} or {} columns for {} classes, the output is {}".format(
+            columns[0], columns[1], numClasses, output.shape))
+    return output
+
+
+class HostYoloDetector:
+    """
+        Runs a YOLO model with OpenCV DNN.  Not thread safe, each worker has
+        its own.
+
+    # Arguments
+        modelPath: the model file, like an .onnx file or the .xml of an
+            OpenVINO IR.
+        inputSize: the network input width and height.
+        numClasses: the number of classes.
+        confThreshold: the least score of a detection.
+        iouThreshold: the overlap above which a box of the same class is
+            suppressed.
+        decoder: a yolo_helpers.YoloDecoder for models that output raw
+            heads.  None if the outputs are decoded rows.
+    """
+    def __init__(self, modelPath, inputSize, numClasses, confThreshold=0.5, iouThreshold=0.5,
+                 decoder=None):
+        self.net = cv2.dnn.readNet(str(modelPath))
+        self.outputNames = self.net.getUnconnectedOutLayersNames()
+        self.inputSize = tuple(inputSize)
+        self.numClasses = numClasses
+        self.confThreshold = confThreshold
+        self.iouThreshold = iouThreshold
+        self.decoder = decoder
+
+    def detect(self, frames):
+        """Return a list of HostSpatialDetections for each BGR frame."""
+        blob = cv2.dnn.blobFromImages(frames, 1 / 255.0, self.inputSize, swapRB=True, crop=False)
+        self.net.setInput(blob)
+        outputs = self.net.forward(self.outputNames)
+        if self.decoder is not None and all(output.ndim == 4 for output in outputs):
+            return [[HostSpatialDetection(int(label), float(score), *map(float, box))
+                     for box, score, label in zip(boxes, scores, classes)]
+                    for boxes, scores, classes in self.decoder.decode(outputs)]
+        rows = np.concatenate([yolo_rows(output, self.numClasses) for output in outputs], axis=1)
+        return [self.decode(frameRows) for frameRows in rows]
+
+    def decode(self, rows):
+        """Turn the rows of one frame into detections with normalized boxes."""
+        classScores = rows[:, -self.numClasses:]
+        classes = classScores.argmax(axis=1)
+        scores = classScores[np.arange(len(rows)), classes]
+        if rows.shape[1] == 5 + self.numClasses:
+            scores = scores * rows[:, 4]
+        candidates = scores >= self.confThreshold
+        boxes = rows[candidates, :4].astype(np.float32)
+        scores, classes = scores[candidates], classes[candidates]
+
+        # Box centers and sizes are in input pixels, or already normalized
+        if len(boxes) and boxes.max() > 2:
+            boxes /= np.array(self.inputSize * 2, dtype=np.float32)
+        boxes = np.concatenate([boxes[:, :2] - boxes[:, 2:] / 2, boxes[:, :2] + boxes[:, 2:] / 2], axis=1)
+
+        keep = class_nms(boxes, scores, classes, self.iouThreshold)
+        return [HostSpatialDetection(int(classes[i]), float(scores[i]), *map(float, boxes[i]))
+                for i in keep]
+
+
+class HostQueue:
+    """Stands in for a dai.DataOutputQueue that HostInference puts messages in."""
+    def __init__(self, name, maxSize=4, blocking=False):
+        self.name = name
+        self.maxSize = maxSize
+        self.blocking = blocking
+        self.messages = deque()
+        self.cond = threading.Condition()
+        self.finished = False
+
+    def put(self, msg):
+        with self.cond:
+            if self.blocking:
+                self.cond.wait_for(lambda: len(self.messages) < self.maxSize or self.finished)
+            elif len(self.messages) >= self.maxSize:
+                self.messages.popleft()
+            self.messages.append(msg)
+            self.cond.notify_all()
+
+    def finish(self):
+        with self.cond:
+            self.finished = True
+            self.cond.notify_all()
+
+    def get(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.messages or self.finished)
+            if not self.messages:
+                raise ReplayFinished(f"Host '{self.name}' queue finished")
+            msg = self.messages.popleft()
+            self.cond.notify_all()
+            return msg
+
+    def tryGet(self):
+        with self.cond:
+            if not self.messages:
+                return None
+            msg = self.messages.popleft()
+            self.cond.notify_all()
+            return msg
+
+    def tryGetAll(self):
+        with self.cond:
+            msgs = list(self.messages)
+            self.messages.clear()
+            self.cond.notify_all()
+            return msgs
+
+    def getAll(self):
+        return [self.get()] + self.tryGetAll()
+
+    def has(self):
+        with self.cond:
+            return bool(self.messages)
+
+    def getName(self):
+        return self.name
+
+    def getMaxSize(self):
+        return self.maxSize
+
+    def getBlocking(self):
+        return self.blocking
+
+
+class HostInference:
+    """
+        Reads a camera and runs a detector on worker threads, with output
+        queues like a dai.Device running the spatial detection pipeline.
+
+    # Arguments
+        source: the OpenCV camera index, or a video file.  A video file is
+            read at its frame rate, like a camera, and finishes the queues
+            when it ends.
+        makeDetector: function returning a new detector for each worker.
+        workers: the number of inference threads.
+        batchSize: the most frames a worker runs in one forward pass.
+        maxPending: the most frames waiting for a worker.  The oldest is
+            dropped when the workers fall behind.
+        width, height: the camera resolution to ask for.
+    """
+    def __init__(self, source, makeDetector, workers=2, batchSize=1, maxPending=4,
+                 width=None, height=None):
+        self.camera = cv2.VideoCapture(source)
+        if not self.camera.isOpened():
+            raise RuntimeError("Can't open camera {}".format(source))
+        if width is not None:
+            self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        if height is not None:
+            self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        self.batchSize = batchSize
+        self.maxPending = maxPending
+        # A file would be read as fast as it can be decoded
+        self.frameInterval = 0.0
+        if not isinstance(source, int):
+            self.frameInterval = 1.0 / (self.camera.get(cv2.CAP_PROP_FPS) or 30.0)
+
+        self.queues = {}
+        self.pending = deque()
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.captureDone = False
+        self.takeTicket = 0
+        self.publishTicket = 0
+        self.dropped = 0
+        self.inferenceTime = 0.0
+        self.inferenceFrames = 0
+        self.blankDepth = None
+        self.errors = []
+
+        self.threads = [threading.Thread(target=self._capture, name="host-capture", daemon=True)]
+        self.threads += [threading.Thread(target=self._work, args=(makeDetector,),
+                                          name="host-inference-%d" % i, daemon=True)
+                         for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def getOutputQueue(self, name, maxSize=4, blocking=False):
+        if name not in STREAMS:
+            raise RuntimeError("No output stream named '{}'".format(name))
+        with self.cond:
+            if name not in self.queues:
+                self.queues[name] = HostQueue(name, maxSize, blocking)
+            return self.queues[name]
+
+    def getOutputQueueNames(self):
+        return list(STREAMS)
+
+    def _capture(self):
+        seq = 0
+        due = time.monotonic()
+        while not self.stopped:
+            if self.frameInterval:
+                due += self.frameInterval
+                time.sleep(max(due - time.monotonic(), 0.0))
+            ok, frame = self.camera.read()
+            timestamp = time.monotonic()
+            if not ok:
+                break
+            with self.cond:
+                if len(self.pending) >= self.maxPending:
+                    self.pending.popleft()
+                    self.dropped += 1
+                self.pending.append((seq, timestamp, frame))
+                self.cond.notify_all()
+            seq += 1
+        with self.cond:
+            self.captureDone = True
+            self.cond.notify_all()
+
+    def _work(self, makeDetector):
+        try:
+            detector = makeDetector()
+        except Exception as e:
+            self._fail(e)
+            return
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.captureDone or self.stopped)
+                if self.stopped or not self.pending:
+                    break
+                batch = [self.pending.popleft() for _ in range(min(self.batchSize, len(self.pending)))]
+                ticket = self.takeTicket
+                self.takeTicket += 1
+
+            start = time.perf_counter()
+            try:
+                results = detector.detect([frame for _, _, frame in batch])
+            except Exception as e:
+                self._fail(e)
+                return
+            elapsed = time.perf_counter() - start
+
+            # Publish in the order the frames were taken
+            with self.cond:
+                self.cond.wait_for(lambda: self.publishTicket == ticket or self.stopped)
+                if self.stopped:
+                    break
+                for (seq, timestamp, frame), detections in zip(batch, results):
+                    self._publish(seq, timestamp, frame, detections)
+                self.inferenceTime += elapsed
+                self.inferenceFrames += len(batch)
+                self.publishTicket += 1
+                self.cond.notify_all()
+        self._finish_if_done()
+
+    def _publish(self, seq, timestamp, frame, detections):
+        stamps = {"seq": seq, "timestamp": timestamp}
+        if self.blankDepth is None or self.blankDepth.shape != frame.shape[:2]:
+            self.blankDepth = np.zeros(frame.shape[:2], dtype=np.uint16)
+        messages = {"rgb": lambda: HostImgFrame(frame, **stamps),
+                    "detections": lambda: HostDetections(detections, **stamps),
+                    "depth": lambda: HostImgFrame(self.blankDepth, **stamps),
+                    "boundingBoxDepthMapping": lambda: HostLocationConfig(
+                        [HostConfigData(HostRect(d.xmin, d.ymin, d.xmax - d.xmin, d.ymax - d.ymin))
+                         for d in detections], **stamps)}
+        for name, queue in self.queues.items():
+            queue.put(messages[name]())
+
+    def _fail(self, error):
+        print("Host inference stopped:", error)
+        with self.cond:
+            self.errors.append(error)
+            self.stopped = True
+            self.cond.notify_all()
+        self._finish_queues()
+
+    def _finish_if_done(self):
+        with self.cond:
+            done = self.captureDone and not self.pending and self.publishTicket == self.takeTicket
+        if done or self.stopped:
+            self._finish_queues()
+
+    def _finish_queues(self):
+        with self.cond:
+            queues = list(self.queues.values())
+        for queue in queues:
+            queue.finish()
+
+    def close(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self._finish_queues()
+        for thread in self.threads:
+            thread.join(timeout=2)
+        self.camera.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stats(self):
+        with self.cond:
+            return {"frames": self.inferenceFrames, "dropped": self.dropped,
+                    "inference_ms": self.inferenceTime / self.inferenceFrames * 1000
+                    if self.inferenceFrames else 0.0}
+
+
+def parse_args():
+    """Parse input arguments."""
+    desc = 'Run a YOLO model with OpenCV DNN on a webcam instead of an OAK camera'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument(
+        '-m', '--model', type=str, required=True,
+        help='the model file, like an .onnx or OpenVINO .xml file')
+    parser.add_argument(
+        '-c', '--config', type=str, default=None,
+        help='the model config file [<model>-config.json]')
+    parser.add_argument(
+        '--source', type=str, default='0',
+        help='the camera index or a video file [0]')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=2,
+        help='inference threads [2]')
+    parser.add_argument(
+        '-b', '--batch', type=int, default=1,
+        help='most frames run through the network at once by each thread [1]')
+    parser.add_argument(
+        '-g', '--gui', action='store_true',
+        help='use desktop gui for display [False]')
+    parser.add_argument(
+        '-n', '--no_network_tables', action='store_true',
+        help='don\'t use WPI Network Tables [False]')
+    parser.add_argument(
+        '-p', '--mjpeg_port', type=int, default=8080,
+        help='MJPEG server port [8080]')
+    parser.add_argument(
+        '--headless', action='store_true',
+        help='only publish to Network Tables, without the MJPEG stream or windows [False]')
+    parser.add_argument(
+        '-o', '--overlay', type=str, default='full', choices=DETAIL_LEVELS,
+        help='detail drawn for each detection: box, label or full [full]')
+    parser.add_argument(
+        '--track', action='store_true',
+        help='track the detections and publish them with ids to ML/tracks [False]')
+    parser.add_argument(
+        '-s', '--serial', action='store_true',
+        help='run capture, publishing and rendering in one loop instead of threads [False]')
+    parser.add_argument(
+        '--report_interval', type=float, default=5.0,
+        help='seconds between the latency reports [5]')
+    # The options oak_yolo_spacial.run_detection reads that this script doesn't have
+    parser.set_defaults(stream_width=320, stream_height=240, stream_fps=15, stream_kbps=2000,
+                        host_decode=False)
+    args = parser.parse_args()
+    return args
+
+# -------------------------------------------------------------------------
+# Main Program Start
+# -------------------------------------------------------------------------
+def main(args):
+    # Imported here so the module can be used without depthai
+    from oak_yolo_spacial import run_detection
+    from wpi_helpers import ConfigParser, ModelConfigParser, WPINetworkTables
+
+    modelPath = Path(args.model)
+    configPath = args.config or str(modelPath.with_suffix("")) + "-config.json"
+    model_config = ModelConfigParser(configPath)
+    print(model_config.labelMap)
+    numClasses = model_config.classes or len(model_config.labelMap)
+    confidence = model_config.confidence_threshold or 0.5
+    iou = model_config.iou_threshold or 0.5
+
+    decoder = decoder_from_config(model_config) if model_config.anchors else None
+
+    def make_detector():
+        return HostYoloDetector(modelPath, model_config.inputSize, numClasses, confidence, iou, decoder)
+
+    if args.no_network_tables == False:
+        networkTables = WPINetworkTables(ConfigParser().team, "Host Webcam", model_config.labelMap)
+    else:
+        networkTables = False
+
+    source = int(args.source) if args.source.isdigit() else args.source
+    with HostInference(source, make_detector, args.workers, args.batch) as inference:
+        run_detection(inference, args, model_config, networkTables, args.mjpeg_port)
+        stats = inference.stats()
+    print("Inference: {frames} frames, {inference_ms:.1f} ms per frame, {dropped} dropped".format(**stats))
+
+
+if __name__ == '__main__':
+    print("Running host_inference.py")
+    args = parse_args()
+
+    main(args)
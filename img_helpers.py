@@ -1,67 +1,229 @@
 """
 - This module saves images and a log file.
-- Images are saved in a folder.
-- Folder should be created manually with the name "DataCollected"
+- Images are saved in a new IMGn folder inside "DataCollected".  The
+folder is created when the first image is saved.
 - The name of the image and the speed angle is logged
 in the log file.
+- Images are written by AsyncImageWriter on background threads, so the
+capture loop never waits for the SD card.  Its queue is bounded: when the
+card can't keep up, frames are dropped (or the caller waits) following the
+drop policy, and memory stays the same however long the session is.
+- Each log row is appended as soon as its image is written and the log is
+flushed every second, so a crash or power cut only loses the last second.
 - Call the saveData function to start.
 - Call the saveLog function to end.
 - If runs independent, will save ten images as a demo.
 """
 
-import pandas as pd
+import csv
 import os
+import threading
+import time
+from collections import deque
 import cv2
 from datetime import datetime
 
-global imgList, speedList
+DROP_POLICIES = ("drop_oldest", "drop_newest", "block")
+
 countFolder = 0
 count = 0
-imgList = []
-speedList = []
-rotateList = []
 
 #GET CURRENT DIRECTORY PATH
 myDirectory = os.path.join(os.getcwd(), 'DataCollected')
 # print(myDirectory)
+newPath = None
+newFilename = None
 
 # CREATE A NEW FOLDER BASED ON THE PREVIOUS FOLDER COUNT
-while os.path.exists(os.path.join(myDirectory,f'IMG{str(countFolder)}')):
+def createFolder():
+    global countFolder, newPath, newFilename
+    while os.path.exists(os.path.join(myDirectory,f'IMG{str(countFolder)}')):
         countFolder += 1
-newPath = myDirectory +"/IMG"+str(countFolder)
-newFilename = "DataCollected/IMG"+str(countFolder)
-os.makedirs(newPath)
+    newPath = myDirectory +"/IMG"+str(countFolder)
+    newFilename = "DataCollected/IMG"+str(countFolder)
+    os.makedirs(newPath)
+
+
+class AsyncImageWriter:
+    """
+        Writes images and their log rows on a pool of background threads.
+
+    # Arguments
+        logPath: the CSV log file.  Rows of image file name, speed and rotate
+            are appended to it in the order the images were submitted.
+            None writes no log.
+        workers: the number of writer threads.
+        maxQueue: the most images waiting to be written.
+        policy: what submit does when the queue is full.  drop_oldest
+            replaces the oldest waiting image, drop_newest drops the new one
+            and block waits for room.
+        flushInterval: seconds between flushes of the log file.
+    """
+    def __init__(self, logPath, workers=2, maxQueue=32, policy="drop_oldest", flushInterval=1.0):
+        if policy not in DROP_POLICIES:
+            raise ValueError("policy must be one of {}".format(DROP_POLICIES))
+        self.policy = policy
+        self.maxQueue = maxQueue
+        self.flushInterval = flushInterval
+        self.pending = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+        # Each queued image has a ticket.  The rows of images written before
+        # an earlier one wait in rows until it is done.
+        self.tickets = 0
+        self.nextRow = 0
+        self.rows = {}
+        self.logLock = threading.Lock()
+        self.logFile = None
+        if logPath is not None:
+            self.logFile = open(logPath, "a", newline="")
+            self.log = csv.writer(self.logFile)
+        self.lastFlush = time.monotonic()
+
+        self.threads = [threading.Thread(target=self._run, name="image-writer-%d" % i, daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, fileName, img, speed, rotate):
+        """Queue an image to be written.  Returns False if it was dropped."""
+        with self.cond:
+            if self.closed:
+                raise ValueError("the writer is closed")
+            self.submitted += 1
+            if len(self.pending) >= self.maxQueue:
+                if self.policy == "drop_newest":
+                    self.dropped += 1
+                    return False
+                if self.policy == "drop_oldest":
+                    self._log(self.pending.popleft()[0], None)
+                    self.dropped += 1
+                else:
+                    self.cond.wait_for(lambda: len(self.pending) < self.maxQueue)
+            self.pending.append((self.tickets, fileName, img, speed, rotate))
+            self.tickets += 1
+            self.cond.notify_all()
+        return True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.closed)
+                if not self.pending:
+                    return
+                ticket, fileName, img, speed, rotate = self.pending.popleft()
+                # Let a blocked submit know there is room
+                self.cond.notify_all()
+
+            try:
+                ok = self.write_item(fileName, img, speed, rotate)
+            except (OSError, ValueError, cv2.error) as e:
+                print("Image not written:", e)
+                ok = False
+            self._log(ticket, [fileName, speed, rotate] if ok else None)
+            with self.cond:
+                if ok:
+                    self.written += 1
+                else:
+                    self.failed += 1
+
+    def write_item(self, fileName, img, speed, rotate):
+        """Write one image.  Returns False if it couldn't be written."""
+        if img.ndim == 1:
+            # Already JPEG encoded, by the camera
+            with open(fileName, "wb") as f:
+                f.write(img)
+        elif not cv2.imwrite(fileName, img):
+            return False
+        return True
+
+    def _log(self, ticket, row):
+        """
+        Log the row of a ticket's image, None if it was dropped or failed,
+        once the rows of every earlier ticket are logged.
+        """
+        if self.logFile is None:
+            return
+        with self.logLock:
+            self.rows[ticket] = row
+            while self.nextRow in self.rows:
+                row = self.rows.pop(self.nextRow)
+                self.nextRow += 1
+                if row is not None:
+                    self.log.writerow(row)
+            now = time.monotonic()
+            if now - self.lastFlush >= self.flushInterval:
+                self.logFile.flush()
+                self.lastFlush = now
+
+    def close(self):
+        """Write the images still queued, then flush and close the log."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        if self.logFile is not None:
+            with self.logLock:
+                self.logFile.close()
+
+    def stats(self):
+        with self.cond:
+            return {"submitted": self.submitted, "written": self.written,
+                    "dropped": self.dropped, "failed": self.failed,
+                    "queued": len(self.pending)}
+
+
+writer = None
+writerOptions = {}
+
+# SET HOW IMAGES ARE WRITTEN, BEFORE THE FIRST saveData
+def configureWriter(**options):
+    """Set the AsyncImageWriter arguments used by saveData."""
+    writerOptions.update(options)
 
 # SAVE IMAGES IN THE FOLDER
 def saveData(img,speed, rotate):
-    global imgList, speedList, rotateList
+    """Queue an image, or the bytes of a JPEG as a 1-D array, to be saved.  Returns False if it was dropped."""
+    global writer
+    if writer is None:
+        if newPath is None:
+            createFolder()
+        logPath = os.path.join(myDirectory,f'log_{str(countFolder)}.csv')
+        writer = AsyncImageWriter(logPath, **writerOptions)
     now = datetime.now()
     timestamp = str(datetime.timestamp(now)).replace('.', '')
     #print("timestamp =", timestamp)
     # fileName = os.path.join(newPath,f'Image_{timestamp}.jpg')
     fileName = os.path.join(newFilename,f'Image_{timestamp}.jpg')
-    cv2.imwrite(fileName, img)
-    imgList.append(fileName)
-    speedList.append(speed)
-    rotateList.append(rotate)
+    return writer.submit(fileName, img, speed, rotate)
 
 
 # SAVE LOG FILE WHEN THE SESSION ENDS
 def saveLog():
-    global imgList, speedList, rotateList
-    rawData = {'Image': imgList,
-                'speed': speedList,
-                'rotate': rotateList}
-    df = pd.DataFrame(rawData)
-    df.to_csv(os.path.join(myDirectory,f'log_{str(countFolder)}.csv'), index=False, header=False)
+    """Wait for the queued images to be written and close the log."""
+    global writer
+    if writer is None:
+        print('No images saved')
+        return
+    writer.close()
+    stats = writer.stats()
+    writer = None
     print('Log Saved')
-    print('Total Images: ',len(imgList))
+    print('Total Images: ', stats["written"])
+    if stats["dropped"] or stats["failed"]:
+        print('Dropped Images: ', stats["dropped"], ' Failed Images: ', stats["failed"])
 
 if __name__ == '__main__':
     cap = cv2.VideoCapture(1)
     for x in range(10):
         _, img = cap.read()
-        saveData(img, 0.5)
+        saveData(img, 0.5, 0)
         cv2.waitKey(1)
         cv2.imshow("Image", img)
     saveLog()
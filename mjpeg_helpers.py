@@ -0,0 +1,140 @@
+"""
+- This module has the MJPEG server used when cscore isn't installed.
+- wpi_helpers.start_mjpeg_source only imports it then, so the HTTP server
+modules aren't loaded on a robot that has cscore.
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import cv2
+
+
+class FrameBroadcaster:
+    """
+        Shares the latest frame with every connected MJPEG client.
+
+        Each frame is JPEG encoded once, and only while a client is connected.
+        Clients wait on a condition for the next frame instead of polling.  A
+        client that is still sending an old frame skips to the newest one, so
+        a slow client never holds up the others or the caller.
+
+    # Arguments
+        quality: JPEG quality from 0 to 100.
+    """
+    def __init__(self, quality=80):
+        self.quality = quality
+        self.cond = threading.Condition()
+        self.jpeg = None
+        self.frame_size = 0
+        self.frame_number = 0
+        self.clients = 0
+        self.closed = False
+
+    def putFrame(self, frame):
+        if self.clients == 0:
+            return
+        ok, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, int(self.quality)])
+        if not ok:
+            return
+        with self.cond:
+            self.jpeg = buffer.tobytes()
+            self.frame_size = len(self.jpeg)
+            self.frame_number += 1
+            self.cond.notify_all()
+
+    def isEnabled(self):
+        """True while a client is connected, like cscore's CvSource."""
+        return self.clients > 0
+
+    def wait_for_frame(self, last_frame_number, timeout=1.0):
+        """Wait for a frame newer than last_frame_number.  Returns (frame_number, jpeg)."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.frame_number != last_frame_number or self.closed, timeout)
+            if self.frame_number == last_frame_number:
+                return last_frame_number, None
+            return self.frame_number, self.jpeg
+
+    def add_client(self):
+        with self.cond:
+            self.clients += 1
+
+    def remove_client(self):
+        with self.cond:
+            self.clients -= 1
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class VideoStreamHandler(BaseHTTPRequestHandler):
+    # Drop clients that stop reading
+    timeout = 5
+
+    def do_GET(self):
+        broadcaster = self.server.broadcaster
+        self.send_response(200)
+        self.send_header('Content-type', 'multipart/x-mixed-replace; boundary=jpgboundary')
+        self.end_headers()
+        broadcaster.add_client()
+        try:
+            frame_number = 0
+            while not broadcaster.closed:
+                frame_number, jpeg = broadcaster.wait_for_frame(frame_number)
+                if jpeg is None:
+                    continue
+                self.wfile.write(b"--jpgboundary\r\n")
+                self.send_header('Content-type', 'image/jpeg')
+                self.send_header('Content-length', str(len(jpeg)))
+                self.end_headers()
+                self.wfile.write(jpeg)
+                self.wfile.write(b"\r\n")
+        except OSError:
+            # The client disconnected or timed out
+            pass
+        finally:
+            broadcaster.remove_client()
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """Handle requests in a separate thread."""
+    daemon_threads = True
+
+class MjpegStreamServer:
+    """
+        An MJPEG server for when cscore isn't installed.  It has the same
+        putFrame and isEnabled methods as a cscore CvSource.
+
+    # Arguments
+        port: the HTTP port to stream on.
+        quality: JPEG quality from 0 to 100.
+    """
+    def __init__(self, port, quality=80):
+        self.broadcaster = FrameBroadcaster(quality)
+        self.server = ThreadedHTTPServer(('', port), VideoStreamHandler)
+        self.server.broadcaster = self.broadcaster
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def putFrame(self, frame):
+        self.broadcaster.putFrame(frame)
+
+    def isEnabled(self):
+        return self.broadcaster.isEnabled()
+
+    def setCompression(self, quality):
+        """Set the JPEG quality, like cscore's MjpegServer."""
+        self.broadcaster.quality = quality
+
+    def frameSize(self):
+        """The size in bytes of the last JPEG sent."""
+        return self.broadcaster.frame_size
+
+    def close(self):
+        self.broadcaster.close()
+        self.server.shutdown()
+        self.server.server_close()
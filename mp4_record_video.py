@@ -1,11 +1,9 @@
 #!/usr/bin/env python3
 
-import av
 import depthai as dai
-from fractions import Fraction
-import time
-import sys
 import argparse
+from startup_helpers import timeline, wait_for_device
+from video_helpers import CODECS, SegmentedVideoWriter, encoder_profile
 
 def parse_args():
     """Parse input arguments."""
@@ -14,18 +12,25 @@ def parse_args():
             'YOLO model')
     parser = argparse.ArgumentParser(description=desc)
     parser.add_argument(
-        '-c', '--codec', type=str, default="mjpeg",
+        '-c', '--codec', type=str, default="mjpeg", choices=CODECS,
         help='codec can be either h264, h265, or mjpeg')
+    parser.add_argument(
+        '-f', '--folder', type=str, default="videos",
+        help='folder the video segments are written to [videos]')
+    parser.add_argument(
+        '--segment_seconds', type=float, default=60.0,
+        help='start a new segment after this many seconds, 0 for no limit [60]')
+    parser.add_argument(
+        '--segment_mb', type=float, default=0,
+        help='start a new segment after this many megabytes, 0 for no limit [0]')
+    parser.add_argument(
+        '--device_timeout', type=float, default=None,
+        help='seconds to wait for the OAK camera before giving up [wait forever]')
 
     args = parser.parse_args()
     return args    
 
 
-def get_encoder_profile(codec):
-    if codec == "h264": return dai.VideoEncoderProperties.Profile.H264_MAIN
-    elif codec == "mjpeg": return dai.VideoEncoderProperties.Profile.MJPEG
-    else: return dai.VideoEncoderProperties.Profile.H265_MAIN
-
 # -------------------------------------------------------------------------
 # Main Program Start
 # -------------------------------------------------------------------------
@@ -46,7 +51,7 @@ def main(args):
     # Properties
     print(f"codec {args.codec}")
     videoEnc = pipeline.create(dai.node.VideoEncoder)
-    videoEnc.setDefaultProfilePreset(30, get_encoder_profile(args.codec))
+    videoEnc.setDefaultProfilePreset(30, encoder_profile(args.codec))
     # videoEnc.setLossless(True) # Lossless MJPEG, video players usually don't support it
     camRgb.video.link(videoEnc.input)
 
@@ -55,37 +60,32 @@ def main(args):
     videoEnc.bitstream.link(xout.input)
 
     # Connect to device and start pipeline
-    with dai.Device(pipeline) as device:
+    with dai.Device(pipeline, wait_for_device(timeout=args.device_timeout)) as device:
+        timeline.mark("Pipeline started")
 
-        print(f"App starting streaming {get_encoder_profile(args.codec).name} encoded frames into file video.mp4")
+        print(f"App starting streaming {encoder_profile(args.codec).name} encoded frames into {args.folder}")
 
         # Output queue will be used to get the encoded data from the output defined above
         q = device.getOutputQueue(name="enc", maxSize=30, blocking=True)
 
-        output_container = av.open('video.mp4', 'w')
-        stream = output_container.add_stream(args.codec, rate=30)
-        stream.time_base = Fraction(1, 1000 * 1000) # Microseconds
-
-        if args.codec == "mjpeg":
-            # We need to set pixel format for MJEPG, for H264/H265 it's yuv420p by default
-            stream.pix_fmt = "yuvj420p"
-
-        start = time.time()
+        width, height = camRgb.getVideoSize()
+        writer = SegmentedVideoWriter(args.folder, args.codec, fps=30, width=width, height=height,
+                                      segmentSeconds=args.segment_seconds or None,
+                                      segmentBytes=int(args.segment_mb * 1000000) or None)
         try:
             while True:
-                data = q.get().getData() # np.array
-                packet = av.Packet(data) # Create new packet with byte array
-
-                # Set frame timestamp
-                packet.pts = int((time.time() - start) * 1000 * 1000)
-
-                output_container.mux_one(packet) # Mux the Packet into container
+                # The writer muxes on its own thread with the packet's device timestamp
+                writer.write(q.get())
 
         except KeyboardInterrupt:
             # Keyboard interrupt (Ctrl + C) detected
             pass
 
-        output_container.close()
+        writer.close()
+        stats = writer.stats()
+        print("Wrote {packets} packets to {segments} segments".format(**stats))
+        if stats["skipped"]:
+            print("Packets missing from the encoder output:", stats["skipped"])
 
 if __name__ == '__main__':
     print("Running record_video.py")
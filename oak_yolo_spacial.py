@@ -12,7 +12,20 @@ from pathlib import Path
 import cv2
 import depthai as dai
 
-from wpi_helpers import ConfigParser, WPINetworkTables, ModelConfigParser, WPINetworkTables
+from startup_helpers import timeline, wait_for_device, wait_for_devices, watch_network_tables
+from wpi_helpers import (ConfigParser, WPINetworkTables, ModelConfigParser, WPINetworkTables, start_mjpeg_source,
+                         start_network_tables)
+from replay_helpers import (Recorder, Replay, HostDetections, HostSpatialDetection, HostRect,
+                            HostConfigData, HostLocationConfig)
+from perf_helpers import NullTimer, FpsCounter, CameraMonitor, LatencyTracker, RuntimeStats
+from pipeline_helpers import LatestMailbox, StageThread, MessageSynchronizer
+from pipeline_builder import (SPATIAL_STREAMS, streams_for_args, bandwidth, format_bandwidth,
+                              load_profile)
+from depth_helpers import (DepthColorizer, SpatialCalculator, depth_consumer_attached, rgb_intrinsics,
+                           BOUNDING_BOX_SCALE_FACTOR, DEPTH_LOWER_THRESHOLD, DEPTH_UPPER_THRESHOLD)
+from overlay_helpers import OverlayRenderer, DETAIL_LEVELS
+from tracking_helpers import Tracker
+from yolo_helpers import decoder_from_config
 
 '''
 Spatial Tiny-yolo example
@@ -22,6 +35,11 @@ Spatial Tiny-yolo example
   
   The script uses the WPI Network Tables to send data back to the WPI program.
   Can be used for tiny-yolo-v3 or tiny-yolo-v4 networks  
+
+  With --host_decode the model runs in a plain NeuralNetwork node and its
+  raw YOLO outputs are decoded on the host with yolo_helpers, for models the
+  YOLO node can't decode, like YOLOv5.  The spatial coordinates are then
+  found on the host from the aligned depth frames with depth_helpers.
 '''
 
 def parse_args():
@@ -54,30 +72,261 @@ def parse_args():
     parser.add_argument(
         '-p', '--mjpeg_port', type=int, default=8080,
         help='MJPEG server port [8080]')    
+    parser.add_argument(
+        '-o', '--overlay', type=str, default='full', choices=DETAIL_LEVELS,
+        help='detail drawn for each detection: box, label or full [full]')
+    parser.add_argument(
+        '--profile', type=str, default=None,
+        help=('pipeline profile from the model config or built in: default, low-latency, '
+              'max-fps or max-accuracy [the config\'s profile, or default]'))
+    parser.add_argument(
+        '--headless', action='store_true',
+        help='only publish to Network Tables, without the MJPEG stream or windows [False]')
+    parser.add_argument(
+        '--host_decode', action='store_true',
+        help=('run the model as a plain neural network and decode its YOLO outputs on the host, '
+              'for models the YOLO node can\'t decode [False]'))
+    parser.add_argument(
+        '--depth_port', type=int, default=None,
+        help='also stream the colored depth map on this MJPEG port')
+    parser.add_argument(
+        '--stream_width', type=int, default=320,
+        help='width of the MJPEG streams [320]')
+    parser.add_argument(
+        '--stream_height', type=int, default=240,
+        help='height of the MJPEG streams [240]')
+    parser.add_argument(
+        '--stream_fps', type=float, default=15,
+        help='most frames per second sent on each MJPEG stream, 0 for every frame [15]')
+    parser.add_argument(
+        '--stream_kbps', type=int, default=2000,
+        help='bandwidth budget of each MJPEG stream in kbit/s, 0 for a fixed JPEG quality [2000]')
+    parser.add_argument(
+        '--track', action='store_true',
+        help='track the detections and publish them with ids and velocities to ML/tracks [False]')
+    parser.add_argument(
+        '-d', '--devices', type=str, default=None,
+        help=('run on several OAK cameras: "all", or comma separated MxIds or '
+              'camera names from frc.json.  Camera i streams on mjpeg_port + i'))
+    parser.add_argument(
+        '--report_interval', type=float, default=5.0,
+        help='seconds between the latency reports, and the per camera fps reports with --devices [5]')
+    parser.add_argument(
+        '-s', '--serial', action='store_true',
+        help='run capture, publishing and rendering in one loop instead of threads [False]')
+    parser.add_argument(
+        '--device_timeout', type=float, default=None,
+        help='seconds to wait for the OAK camera before giving up [wait forever]')
+    parser.add_argument(
+        '-r', '--record', type=str, default=None,
+        help='record the device output queues to this folder')
+    parser.add_argument(
+        '--replay', type=str, default=None,
+        help='replay a recording from this folder instead of using a device')
+    parser.add_argument(
+        '--loop', action='store_true',
+        help='start the replay over when it finishes [False]')
+    parser.add_argument(
+        '--realtime', action='store_true',
+        help='replay at the recorded rate instead of full speed [False]')
     args = parser.parse_args()
     return args
 
-def draw_boxes(detection, frame, label, color):
-    # Denormalize bounding box
-    x1 = int(detection.xmin * frame.shape[1])
-    x2 = int(detection.xmax * frame.shape[1])
-    y1 = int(detection.ymin * frame.shape[0])
-    y2 = int(detection.ymax * frame.shape[0])
-
-    x_coord = int(detection.spatialCoordinates.x)   
-    y_coord = int(detection.spatialCoordinates.y)
-    z_coord = int(detection.spatialCoordinates.z)
-    cv2.putText(frame, str(label), (x1 + 10, y1 + 20), cv2.FONT_HERSHEY_TRIPLEX, 0.5, 255)
-    cv2.putText(frame, "{:.2f}".format(detection.confidence*100), (x1 + 10, y1 + 35), cv2.FONT_HERSHEY_TRIPLEX, 0.5, 255)
-    cv2.putText(frame, f"X: {x_coord} mm", (x1 + 10, y1 + 50), cv2.FONT_HERSHEY_TRIPLEX, 0.5, 255)
-    cv2.putText(frame, f"Y: {y_coord} mm", (x1 + 10, y1 + 65), cv2.FONT_HERSHEY_TRIPLEX, 0.5, 255)
-    cv2.putText(frame, f"Z: {z_coord} mm", (x1 + 10, y1 + 80), cv2.FONT_HERSHEY_TRIPLEX, 0.5, 255)
-
-    cv2.rectangle(frame, (x1, y1), (x2, y2), color, cv2.FONT_HERSHEY_SIMPLEX)
-    return frame
-           
+class FrameData:
+    """The messages from the device that belong to one frame."""
+    def __init__(self, inPreview, inDet, depth, boundingBoxMapping, fps):
+        self.inPreview = inPreview
+        self.inDet = inDet
+        self.depth = depth
+        self.boundingBoxMapping = boundingBoxMapping
+        self.detections = inDet.detections
+        self.fps = fps
+        self.tracks = None
+        # dai.Clock times used to measure the latency
+        self.received = dai.Clock.now()
+        self.publishStart = None
+        self.published = None
+
+def create_synchronizer(previewQueue, detectionNNQueue, depthQueue, 
+                        xoutBoundingBoxDepthMappingQueue):
+    """Match up the messages of each frame from the output queues.
+
+    The rgb frames, detections and bounding box mappings come from the same
+    color camera frame and share sequence numbers.  Depth comes from the mono
+    cameras, so it is matched by timestamp.  The bounding box mapping is only
+    used to draw on the depth frame and is never waited for.  Queues that are
+    None, for streams the pipeline doesn't send, are left out.
+    """
+    queues = {"rgb": previewQueue, 
+              "detections": detectionNNQueue, 
+              "depth": depthQueue, 
+              "boundingBoxDepthMapping": xoutBoundingBoxDepthMappingQueue}
+    queues = {name: queue for name, queue in queues.items() if queue is not None}
+    return MessageSynchronizer(queues, matchByTime=("depth",), optional=("boundingBoxDepthMapping",))
+
+class HostDecoder:
+    """
+        Decodes the raw YOLO output layers a NeuralNetwork node sends as the
+        detections stream into a detections message like the YOLO node's.
+        With a spatial calculator the detections get the spatial coordinates
+        of the frame's depth, and the ROIs read become the bundle's bounding
+        box mappings, like the spatial detection network sends.
+
+    # Arguments
+        decoder: a yolo_helpers YoloDecoder with the model's anchors.
+        spatialCalculator: Optional depth_helpers SpatialCalculator.
+    """
+    def __init__(self, decoder, spatialCalculator=None):
+        self.decoder = decoder
+        self.spatialCalculator = spatialCalculator
+
+    def decode(self, bundle):
+        """Replace the NNData message of a frame's bundle with its detections."""
+        nnData = bundle["detections"]
+        layers = [nnData.getLayerFp16(name) for name in nnData.getAllLayerNames()]
+        boxes, scores, classes = self.decoder.decode_layers(layers)
+        detections = [HostSpatialDetection(int(label), float(score), *map(float, box))
+                      for box, score, label in zip(boxes, scores, classes)]
+        stamps = {"seq": nnData.getSequenceNum(), "timestamp": nnData.getTimestamp().total_seconds(),
+                  "timestampDevice": nnData.getTimestampDevice().total_seconds()}
+        depth = bundle.get("depth")
+        if self.spatialCalculator is not None and depth is not None:
+            depthFrame = depth.getFrame()
+            detections = self.spatialCalculator.locate(detections, depthFrame)
+            height, width = depthFrame.shape[:2]
+            rois = self.spatialCalculator.rois(boxes, width, height)
+            configData = [HostConfigData(HostRect(x1 / width, y1 / height, (x2 - x1) / width, (y2 - y1) / height))
+                          for x1, y1, x2, y2 in rois.tolist()]
+            bundle["boundingBoxDepthMapping"] = HostLocationConfig(configData, **stamps)
+        bundle["detections"] = HostDetections(detections, **stamps)
+
+def create_spatial_calculator(device, model_config, profile=None):
+    """
+    A SpatialCalculator for the detections of a pipeline created with
+    hostDecode, which are normalized to the preview, from depth aligned to
+    the rgb camera.
+    """
+    if profile is None:
+        profile = load_profile(model_config)
+    sensorSize = profile.sensor_size()
+    return SpatialCalculator(rgb_intrinsics(device, *sensorSize), size=sensorSize,
+                             crop=profile.preview_crop(model_config.inputSize))
+
+def read_frame(synchronizer, fpsCounter, hostDecoder=None):
+    """Wait for the next frame's messages and bundle them together."""
+    bundle = synchronizer.get()
+    if hostDecoder is not None:
+        hostDecoder.decode(bundle)
+    return FrameData(bundle.get("rgb"), bundle["detections"], bundle.get("depth"), 
+                     bundle.get("boundingBoxDepthMapping"), fpsCounter.tick())
+
+def monitor_frame(frameData, monitor):
+    """Count the frame and its latency from capture on the device to now."""
+    if monitor is not None:
+        monitor.frame((dai.Clock.now() - frameData.inDet.getTimestamp()).total_seconds())
+
+def track_frame(frameData, tracker):
+    """Match the frame's detections to the tracks when tracking is on."""
+    if tracker is not None:
+        timestamp = frameData.inDet.getTimestamp().total_seconds()
+        frameData.tracks = tracker.update(frameData.detections, timestamp)
+
+def publish_frame(frameData, networkTables):
+    """Put all of the frame's data to Network Tables in one update."""
+    frameData.publishStart = dai.Clock.now()
+    if networkTables:
+        networkTables.put_spacial_detections(frameData.detections, frameData.inDet.getSequenceNum(),
+                                             frameData.tracks)
+        timeline.mark_once("First detections published")
+    frameData.published = dai.Clock.now()
+
+def measure_latency(frameData, latency, networkTables):
+    """Add the frame's latency from capture to publish, and report it every so often."""
+    if latency is None:
+        return
+    latency.frame(frameData.inDet.getTimestamp(), frameData.received,
+                  frameData.publishStart, frameData.published)
+    if latency.due():
+        summary = latency.summary()
+        print(latency.format(summary))
+        if networkTables:
+            networkTables.put_latency(summary)
+
+def report_stats(stats, networkTables, synchronizer, mailboxes=()):
+    """Publish the runtime statistics once every interval, with the frames dropped in it."""
+    if stats is None or not stats.due():
+        return
+    syncStats = synchronizer.stats()
+    report = stats.report(queue_drops=sum(syncStats["missed"].values()),
+                          sync_drops=sum(syncStats["dropped"].values()),
+                          skipped_frames=sum(mailbox.dropped for mailbox in mailboxes))
+    if networkTables:
+        networkTables.put_stats(report)
+
+def render_frame(frameData, overlay, cvSource, depthSource, depthColorizer, timer):
+    """Draw the detections on the frame and send it to the display or the mjpeg server.
+
+    Nothing is rendered headless, when cvSource is None.  Returns True if a
+    frame was shown or streamed.
+    """
+    if cvSource is None:
+        return False
+    color = (255, 255, 255)
+
+    frame = frameData.inPreview.getCvFrame()
+    timer.mark("getCvFrame")
+
+    # Skip the drawing when no stream wants this frame
+    showFrame = cvSource is False or cvSource.wants_frame()
+    showDepth = frameData.depth is not None and depth_consumer_attached(cvSource, depthSource)
+    if showDepth:
+        depthFrame = frameData.depth.getFrame() # depthFrame values are in millimeters
+        depthFrameColor = depthColorizer.colorize(depthFrame)
+    timer.mark("depth_colorize")
+
+    if showDepth and frameData.boundingBoxMapping is not None:
+        roiDatas = frameData.boundingBoxMapping.getConfigData()
+
+        for roiData in roiDatas:
+            roi = roiData.roi
+            roi = roi.denormalize(depthFrameColor.shape[1], depthFrameColor.shape[0])
+            topLeft = roi.topLeft()
+            bottomRight = roi.bottomRight()
+            xmin = int(topLeft.x)
+            ymin = int(topLeft.y)
+            xmax = int(bottomRight.x)
+            ymax = int(bottomRight.y)
+
+            cv2.rectangle(depthFrameColor, (xmin, ymin), (xmax, ymax), color, 1)
+    timer.mark("roi_drawing")
+
+    # If the frame is available, draw bounding boxes on it and show the frame
+    if showFrame:
+        overlay.draw(frame, frameData.detections, frameData.fps)
+    timer.mark("draw_boxes")
+
+    if cvSource is False:
+        # Display stream to desktop window
+        if showDepth:
+            cv2.imshow("depth", depthFrameColor)
+        cv2.imshow("rgb", frame)
+    else:               
+        # Display stream to browser
+        if showFrame:
+            cvSource.putFrame(frame)
+        if showDepth and depthSource is not None:
+            depthSource.putFrame(depthFrameColor)
+    timer.mark("put_frame")
+    return cvSource is False or showFrame or (showDepth and depthSource is not None)
+
+def window_closed(cvSource):
+    """Only a desktop window can be closed with the keyboard."""
+    return cvSource is False and cv2.waitKey(1) == ord('q')
+
 def loop_and_detect(previewQueue, detectionNNQueue, depthQueue, 
-                    xoutBoundingBoxDepthMappingQueue, labelMap, networkTables, cvSource):
+                    xoutBoundingBoxDepthMappingQueue, labelMap, networkTables, cvSource,
+                    depthSource=None, overlayDetail="full", tracker=None, monitor=None, latency=None,
+                    stats=None, timer=None, hostDecoder=None):
     """Continuously capture images from camera and do object detection.
 
     # Arguments
@@ -87,220 +336,454 @@ def loop_and_detect(previewQueue, detectionNNQueue, depthQueue,
       xoutBoundingBoxDepthMappingQueue: Bounding boxes for objects 
       labelMap: Map of labelled classes
       nt: the WPI Network Tables.
-      cvSource: The source going out to the mjpeg server
+      cvSource: The source going out to the mjpeg server, False for desktop
+        windows or None to run headless
+      depthSource: Optional source for a depth mjpeg server.  The depth frame
+        is only colored while a desktop window or a depth client needs it.
+      overlayDetail: What to draw for each detection: box, label or full
+      tracker: Optional tracking_helpers Tracker.  Its tracks are published
+        to Network Tables with the detections.
+      monitor: Optional CameraMonitor that counts the frames and their latency
+      latency: Optional LatencyTracker that measures the latency of each
+        frame from capture to publish, and reports it to the log and Network Tables
+      stats: Optional RuntimeStats published to Network Tables
+      timer: Optional StageTimer that records the time spent in each stage
+      hostDecoder: Optional HostDecoder for the raw outputs of a pipeline
+        created with hostDecode
     """
-    startTime = time.monotonic()
-    counter = 0
-    fps = 0
-    color = (255, 255, 255)
+    if timer is None:
+        timer = NullTimer()
+    fpsCounter = FpsCounter()
+    depthColorizer = DepthColorizer()
+    overlay = OverlayRenderer(labelMap, overlayDetail)
+    synchronizer = create_synchronizer(previewQueue, detectionNNQueue, depthQueue, 
+                                       xoutBoundingBoxDepthMappingQueue)
 
     # Run detection loop
-    while True:
-        inPreview = previewQueue.get()
-        inDet = detectionNNQueue.get()
-        depth = depthQueue.get()
-
-        frame = inPreview.getCvFrame()
-        depthFrame = depth.getFrame() # depthFrame values are in millimeters
-
-        depthFrameColor = cv2.normalize(depthFrame, None, 255, 0, cv2.NORM_INF, cv2.CV_8UC1)
-        depthFrameColor = cv2.equalizeHist(depthFrameColor)
-        depthFrameColor = cv2.applyColorMap(depthFrameColor, cv2.COLORMAP_HOT)
-
-        counter+=1
-        current_time = time.monotonic()
-        if (current_time - startTime) > 1 :
-            fps = counter / (current_time - startTime)
-            counter = 0
-            startTime = current_time
-
-        detections = inDet.detections
-
-        if len(detections) != 0:
-            boundingBoxMapping = xoutBoundingBoxDepthMappingQueue.get()
-            roiDatas = boundingBoxMapping.getConfigData()
-
-            for roiData in roiDatas:
-                roi = roiData.roi
-                roi = roi.denormalize(depthFrameColor.shape[1], depthFrameColor.shape[0])
-                topLeft = roi.topLeft()
-                bottomRight = roi.bottomRight()
-                xmin = int(topLeft.x)
-                ymin = int(topLeft.y)
-                xmax = int(bottomRight.x)
-                ymax = int(bottomRight.y)
-
-                cv2.rectangle(depthFrameColor, (xmin, ymin), (xmax, ymax), color, cv2.FONT_HERSHEY_SCRIPT_SIMPLEX)
-
-
-        # If the frame is available, draw bounding boxes on it and show the frame
-        height = frame.shape[0]
-        width  = frame.shape[1]
-        for detection in detections:
-            try:
-                label = labelMap[detection.label]
-            except:
-                label = detection.label
-
-            frame = draw_boxes(detection, frame, label, color)
-
-            # Put data to Network Tables
-            if networkTables:
-                networkTables.put_spacial_data(detection, label, fps)
-
-        cv2.putText(frame, "NN fps: {:.2f}".format(fps), (2, frame.shape[0] - 4), cv2.FONT_HERSHEY_TRIPLEX, 0.4, color)
-        
-        if cvSource is False:
-            # Display stream to desktop window
-            cv2.imshow("depth", depthFrameColor)
-            cv2.imshow("rgb", frame)
-        else:               
-            # Display stream to browser
-            cvSource.putFrame(frame)   
-
-        if cv2.waitKey(1) == ord('q'):
-            break
-
-# -------------------------------------------------------------------------
-# Main Program Start
-# -------------------------------------------------------------------------
-def main(args, config_parser):
-    
-    # Get the model blob file
-    if not os.path.isfile('%s.blob' % args.model):
-        raise SystemExit('ERROR: file (%s.blob) not found!' % args.model)
-
-    blob_file = f"{args.model}.blob"
-    config_file = f"{args.model}-config.json"
-    nnPath = str((Path(__file__).parent / Path(blob_file)).resolve().absolute())
-    configPath = str((Path(__file__).parent / Path(config_file)).resolve().absolute())
-    print(f"Running model at path {nnPath}")
-
-    if not Path(nnPath).exists():
-        print(f"No model found at path {nnPath}")
-
-    ## Read the model configuration file
-    print("Loading network settings")
-    model_config = ModelConfigParser(configPath)
-    print(model_config.labelMap)
-    print("Classes:", model_config.classes)
-    print("Confidence Threshold:", model_config.confidence_threshold)
-
-    print("Connecting to Network Tables")
-    hardware_type = "OAK-D Camera"
-    if args.no_network_tables == False:
-        print("Using Network Tables")
-        networkTables = WPINetworkTables(config_parser.team, hardware_type, model_config.labelMap)
+    try:
+        while True:
+            timer.start()
+            frameData = read_frame(synchronizer, fpsCounter, hostDecoder)
+            monitor_frame(frameData, monitor)
+            if stats is not None:
+                stats.nn_frame(len(frameData.detections))
+            timer.mark("dequeue")
+
+            track_frame(frameData, tracker)
+            timer.mark("tracking")
+
+            publish_frame(frameData, networkTables)
+            measure_latency(frameData, latency, networkTables)
+            timer.mark("nt_publish")
+
+            rendered = render_frame(frameData, overlay, cvSource, depthSource, depthColorizer, timer)
+            if stats is not None:
+                if rendered:
+                    stats.host_frame()
+                if networkTables:
+                    stats.published()
+                report_stats(stats, networkTables, synchronizer)
+            timer.end()
+
+            if window_closed(cvSource):
+                break
+    finally:
+        print(synchronizer.report())
+
+def loop_and_detect_threaded(previewQueue, detectionNNQueue, depthQueue, 
+                             xoutBoundingBoxDepthMappingQueue, labelMap, networkTables, cvSource,
+                             depthSource=None, overlayDetail="full", tracker=None, monitor=None,
+                             latency=None, stats=None, hostDecoder=None):
+    """Run object detection with the capture, publishing and rendering on separate threads.
+
+    The capture thread reads each frame's messages from the device and hands
+    them to the publishing and rendering stages through LatestMailboxes.  A
+    slow stage only skips frames, so Network Tables is updated at the rate of
+    the neural network however long the rendering takes.  Rendering runs on
+    the calling thread because the desktop window has to.  Headless, with
+    nothing to render, the calling thread only waits for the threads to stop.
+
+    Takes the same arguments as loop_and_detect.
+    """
+    fpsCounter = FpsCounter()
+    depthColorizer = DepthColorizer()
+    overlay = OverlayRenderer(labelMap, overlayDetail)
+    synchronizer = create_synchronizer(previewQueue, detectionNNQueue, depthQueue, 
+                                       xoutBoundingBoxDepthMappingQueue)
+    publishMailbox = LatestMailbox()
+    # render_frame draws nothing without a cvSource
+    renderMailbox = LatestMailbox() if cvSource is not None else None
+    mailboxes = tuple(mailbox for mailbox in (publishMailbox, renderMailbox) if mailbox is not None)
+    stop = threading.Event()
+
+    def capture():
+        frameData = read_frame(synchronizer, fpsCounter, hostDecoder)
+        monitor_frame(frameData, monitor)
+        if stats is not None:
+            stats.nn_frame(len(frameData.detections))
+        # Tracking runs here so it sees every frame, even when publishing falls behind
+        track_frame(frameData, tracker)
+        for mailbox in mailboxes:
+            mailbox.put(frameData)
+
+    def publish():
+        frameData = publishMailbox.get(timeout=0.1)
+        if frameData is not None:
+            publish_frame(frameData, networkTables)
+            measure_latency(frameData, latency, networkTables)
+            if stats is not None and networkTables:
+                stats.published()
+        report_stats(stats, networkTables, synchronizer, mailboxes)
+
+    threads = [StageThread("capture", capture, stop),
+               StageThread("publish", publish, stop)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while renderMailbox is None and not stop.is_set():
+            stop.wait(0.1)
+        while not stop.is_set():
+            frameData = renderMailbox.get(timeout=0.1)
+            if frameData is None:
+                continue
+            rendered = render_frame(frameData, overlay, cvSource, depthSource, depthColorizer, NullTimer())
+            if stats is not None and rendered:
+                stats.host_frame()
+
+            if window_closed(cvSource):
+                break
+    finally:
+        stop.set()
+        for mailbox in mailboxes:
+            mailbox.close()
+        for thread in threads:
+            thread.join(timeout=1)
+
+    print(synchronizer.report())
+    if renderMailbox is None:
+        print("Frames skipped by publishing:", publishMailbox.dropped)
     else:
-        print("No Network Tables requested")
-        networkTables = False    
-
+        print("Frames skipped by publishing:", publishMailbox.dropped,
+              "rendering:", renderMailbox.dropped)
+    for thread in threads:
+        if thread.error is not None:
+            raise thread.error
+
+def create_pipeline(nnPath, model_config, streams=SPATIAL_STREAMS, profile=None, hostDecode=False):
+    """Create the spatial detection pipeline for the OAK-D camera.
+
+    Only the streams named in streams are sent to the host.  The cameras,
+    stereo and network are set up from the PipelineProfile, by default the
+    model config's.  With hostDecode the model runs in a plain NeuralNetwork
+    node, which sends its raw output layers as the detections stream for a
+    HostDecoder, and the depth is sent straight from the stereo node.
+    """
     syncNN = True
+    if profile is None:
+        profile = load_profile(model_config)
 
-    # Configure and load the camera pipeline
-    print("Loading camera and model")
     pipeline = dai.Pipeline()
 
     # Define sources and outputs
     camRgb = pipeline.create(dai.node.ColorCamera)
-    spatialDetectionNetwork = pipeline.create(dai.node.YoloSpatialDetectionNetwork)
+    if hostDecode:
+        spatialDetectionNetwork = pipeline.create(dai.node.NeuralNetwork)
+    else:
+        spatialDetectionNetwork = pipeline.create(dai.node.YoloSpatialDetectionNetwork)
     monoLeft = pipeline.create(dai.node.MonoCamera)
     monoRight = pipeline.create(dai.node.MonoCamera)
     stereo = pipeline.create(dai.node.StereoDepth)
 
-    xoutRgb = pipeline.create(dai.node.XLinkOut)
-    xoutNN = pipeline.create(dai.node.XLinkOut)
-    xoutBoundingBoxDepthMapping = pipeline.create(dai.node.XLinkOut)
-    xoutDepth = pipeline.create(dai.node.XLinkOut)
-
-    xoutRgb.setStreamName("rgb")
-    xoutNN.setStreamName("detections")
-    xoutBoundingBoxDepthMapping.setStreamName("boundingBoxDepthMapping")
-    xoutDepth.setStreamName("depth")
+    xout = {}
+    for name in streams:
+        xout[name] = pipeline.create(dai.node.XLinkOut)
+        xout[name].setStreamName(name)
 
     # Properties
-    frame_width = 416
-    frame_height = 416
-    camRgb.setPreviewSize(frame_width, frame_height)
-    camRgb.setResolution(dai.ColorCameraProperties.SensorResolution.THE_1080_P)
+    profile.configure_color_camera(camRgb, model_config.inputSize)
     camRgb.setInterleaved(False)
     camRgb.setColorOrder(dai.ColorCameraProperties.ColorOrder.BGR)
 
-    monoLeft.setResolution(dai.MonoCameraProperties.SensorResolution.THE_400_P)
     monoLeft.setBoardSocket(dai.CameraBoardSocket.LEFT)
-    monoRight.setResolution(dai.MonoCameraProperties.SensorResolution.THE_400_P)
     monoRight.setBoardSocket(dai.CameraBoardSocket.RIGHT)
 
     # setting node configs
-    stereo.setDefaultProfilePreset(dai.node.StereoDepth.PresetMode.HIGH_DENSITY)
+    profile.configure_stereo(monoLeft, monoRight, stereo)
     stereo.setDepthAlign(dai.CameraBoardSocket.RGB)
 
     spatialDetectionNetwork.setBlobPath(nnPath)
-    spatialDetectionNetwork.setConfidenceThreshold(model_config.confidence_threshold)
-    spatialDetectionNetwork.input.setBlocking(False)
-    spatialDetectionNetwork.setBoundingBoxScaleFactor(0.5)
-    spatialDetectionNetwork.setDepthLowerThreshold(100)
-    spatialDetectionNetwork.setDepthUpperThreshold(5000)
-
-    # Yolo specific parameters
-    spatialDetectionNetwork.setNumClasses(model_config.classes)
-    spatialDetectionNetwork.setCoordinateSize(4)
-    spatialDetectionNetwork.setAnchors(np.array([10,14, 23,27, 37,58, 81,82, 135,169, 344,319]))
-    spatialDetectionNetwork.setAnchorMasks({ "side26": np.array([1,2,3]), "side13": np.array([3,4,5]) })
-    spatialDetectionNetwork.setIouThreshold(0.5)
+    profile.configure_network(spatialDetectionNetwork)
+    if not hostDecode:
+        spatialDetectionNetwork.setConfidenceThreshold(model_config.confidence_threshold)
+        spatialDetectionNetwork.setBoundingBoxScaleFactor(BOUNDING_BOX_SCALE_FACTOR)
+        spatialDetectionNetwork.setDepthLowerThreshold(DEPTH_LOWER_THRESHOLD)
+        spatialDetectionNetwork.setDepthUpperThreshold(DEPTH_UPPER_THRESHOLD)
+
+        # Yolo specific parameters
+        spatialDetectionNetwork.setNumClasses(model_config.classes)
+        spatialDetectionNetwork.setCoordinateSize(4)
+        spatialDetectionNetwork.setAnchors(model_config.anchors)
+        spatialDetectionNetwork.setAnchorMasks(model_config.anchor_masks)
+        spatialDetectionNetwork.setIouThreshold(model_config.iou_threshold or 0.5)
 
     # Linking
     monoLeft.out.link(stereo.left)
     monoRight.out.link(stereo.right)
 
     camRgb.preview.link(spatialDetectionNetwork.input)
-    if syncNN:
-        spatialDetectionNetwork.passthrough.link(xoutRgb.input)
-    else:
-        camRgb.preview.link(xoutRgb.input)
+    if "rgb" in xout:
+        if syncNN:
+            spatialDetectionNetwork.passthrough.link(xout["rgb"].input)
+        else:
+            camRgb.preview.link(xout["rgb"].input)
+
+    spatialDetectionNetwork.out.link(xout["detections"].input)
+    if hostDecode:
+        # The host matches the depth to the frames by time
+        if "depth" in xout:
+            stereo.depth.link(xout["depth"].input)
+        return pipeline
 
-    spatialDetectionNetwork.out.link(xoutNN.input)
-    spatialDetectionNetwork.boundingBoxMapping.link(xoutBoundingBoxDepthMapping.input)
+    if "boundingBoxDepthMapping" in xout:
+        spatialDetectionNetwork.boundingBoxMapping.link(xout["boundingBoxDepthMapping"].input)
 
     stereo.depth.link(spatialDetectionNetwork.inputDepth)
-    spatialDetectionNetwork.passthroughDepth.link(xoutDepth.input)
+    if "depth" in xout:
+        spatialDetectionNetwork.passthroughDepth.link(xout["depth"].input)
 
-    # Connect to device and start pipeline
-    print("Connecting to device and starting pipeline")
-    with dai.Device(pipeline) as device:
+    return pipeline
 
-        # Output queues will be used to get the rgb frames and nn data from the outputs defined above
-        previewQueue = device.getOutputQueue(name="rgb", maxSize=4, blocking=False)
-        detectionNNQueue = device.getOutputQueue(name="detections", maxSize=4, blocking=False)
-        xoutBoundingBoxDepthMappingQueue = device.getOutputQueue(name="boundingBoxDepthMapping", maxSize=4, blocking=False)
-        depthQueue = device.getOutputQueue(name="depth", maxSize=4, blocking=False)
+# -------------------------------------------------------------------------
+# Main Program Start
+# -------------------------------------------------------------------------
+def open_output_queues(device, streams=SPATIAL_STREAMS, profile=None):
+    """Output queues will be used to get the rgb frames and nn data from the outputs defined above.
 
-        # Run the inference loop
-        if args.gui is True:
-            print("Gui requested")
-            try:
-                loop_and_detect(previewQueue, detectionNNQueue, 
-                                depthQueue, xoutBoundingBoxDepthMappingQueue, 
-                                model_config.labelMap, networkTables, cvSource=False)
-            except Exception as e:
-                print(e)
-            finally:
-                print("Finished") 
-        else:
-            # Start the mjpeg server (default)
-            import cscore as cs
-            cvSource = cs.CvSource("cvsource", cs.VideoMode.PixelFormat.kMJPEG, 320, 240, 30)
-            mjpeg_server = cs.MjpegServer("httpserver", args.mjpeg_port)
-            mjpeg_server.setSource(cvSource)
-            print('MJPEG server started on port', args.mjpeg_port)
+    The queues of streams that aren't in streams are None.  Their size and
+    blocking come from the PipelineProfile, by default 4 and non-blocking.
+    """
+    if profile is None:
+        profile = load_profile()
+    queues = {name: profile.output_queue(device, name) for name in streams}
+    return (queues.get("rgb"), queues["detections"], queues.get("depth"),
+            queues.get("boundingBoxDepthMapping"))
+
+def report_bandwidth(streams, profile, model_config):
+    """Print the profile, the streams the pipeline sends and roughly how much of the link they use."""
+    print("Pipeline profile {}: {}".format(profile.name, profile.settings()))
+    print("XLink streams:", ", ".join(streams))
+    print(format_bandwidth(bandwidth(streams, profile.fps, profile.preview(model_config.inputSize),
+                                     profile.depth_size())))
+
+def run_detection(device, args, model_config, networkTables, mjpegPort, depthPort=None, monitor=None,
+                  streams=SPATIAL_STREAMS, profile=None):
+    """Run the inference loop on an open device, or a replay, until it stops.
+
+    Only the queues of streams are read.  They have to be what the mode,
+    from streams_for_args, reads.  The queues are opened as the
+    PipelineProfile sets.
+    """
+    queues = open_output_queues(device, streams, profile)
+    hostDecoder = None
+    if args.host_decode:
+        hostDecoder = HostDecoder(decoder_from_config(model_config),
+                                  create_spatial_calculator(device, model_config, profile))
+    tracker = Tracker() if args.track else None
+    latency = LatencyTracker(reportInterval=args.report_interval,
+                             name=None if monitor is None else monitor.name)
+    stats = RuntimeStats()
+
+    # Run the inference loop
+    detect = loop_and_detect if args.serial else loop_and_detect_threaded
+    if args.gui is True:
+        print("Gui requested")
+        try:
+            detect(*queues, model_config.labelMap, networkTables, cvSource=False,
+                   overlayDetail=args.overlay, tracker=tracker, monitor=monitor, latency=latency,
+                   stats=stats, hostDecoder=hostDecoder)
+        except Exception as e:
+            print(e)
+        finally:
+            print("Finished") 
+    elif args.headless:
+        print("Headless, only publishing to Network Tables")
+        try:
+            detect(*queues, model_config.labelMap, networkTables, cvSource=None,
+                   tracker=tracker, monitor=monitor, latency=latency, stats=stats,
+                   hostDecoder=hostDecoder)
+        except Exception as e:
+            print(e)
+        finally:
+            print("Finished")
+    else:
+        # Start the mjpeg server (default)
+        streamSettings = (args.stream_width, args.stream_height, args.stream_fps, args.stream_kbps)
+        cvSource = start_mjpeg_source("cvsource%d" % mjpegPort, mjpegPort, *streamSettings)
+        print('MJPEG server started on port', mjpegPort)
+        depthSource = None
+        if depthPort is not None:
+            depthSource = start_mjpeg_source("depthsource%d" % depthPort, depthPort, *streamSettings)
+            print('Depth MJPEG server started on port', depthPort)
+        try:
+            detect(*queues, model_config.labelMap, networkTables, cvSource=cvSource,
+                   depthSource=depthSource, overlayDetail=args.overlay, tracker=tracker,
+                   monitor=monitor, latency=latency, stats=stats, hostDecoder=hostDecoder)
+        except Exception as e:
+            print(e)
+        finally:
+            print("Finished")         
+
+def select_devices(selection, oak_cameras, timeout=None):
+    """
+    Wait for the devices picked by --devices and return (name, DeviceInfo) pairs.
+
+    # Arguments
+        selection: "all", or comma separated MxIds or camera names from frc.json.
+        oak_cameras: dictionary of camera name to MxId from frc.json.
+        timeout: seconds to wait for the devices.  None waits forever.
+    """
+    names = {mxid: name for name, mxid in oak_cameras.items()}
+    if selection == "all":
+        devices = wait_for_devices(timeout=timeout)
+    else:
+        mxids = [oak_cameras.get(item, item) for item in selection.split(",")]
+        devices = wait_for_devices(mxids, timeout)
+    return [(names.get(info.getMxId(), info.getMxId()), info) for info in devices]
+
+def run_cameras(args, config_parser, nnPath, model_config, hardware_type, profile):
+    """
+    Run a pipeline on each of several OAK devices, each on its own worker thread.
+
+    Camera i publishes to the Network Tables subtable ML/<name>, through one
+    client shared by all of them, and streams on the MJPEG port mjpeg_port + i.  The frame rate and latency of each
+    camera is printed every report_interval seconds.
+    """
+    streams = streams_for_args(args)
+    report_bandwidth(streams, profile, model_config)
+    cameras = select_devices(args.devices, config_parser.oak_cameras, args.device_timeout)
+    print("Cameras:", ", ".join("{} ({})".format(name, info.getMxId()) for name, info in cameras))
+    monitors = [CameraMonitor(name) for name, _ in cameras]
+    errors = {}
+    ntinst = None
+    if args.no_network_tables == False:
+        ntinst = start_network_tables(config_parser.team)
+        watch_network_tables(ntinst)
+
+    def worker(index, name, info, monitor):
+        try:
+            run_camera(index, name, info, monitor)
+        except Exception as e:
+            errors[name] = e
+
+    def run_camera(index, name, info, monitor):
+        networkTables = False
+        if args.no_network_tables == False:
+            networkTables = WPINetworkTables(config_parser.team, hardware_type, model_config.labelMap,
+                                             table_name="ML/" + name, ntinst=ntinst)
+        depthPort = None if args.depth_port is None else args.depth_port + index
+        pipeline = create_pipeline(nnPath, model_config, streams, profile, args.host_decode)
+        with dai.Device(pipeline, info) as device:
+            timeline.mark("Pipeline started on " + name)
+            if args.record is not None:
+                device = Recorder(os.path.join(args.record, name), device)
             try:
-                loop_and_detect(previewQueue, detectionNNQueue, 
-                                depthQueue, xoutBoundingBoxDepthMappingQueue, 
-                                model_config.labelMap, networkTables, cvSource=cvSource)
-            except Exception as e:
-                print(e)
+                run_detection(device, args, model_config, networkTables,
+                              args.mjpeg_port + index, depthPort, monitor, streams, profile)
             finally:
-                print("Finished")         
+                if args.record is not None:
+                    device.close()
+
+    threads = [threading.Thread(target=worker, args=(i, name, info, monitor), name=name, daemon=True)
+               for i, ((name, info), monitor) in enumerate(zip(cameras, monitors))]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(args.report_interval)
+            reports = [monitor.report() for monitor in monitors]
+            for r in reports:
+                latency = r.get("latency_ms")
+                print("{}: {:.1f} fps, latency {}".format(
+                    r["name"], r["fps"],
+                    "mean {:.1f} ms p95 {:.1f} ms".format(latency["mean"], latency["p95"]) if latency else "-"))
+            print("Total: {:.1f} fps from {} cameras".format(sum(r["fps"] for r in reports), len(reports)))
+    except KeyboardInterrupt:
+        pass
+    for name, error in errors.items():
+        print("Camera {} stopped: {}".format(name, error))
+
+def main(args, config_parser):
+    timeline.mark("Modules loaded")
+
+    # Get the model blob file.  A replay doesn't need it.
+    if args.replay is None and not os.path.isfile('%s.blob' % args.model):
+        raise SystemExit('ERROR: file (%s.blob) not found!' % args.model)
+
+    blob_file = f"{args.model}.blob"
+    config_file = f"{args.model}-config.json"
+    nnPath = str((Path(__file__).parent / Path(blob_file)).resolve().absolute())
+    configPath = str((Path(__file__).parent / Path(config_file)).resolve().absolute())
+    print(f"Running model at path {nnPath}")
+
+    if not Path(nnPath).exists():
+        print(f"No model found at path {nnPath}")
+
+    ## Read the model configuration file
+    print("Loading network settings")
+    model_config = ModelConfigParser(configPath)
+    print(model_config.labelMap)
+    print("Classes:", model_config.classes)
+    print("Confidence Threshold:", model_config.confidence_threshold)
+    try:
+        profile = load_profile(model_config, args.profile)
+    except ValueError as e:
+        raise SystemExit('ERROR: {}'.format(e))
+    if args.host_decode and not model_config.anchors:
+        raise SystemExit('ERROR: --host_decode needs the anchors and anchor_masks in the model config')
+
+    hardware_type = "OAK-D Camera"
+    if args.devices is not None:
+        if args.gui or args.replay is not None:
+            raise SystemExit('ERROR: --devices can\'t be used with --gui or --replay')
+        run_cameras(args, config_parser, nnPath, model_config, hardware_type, profile)
+        return
+
+    print("Connecting to Network Tables")
+    if args.no_network_tables == False:
+        print("Using Network Tables")
+        networkTables = WPINetworkTables(config_parser.team, hardware_type, model_config.labelMap)
+        watch_network_tables(networkTables.ntinst)
+    else:
+        print("No Network Tables requested")
+        networkTables = False    
+
+    streams = streams_for_args(args)
+    if args.replay is not None:
+        print("Replaying recording", args.replay)
+        device = Replay(args.replay, loop=args.loop, realtime=args.realtime)
+    else:
+        # Configure and load the camera pipeline
+        print("Loading camera and model")
+        report_bandwidth(streams, profile, model_config)
+        pipeline = create_pipeline(nnPath, model_config, streams, profile, args.host_decode)
+
+        # Connect to device and start pipeline
+        print("Connecting to device and starting pipeline")
+        device = dai.Device(pipeline, wait_for_device(timeout=args.device_timeout))
+        timeline.mark("Pipeline started")
+
+    with device:
+        if args.record is not None:
+            print("Recording to", args.record)
+            device = Recorder(args.record, device)
+
+        run_detection(device, args, model_config, networkTables, args.mjpeg_port, args.depth_port,
+                      streams=streams, profile=profile)
+
+        if args.record is not None:
+            device.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,165 @@
+"""
+- This module draws detections on the frames sent to the display.
+- Text is rendered once into cached anti-aliased sprites: one per label,
+and one per digit or symbol for the numbers that change every frame.  A
+character without a sprite, like the letters of a NaN, gets one rendered
+the first time it is drawn.
+- The sprites for a frame are pasted into a single alpha mask, and the
+text color is blended onto the frame through it once per block of text.
+- The detail level bounds the drawing cost:
+    box    only the bounding box
+    label  the box and the class label
+    full   the box, label, confidence and X, Y, Z coordinates
+"""
+
+import cv2
+import numpy as np
+
+DETAIL_LEVELS = ("box", "label", "full")
+
+# Characters drawn from single glyph sprites
+GLYPHS = "0123456789-.: "
+
+# Bound the number of cached lines of text
+MAX_CACHED_LINES = 4096
+
+
+class OverlayRenderer:
+    """
+        Draws detections with cached text sprites.
+
+    # Arguments
+        labelMap: a dictionary used to translate class id to its name.
+        detail: one of DETAIL_LEVELS.
+        boxColor: BGR color of the bounding boxes.
+        textColor: BGR color of the text.
+        fontScale: scale of the OpenCV Hershey triplex font.
+    """
+    def __init__(self, labelMap, detail="full", boxColor=(255, 255, 255),
+                 textColor=(255, 0, 0), fontScale=0.5):
+        if detail not in DETAIL_LEVELS:
+            raise ValueError("detail must be one of {}".format(DETAIL_LEVELS))
+        self.labelMap = labelMap
+        self.detail = detail
+        self.boxColor = boxColor
+        self.textColor = np.array(textColor, dtype=np.uint8)
+        self.font = cv2.FONT_HERSHEY_TRIPLEX
+        self.fontScale = fontScale
+
+        (_, ascent), baseline = cv2.getTextSize("0", self.font, fontScale, 1)
+        self.ascent = ascent + 1
+        self.lineHeight = self.ascent + baseline + 2
+
+        self.sprites = {}
+        self.lines = {}
+        self.glyphs = {c: self._render(c) for c in GLYPHS}
+        self.mask = None
+        self.colorImage = None
+
+    def _render(self, text):
+        """Render text into a mask the height of a line."""
+        (width, _), _ = cv2.getTextSize(text, self.font, self.fontScale, 1)
+        sprite = np.zeros((self.lineHeight, width + 1), dtype=np.uint8)
+        cv2.putText(sprite, text, (0, self.ascent), self.font, self.fontScale, 255, 1, cv2.LINE_AA)
+        return sprite
+
+    def glyph(self, c):
+        """Return the sprite of a character, rendering it the first time."""
+        sprite = self.glyphs.get(c)
+        if sprite is None:
+            sprite = self.glyphs[c] = self._render(c)
+        return sprite
+
+    def text(self, text):
+        """Return the cached sprite for a label or other fixed text."""
+        sprite = self.sprites.get(text)
+        if sprite is None:
+            sprite = self.sprites[text] = self._render(text)
+        return sprite
+
+    def number_line(self, prefix, value, suffix=""):
+        """Return a sprite for prefix + value + suffix built from the glyph sprites."""
+        key = (prefix, value, suffix)
+        sprite = self.lines.get(key)
+        if sprite is None:
+            if len(self.lines) >= MAX_CACHED_LINES:
+                self.lines.clear()
+            parts = [self.glyph(c) for c in value]
+            if prefix:
+                parts.insert(0, self.text(prefix))
+            if suffix:
+                parts.append(self.text(suffix))
+            sprite = self.lines[key] = cv2.hconcat(parts)
+        return sprite
+
+    def get_label(self, class_id):
+        try:
+            return self.labelMap[class_id]
+        except (IndexError, KeyError, TypeError):
+            return str(class_id)
+
+    def detection_lines(self, detection):
+        lines = [self.text(str(self.get_label(detection.label)))]
+        if self.detail == "full":
+            coords = detection.spatialCoordinates
+            lines.append(self.number_line("", "{:.2f}".format(detection.confidence * 100)))
+            lines.append(self.number_line("X: ", "{:.0f}".format(coords.x), " mm"))
+            lines.append(self.number_line("Y: ", "{:.0f}".format(coords.y), " mm"))
+            lines.append(self.number_line("Z: ", "{:.0f}".format(coords.z), " mm"))
+        return lines
+
+    def draw(self, frame, detections, fps=None):
+        """Draw the detections, and the NN fps if given, on the frame in place."""
+        height, width = frame.shape[:2]
+        if self.mask is None or self.mask.shape != (height, width):
+            self.mask = np.zeros((height, width), dtype=np.uint8)
+            self.colorImage = np.empty((height, width, 3), dtype=np.uint8)
+            self.colorImage[:] = self.textColor
+
+        placed = []
+        for detection in detections:
+            x1 = int(detection.xmin * width)
+            x2 = int(detection.xmax * width)
+            y1 = int(detection.ymin * height)
+            y2 = int(detection.ymax * height)
+            cv2.rectangle(frame, (x1, y1), (x2, y2), self.boxColor, 1)
+
+            if self.detail != "box":
+                placed.append((self.detection_lines(detection), x1 + 10, y1 + 8))
+
+        if fps is not None:
+            fpsLine = self.number_line("NN fps: ", "{:.2f}".format(fps))
+            placed.append(([fpsLine], 2, height - self.lineHeight))
+
+        self._composite(frame, placed)
+        return frame
+
+    def _composite(self, frame, placed):
+        """Paste the sprites into the mask and blend the text color onto the frame through it."""
+        height, width = frame.shape[:2]
+        blocks = []
+        for lines, x, y in placed:
+            top, left = max(y, 0), max(x, 0)
+            bottom = min(y + len(lines) * self.lineHeight, height)
+            right = min(x + max(sprite.shape[1] for sprite in lines), width)
+            if bottom <= top or right <= left:
+                continue
+            for sprite in lines:
+                y0, y1 = max(y, 0), min(y + self.lineHeight, height)
+                x1 = min(x + sprite.shape[1], width)
+                if y1 > y0 and x1 > left:
+                    region = self.mask[y0:y1, left:x1]
+                    cv2.max(region, sprite[y0 - y:y1 - y, left - x:x1 - x], dst=region)
+                y += self.lineHeight
+            blocks.append((top, left, bottom, right))
+
+        # Every sprite is in the mask before the first block is blended, so
+        # clearing a block's part of the mask once it is blended leaves no
+        # glyph out and blends no pixel of overlapping blocks twice
+        for top, left, bottom, right in blocks:
+            mask = self.mask[top:bottom, left:right]
+            region = frame[top:bottom, left:right]
+            alpha = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
+            cv2.add(cv2.multiply(self.colorImage[top:bottom, left:right], alpha, scale=1 / 255),
+                    cv2.multiply(region, cv2.bitwise_not(alpha), scale=1 / 255), dst=region)
+            mask[:] = 0
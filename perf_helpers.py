@@ -0,0 +1,270 @@
+"""
+- This module measures how long each stage of the host loop takes.
+- Call start() at the top of an iteration, mark() after each stage
+and end() once the frame is finished.
+- NullTimer has the same methods and does nothing.  The loops use it
+when no timer is passed in.
+- FpsCounter measures a frame rate over one second windows.
+- CameraMonitor keeps the frame rate and latency of one camera for the
+reports of a multi camera run.
+- RuntimeStats counts the frames, detections and publishes of the host
+loop, and reads the CPU and memory use of the process, for the statistics
+published to Network Tables.
+- LatencyTracker keeps the age of the last frames' data when it is
+published, from capture on the device to the host, through the host
+processing and the publish, and reports their p50, p95 and p99.
+"""
+
+import os
+import threading
+import time
+import numpy as np
+
+
+class FpsCounter:
+    def __init__(self):
+        self.startTime = time.monotonic()
+        self.counter = 0
+        self.fps = 0
+
+    def tick(self):
+        """Count a frame and return the latest frame rate."""
+        self.counter += 1
+        current_time = time.monotonic()
+        if (current_time - self.startTime) > 1:
+            self.fps = self.counter / (current_time - self.startTime)
+            self.counter = 0
+            self.startTime = current_time
+        return self.fps
+
+
+class CameraMonitor:
+    """
+        Counts the frames of one camera and their latency between reports.
+
+    # Arguments
+        name: the camera name shown in the report.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.windowStart = time.monotonic()
+        self.frames = 0
+        self.latencies = []
+        self.totalFrames = 0
+
+    def frame(self, latency):
+        """Count a frame.  latency is the seconds from capture to the host."""
+        with self.lock:
+            self.frames += 1
+            self.latencies.append(latency)
+
+    def report(self):
+        """Return the fps and latency since the last report and start a new window."""
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.windowStart
+            fps = self.frames / elapsed if elapsed > 0 else 0.0
+            latencies = np.array(self.latencies) * 1000
+            self.totalFrames += self.frames
+            self.windowStart = now
+            self.frames = 0
+            self.latencies = []
+        result = {"name": self.name, "fps": fps, "frames": self.totalFrames}
+        if len(latencies):
+            result["latency_ms"] = {"mean": float(latencies.mean()),
+                                    "p95": float(np.percentile(latencies, 95))}
+        return result
+
+
+def process_memory_mb():
+    """Resident memory of this process in MB, or 0 if it can't be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class RuntimeStats:
+    """
+        Counts what the host loop does between reports.  The counts can come
+        from several threads.
+
+    # Arguments
+        interval: seconds between reports.
+    """
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.windowStart = time.monotonic()
+        self.cpuStart = self._cpu_time()
+        self.nextReport = self.windowStart + interval
+        self.nnFrames = 0
+        self.detections = 0
+        self.hostFrames = 0
+        self.publishes = 0
+        # The counter totals at the start of the window
+        self.counterStart = {}
+
+    def _cpu_time(self):
+        times = os.times()
+        return times.user + times.system
+
+    def nn_frame(self, detections):
+        """Count a frame of neural network output with its number of detections."""
+        with self.lock:
+            self.nnFrames += 1
+            self.detections += detections
+
+    def host_frame(self):
+        """Count a frame the host loop showed or streamed."""
+        with self.lock:
+            self.hostFrames += 1
+
+    def published(self):
+        with self.lock:
+            self.publishes += 1
+
+    def due(self):
+        """True once every interval seconds."""
+        return time.monotonic() >= self.nextReport
+
+    def report(self, **counters):
+        """
+        Return the rates since the last report and start a new window.  The
+        counters are running totals, like drop counts, and the report has
+        how much each grew in the window.
+        """
+        with self.lock:
+            now = time.monotonic()
+            cpu = self._cpu_time()
+            elapsed = max(now - self.windowStart, 1e-9)
+            result = {"nn_fps": self.nnFrames / elapsed,
+                      "host_fps": self.hostFrames / elapsed,
+                      "publish_rate": self.publishes / elapsed,
+                      "detections_per_frame": self.detections / self.nnFrames if self.nnFrames else 0.0,
+                      "cpu_percent": (cpu - self.cpuStart) / elapsed * 100,
+                      "memory_mb": process_memory_mb()}
+            self.windowStart = now
+            self.cpuStart = cpu
+            self.nextReport = now + self.interval
+            self.nnFrames = self.detections = self.hostFrames = self.publishes = 0
+            for name, total in counters.items():
+                result[name] = total - self.counterStart.get(name, 0)
+            self.counterStart = dict(counters)
+        return result
+
+
+# Stages of LatencyTracker: capture on the device to the host, host
+# processing, the publish and capture to published
+LATENCY_STAGES = ("capture", "processing", "publish", "total")
+PERCENTILES = (50, 95, 99)
+
+
+class LatencyTracker:
+    """
+        Keeps the latency of each stage for the last window frames.
+
+    # Arguments
+        window: the number of frames the percentiles are taken over.
+        reportInterval: seconds between reports.
+        name: the camera name shown in the log.
+    """
+    def __init__(self, window=300, reportInterval=5.0, name=None):
+        self.samples = np.zeros((window, len(LATENCY_STAGES)))
+        self.count = 0
+        self.reportInterval = reportInterval
+        self.name = name
+        self.lastReport = time.monotonic()
+
+    def frame(self, captured, received, publishStart, published):
+        """
+        Add a frame.  The times are timedeltas of the dai.Clock, like the
+        message timestamps and dai.Clock.now().
+        """
+        captured = captured.total_seconds()
+        received = received.total_seconds()
+        publishStart = publishStart.total_seconds()
+        published = published.total_seconds()
+        row = self.samples[self.count % len(self.samples)]
+        row[0] = received - captured
+        row[1] = publishStart - received
+        row[2] = published - publishStart
+        row[3] = published - captured
+        self.count += 1
+
+    def due(self):
+        """True once every reportInterval seconds."""
+        now = time.monotonic()
+        if now - self.lastReport < self.reportInterval:
+            return False
+        self.lastReport = now
+        return True
+
+    def summary(self):
+        """The p50, p95 and p99 of each stage in milliseconds."""
+        frames = min(self.count, len(self.samples))
+        if frames == 0:
+            return {}
+        ms = np.percentile(self.samples[:frames] * 1000, PERCENTILES, axis=0)
+        return {stage: {"p%d" % p: float(ms[j, i]) for j, p in enumerate(PERCENTILES)}
+                for i, stage in enumerate(LATENCY_STAGES)}
+
+    def format(self, summary):
+        text = ", ".join("{} {p50:.1f}/{p95:.1f}/{p99:.1f}".format(stage, **summary[stage])
+                         for stage in LATENCY_STAGES)
+        prefix = "" if self.name is None else self.name + " "
+        return prefix + "latency ms p50/p95/p99: " + text
+
+
+class NullTimer:
+    def start(self):
+        pass
+
+    def mark(self, stage):
+        pass
+
+    def end(self):
+        pass
+
+
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+        self.frames = []
+        self.frameStart = None
+        self.last = None
+        self.firstStart = None
+
+    def start(self):
+        self.frameStart = self.last = time.perf_counter()
+        if self.firstStart is None:
+            self.firstStart = self.frameStart
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.setdefault(stage, []).append(now - self.last)
+        self.last = now
+
+    def end(self):
+        now = time.perf_counter()
+        self.frames.append(now - self.frameStart)
+        self.lastEnd = now
+
+    def summary(self):
+        """Return the stage and frame times in milliseconds."""
+        def stats(times):
+            ms = np.array(times) * 1000
+            return {"mean": float(ms.mean()),
+                    "p50": float(np.percentile(ms, 50)),
+                    "p99": float(np.percentile(ms, 99))}
+
+        if not self.frames:
+            return {"frames": 0}
+        elapsed = self.lastEnd - self.firstStart
+        return {"frames": len(self.frames),
+                "fps": len(self.frames) / elapsed if elapsed > 0 else 0.0,
+                "frame_ms": stats(self.frames),
+                "stages_ms": {name: stats(times) for name, times in self.stages.items()}}
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+- This module works out which device outputs the spatial detection script
+reads in the mode it runs in, so the pipeline only sends those over XLink.
+On a Raspberry Pi the OAK is often on USB2, where the rgb and depth frames
+are nearly all of the traffic, and copying them is a good part of the
+host's work.
+- consumed_streams gives the streams a mode reads.  The detections are
+always read.  The rgb frames are read to show or stream them, the depth
+frames and their bounding box mappings only to show the depth.  A recording
+keeps every stream so it can be replayed in any mode.
+- bandwidth estimates the bytes per second of each stream from the frame
+sizes and rate, and format_bandwidth prints them against what a USB2 link
+carries in practice.
+- PipelineProfile holds the settings a pipeline is built with: the camera
+resolutions and frame rate, the stereo preset, the inference threads and
+the queue sizes.  Named profiles are read from the "pipeline" section of the
+model config, next to "nn_config", on top of the built in PROFILES, so a
+pipeline can be retuned without editing the scripts.  The default profile
+builds the pipeline the scripts used before profiles.
+- If runs independent, prints the streams and bandwidth of each mode, or
+with -c, the profiles of a model config.
+"""
+
+import argparse
+import json
+
+SPATIAL_STREAMS = ("rgb", "detections", "depth", "boundingBoxDepthMapping")
+
+# The preview the network reads and the mono resolution the depth has
+PREVIEW_SIZE = (416, 416)
+DEPTH_SIZE = (640, 400)
+
+# Rough sizes of the small messages
+MESSAGE_HEADER_BYTES = 64
+DETECTION_BYTES = 64
+ROI_BYTES = 32
+
+# What a USB2 link carries in practice, out of its 60 MB/s
+USB2_BYTES_PER_SECOND = 35e6
+
+# The settings of a profile and their values in the default profile.  A
+# preview_size of None is the network input size.
+PROFILE_DEFAULTS = {
+    "fps": 30,
+    "sensor_resolution": "1080p",
+    "preview_size": None,
+    "mono_resolution": "400p",
+    "stereo_preset": "high_density",
+    "inference_threads": 2,
+    "nn_input_blocking": False,
+    "queue_size": 4,
+    "queue_blocking": False,
+}
+
+# Built in profiles, as changes to PROFILE_DEFAULTS
+PROFILES = {
+    "default": {},
+    # One frame in flight everywhere, so nothing waits behind an older frame
+    "low-latency": {"inference_threads": 1, "queue_size": 1},
+    # The camera runs faster than the network, which takes the newest frame
+    "max-fps": {"fps": 60, "queue_size": 2},
+    # Finer depth and every frame processed, at a lower rate
+    "max-accuracy": {"fps": 15, "mono_resolution": "800p", "stereo_preset": "high_accuracy",
+                     "nn_input_blocking": True, "queue_size": 8},
+}
+
+SENSOR_RESOLUTIONS = {"1080p": (1920, 1080), "4k": (3840, 2160), "12mp": (4056, 3040)}
+MONO_RESOLUTIONS = {"400p": (640, 400), "720p": (1280, 720), "800p": (1280, 800)}
+STEREO_PRESETS = ("high_density", "high_accuracy")
+
+
+def consumed_streams(gui=False, mjpeg=True, depthStream=False, record=False, hostDecode=False):
+    """
+    The streams of SPATIAL_STREAMS a mode reads.
+
+    # Arguments
+        gui: the rgb and depth frames are shown in desktop windows.
+        mjpeg: the rgb frames are sent to an MJPEG server.
+        depthStream: the depth frames are sent to an MJPEG server.
+        record: every stream is recorded.
+        hostDecode: the detections are decoded on the host, which reads
+            the depth frames to locate them, and the device has no bounding
+            box mappings to send.
+    """
+    streams = {"detections"}
+    if gui or mjpeg or record:
+        streams.add("rgb")
+    if gui or depthStream or record:
+        streams.update(("depth", "boundingBoxDepthMapping"))
+    if hostDecode:
+        streams.add("depth")
+        streams.discard("boundingBoxDepthMapping")
+    return tuple(name for name in SPATIAL_STREAMS if name in streams)
+
+
+def streams_for_args(args):
+    """The streams read with the options of oak_yolo_spacial."""
+    return consumed_streams(gui=args.gui, mjpeg=not args.gui and not args.headless,
+                            depthStream=not args.gui and not args.headless and args.depth_port is not None,
+                            record=args.record is not None, hostDecode=args.host_decode)
+
+
+def message_bytes(stream, previewSize=PREVIEW_SIZE, depthSize=DEPTH_SIZE, detections=10):
+    """The approximate size of one message of a stream."""
+    if stream == "rgb":
+        # Planar BGR
+        return MESSAGE_HEADER_BYTES + previewSize[0] * previewSize[1] * 3
+    if stream == "depth":
+        # 16 bit millimeters
+        return MESSAGE_HEADER_BYTES + depthSize[0] * depthSize[1] * 2
+    if stream == "detections":
+        return MESSAGE_HEADER_BYTES + DETECTION_BYTES * detections
+    if stream == "boundingBoxDepthMapping":
+        return MESSAGE_HEADER_BYTES + ROI_BYTES * detections
+    raise ValueError("unknown stream {}".format(stream))
+
+
+def bandwidth(streams, fps=30, previewSize=PREVIEW_SIZE, depthSize=DEPTH_SIZE, detections=10):
+    """Dictionary of stream name to the bytes per second it sends at fps."""
+    return {name: message_bytes(name, previewSize, depthSize, detections) * fps for name in streams}
+
+
+def format_bandwidth(rates, linkBytes=USB2_BYTES_PER_SECOND):
+    """The rates one stream a line, with the total and the part of the link it uses."""
+    lines = ["{:>24} {:>8.2f} MB/s".format(name, rate / 1e6) for name, rate in rates.items()]
+    total = sum(rates.values())
+    lines.append("{:>24} {:>8.2f} MB/s, {:.0f}% of USB2".format("total", total / 1e6,
+                                                                 100 * total / linkBytes))
+    return "\n".join(lines)
+
+
+def parse_size(size):
+    """A "WxH" string, or a width and height pair, as a (width, height) tuple."""
+    if isinstance(size, str):
+        return tuple(map(int, size.split("x")))
+    return tuple(size)
+
+
+class PipelineProfile:
+    """
+        The settings a pipeline is built with.  The settings are attributes
+        named like the keys of PROFILE_DEFAULTS.
+
+    # Arguments
+        name: the profile name.
+        settings: dictionary of the settings that differ from
+            PROFILE_DEFAULTS.
+    """
+    def __init__(self, name="default", settings=None):
+        settings = dict(settings or {})
+        unknown = sorted(set(settings) - set(PROFILE_DEFAULTS))
+        if unknown:
+            raise ValueError("profile {} has unknown settings {}".format(name, ", ".join(unknown)))
+        self.name = name
+        for key, value in PROFILE_DEFAULTS.items():
+            setattr(self, key, settings.get(key, value))
+        if self.preview_size is not None:
+            self.preview_size = parse_size(self.preview_size)
+        if self.sensor_resolution not in SENSOR_RESOLUTIONS:
+            raise ValueError("sensor_resolution must be one of {}".format(tuple(SENSOR_RESOLUTIONS)))
+        if self.mono_resolution not in MONO_RESOLUTIONS:
+            raise ValueError("mono_resolution must be one of {}".format(tuple(MONO_RESOLUTIONS)))
+        if self.stereo_preset not in STEREO_PRESETS:
+            raise ValueError("stereo_preset must be one of {}".format(STEREO_PRESETS))
+
+    def settings(self):
+        """The settings as a dictionary, as written in a model config."""
+        settings = {key: getattr(self, key) for key in PROFILE_DEFAULTS}
+        if self.preview_size is not None:
+            settings["preview_size"] = "{}x{}".format(*self.preview_size)
+        return settings
+
+    def preview(self, inputSize):
+        """The preview size, which is the network input size unless set."""
+        return self.preview_size or tuple(inputSize)
+
+    def depth_size(self):
+        return MONO_RESOLUTIONS[self.mono_resolution]
+
+    def sensor_size(self):
+        return SENSOR_RESOLUTIONS[self.sensor_resolution]
+
+    def preview_crop(self, inputSize):
+        """
+        The normalized xmin, ymin, xmax, ymax of the camera's view that the
+        preview shows.  The preview keeps its aspect ratio by cropping the
+        middle of the view, which depth aligned to the rgb camera covers all
+        of.
+        """
+        previewWidth, previewHeight = self.preview(inputSize)
+        sensorWidth, sensorHeight = self.sensor_size()
+        width = min(previewWidth * sensorHeight / (previewHeight * sensorWidth), 1.0)
+        height = min(previewHeight * sensorWidth / (previewWidth * sensorHeight), 1.0)
+        return ((1 - width) / 2, (1 - height) / 2, (1 + width) / 2, (1 + height) / 2)
+
+    def configure_color_camera(self, camRgb, inputSize):
+        """Set the resolution, frame rate and preview size of a ColorCamera."""
+        import depthai as dai
+
+        resolutions = {"1080p": dai.ColorCameraProperties.SensorResolution.THE_1080_P,
+                       "4k": dai.ColorCameraProperties.SensorResolution.THE_4_K,
+                       "12mp": dai.ColorCameraProperties.SensorResolution.THE_12_MP}
+        camRgb.setPreviewSize(*self.preview(inputSize))
+        camRgb.setResolution(resolutions[self.sensor_resolution])
+        camRgb.setFps(self.fps)
+
+    def configure_stereo(self, monoLeft, monoRight, stereo):
+        """Set the mono camera resolution and frame rate and the stereo preset."""
+        import depthai as dai
+
+        resolutions = {"400p": dai.MonoCameraProperties.SensorResolution.THE_400_P,
+                       "720p": dai.MonoCameraProperties.SensorResolution.THE_720_P,
+                       "800p": dai.MonoCameraProperties.SensorResolution.THE_800_P}
+        presets = {"high_density": dai.node.StereoDepth.PresetMode.HIGH_DENSITY,
+                   "high_accuracy": dai.node.StereoDepth.PresetMode.HIGH_ACCURACY}
+        for mono in (monoLeft, monoRight):
+            mono.setResolution(resolutions[self.mono_resolution])
+            mono.setFps(self.fps)
+        stereo.setDefaultProfilePreset(presets[self.stereo_preset])
+
+    def configure_network(self, nn):
+        """Set the inference threads and input blocking of a neural network node."""
+        nn.setNumInferenceThreads(self.inference_threads)
+        nn.input.setBlocking(self.nn_input_blocking)
+
+    def output_queue(self, device, name):
+        return device.getOutputQueue(name=name, maxSize=self.queue_size, blocking=self.queue_blocking)
+
+
+def profile_names(model_config=None):
+    """The built in profiles and those of the model config."""
+    configProfiles = getattr(model_config, "pipeline", {}).get("profiles", {})
+    return list(PROFILES) + [name for name in configProfiles if name not in PROFILES]
+
+
+def load_profile(model_config=None, name=None):
+    """
+    The PipelineProfile name from a ModelConfigParser.
+
+    The model config's "pipeline" section can pick the profile used when
+    name is None with "profile", and add or change profiles in "profiles".
+    A profile in the config changes the built in profile of the same name.
+    """
+    pipeline = getattr(model_config, "pipeline", {})
+    name = name or pipeline.get("profile", "default")
+    configProfiles = pipeline.get("profiles", {})
+    if name not in PROFILES and name not in configProfiles:
+        raise ValueError("no pipeline profile {}, the profiles are {}".format(
+            name, ", ".join(profile_names(model_config))))
+    settings = dict(PROFILES.get(name, {}))
+    settings.update(configProfiles.get(name, {}))
+    return PipelineProfile(name, settings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the XLink streams and bandwidth of each mode')
+    parser.add_argument('-f', '--fps', type=float, default=30,
+                        help='frames per second of the network [30]')
+    parser.add_argument('-d', '--detections', type=int, default=10,
+                        help='detections per frame [10]')
+    parser.add_argument('-c', '--config', type=str, default=None,
+                        help='print the pipeline profiles of this model config instead')
+    args = parser.parse_args()
+
+    if args.config is not None:
+        from wpi_helpers import ModelConfigParser
+        model_config = ModelConfigParser(args.config)
+        for name in profile_names(model_config):
+            print(json.dumps({name: load_profile(model_config, name).settings()}))
+        raise SystemExit(0)
+
+    modes = {"headless": consumed_streams(mjpeg=False),
+             "mjpeg": consumed_streams(),
+             "mjpeg + depth stream": consumed_streams(depthStream=True),
+             "gui": consumed_streams(gui=True, mjpeg=False),
+             "record": consumed_streams(record=True)}
+    for mode, streams in modes.items():
+        print("{}: {}".format(mode, ", ".join(streams)))
+        print(format_bandwidth(bandwidth(streams, args.fps, detections=args.detections)))
@@ -0,0 +1,284 @@
+"""
+- This module has the pieces used to run the host side of a pipeline
+on several threads.
+- LatestMailbox passes values between threads.  It holds a single value
+and a new value replaces one that hasn't been taken yet, so a slow reader
+always gets the latest frame and never holds up the writer.
+- StageThread runs a function in a loop on its own thread and keeps the
+first exception it raises so the main thread can report it.
+- MessageSynchronizer reads several output queues and returns the
+messages that belong to the same frame together.
+"""
+
+import threading
+import time
+from collections import deque
+
+
+class LatestMailbox:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.value = None
+        self.full = False
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, value):
+        with self.cond:
+            if self.full:
+                self.dropped += 1
+            self.value = value
+            self.full = True
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        """Take the latest value.  Returns None on timeout or once the mailbox is closed."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.full or self.closed, timeout)
+            if not self.full:
+                return None
+            value = self.value
+            self.value = None
+            self.full = False
+            return value
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class StageThread(threading.Thread):
+    """
+        Calls step() until stop_event is set.
+
+    # Arguments
+        name: the thread name.
+        step: function called once per iteration.
+        stop_event: threading.Event shared by all of the stages.  It is set
+            when step() raises so the other stages stop too.
+    """
+    def __init__(self, name, step, stop_event):
+        super().__init__(name=name, daemon=True)
+        self.step = step
+        self.stop_event = stop_event
+        self.error = None
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                self.step()
+        except BaseException as e:
+            self.error = e
+            self.stop_event.set()
+
+
+class MessageSynchronizer:
+    """
+        Matches the messages from several output queues into per-frame bundles.
+
+        Streams that come from the same camera frame, like the rgb passthrough
+        and the detections, are matched by sequence number.  Streams from
+        another camera, like depth from the mono cameras, have their own
+        sequence numbers and are matched by the nearest timestamp instead.
+        Messages that can't be matched are dropped and counted.
+
+    # Arguments
+        queues: dictionary of stream name to output queue.
+        matchByTime: names of the streams matched by timestamp.
+        optional: names of the streams added to a bundle when they are
+            available.  They are only waited for, up to optionalWait
+            seconds, while they keep up with the frames.
+        maxPending: the number of frames kept while waiting for the rest
+            of their messages.
+        maxSkew: the largest timestamp difference in seconds allowed
+            between messages matched by timestamp.  About a frame at 30 fps.
+        optionalWait: the longest wait in seconds for the message of an
+            optional stream that comes a little after the rest of its frame.
+    """
+    def __init__(self, queues, matchByTime=(), optional=(), maxPending=8, maxSkew=0.035,
+                 optionalWait=0.005):
+        self.queues = queues
+        self.seqStreams = [n for n in queues if n not in matchByTime and n not in optional]
+        self.timeStreams = [n for n in queues if n in matchByTime and n not in optional]
+        self.optional = [n for n in queues if n in optional]
+        self.maxPending = maxPending
+        self.maxSkew = maxSkew
+        self.optionalWait = optionalWait
+
+        self.pending = {}   # sequence number -> {stream name: message}
+        self.timeBuffers = {n: deque(maxlen=maxPending) for n in self.timeStreams}
+        self.optionalBuffers = {n: deque(maxlen=maxPending) for n in self.optional}
+        self.lastSeq = {}
+
+        # Statistics
+        self.bundles = 0
+        self.missed = {n: 0 for n in queues}    # gaps in the sequence numbers
+        self.dropped = {n: 0 for n in queues}   # received but never matched
+        self.incomplete = 0
+        self.lastSkew = 0.0
+        self.maxSeenSkew = 0.0
+        self.totalSkew = 0.0
+
+    def _timestamp(self, msg):
+        return msg.getTimestamp().total_seconds()
+
+    def add(self, name, msg):
+        seq = msg.getSequenceNum()
+        last = self.lastSeq.get(name)
+        if last is not None and seq > last + 1:
+            self.missed[name] += seq - last - 1
+        self.lastSeq[name] = seq
+
+        buffer = self.timeBuffers.get(name, self.optionalBuffers.get(name))
+        if buffer is not None:
+            if len(buffer) == buffer.maxlen:
+                self.dropped[name] += 1
+            buffer.append(msg)
+        else:
+            self.pending.setdefault(seq, {})[name] = msg
+            while len(self.pending) > self.maxPending:
+                self._drop(min(self.pending))
+
+    def _drop(self, seq):
+        self.incomplete += 1
+        for name in self.pending.pop(seq):
+            self.dropped[name] += 1
+
+    def _drain(self, names):
+        for name in names:
+            for msg in self.queues[name].tryGetAll():
+                self.add(name, msg)
+
+    def _match_time(self, name, reference):
+        """Find the message nearest reference.  Returns (message, waiting)."""
+        buffer = self.timeBuffers[name]
+        # Until a message at or after the reference arrives a closer one may still come
+        if not buffer or self._timestamp(buffer[-1]) < reference:
+            return None, True
+
+        best = None
+        for msg in buffer:
+            skew = abs(self._timestamp(msg) - reference)
+            if skew <= self.maxSkew and (best is None or skew < best[0]):
+                best = (skew, msg)
+        if best is not None:
+            return best[1], False
+        return None, False
+
+    def _pop_bundle(self):
+        """Return the oldest complete bundle, or the name of a stream to wait on."""
+        for seq in sorted(self.pending):
+            group = self.pending[seq]
+            missing = [n for n in self.seqStreams if n not in group]
+            if missing:
+                # A newer frame may still complete, older ones are dropped then
+                continue
+
+            reference = self._timestamp(group[self.seqStreams[0]])
+            bundle = dict(group)
+            for name in self.timeStreams:
+                msg, waiting = self._match_time(name, reference)
+                if msg is None:
+                    if waiting:
+                        return None, name
+                    break
+                bundle[name] = msg
+            else:
+                for older in [s for s in self.pending if s < seq]:
+                    self._drop(older)
+                del self.pending[seq]
+                for name in self.timeStreams:
+                    buffer = self.timeBuffers[name]
+                    while buffer and self._timestamp(buffer[0]) <= self._timestamp(bundle[name]):
+                        used = buffer.popleft()
+                        if used is not bundle[name]:
+                            self.dropped[name] += 1
+                return bundle, None
+
+            # No timestamp match will come for this frame
+            self._drop(seq)
+            return None, None
+
+        waitOn = self.seqStreams[0]
+        if self.pending:
+            oldest = self.pending[min(self.pending)]
+            waitOn = next(n for n in self.seqStreams if n not in oldest)
+        return None, waitOn
+
+    def get(self):
+        """Block until the next complete bundle is available and return it.
+
+        The bundle is a dictionary of stream name to message.
+        """
+        while True:
+            self._drain(self.queues)
+            bundle, waitOn = self._pop_bundle()
+            if bundle is not None:
+                return self._complete(bundle)
+            if waitOn is not None:
+                self.add(waitOn, self.queues[waitOn].get())
+
+    def tryGet(self):
+        """Return the next complete bundle if the queues have its messages, else None."""
+        self._drain(self.queues)
+        while True:
+            bundle, waitOn = self._pop_bundle()
+            if bundle is not None:
+                return self._complete(bundle)
+            if waitOn is not None:
+                return None
+
+    def _wait_optional(self, name, seq):
+        """
+        Wait a moment for the message of an optional stream for frame seq,
+        which is sent after the rest of the frame, like the bounding box
+        mapping after the detections.  A stream that has fallen more than
+        maxPending frames behind, or never sent, isn't waited for.
+        """
+        last = self.lastSeq.get(name)
+        if last is None or last >= seq or last < seq - self.maxPending:
+            return
+        deadline = time.monotonic() + self.optionalWait
+        while True:
+            for msg in self.queues[name].tryGetAll():
+                self.add(name, msg)
+            if self.lastSeq[name] >= seq or time.monotonic() >= deadline:
+                return
+            time.sleep(0.0005)
+
+    def _complete(self, bundle):
+        """Add the optional streams to a bundle and count it."""
+        seq = bundle[self.seqStreams[0]].getSequenceNum()
+        for name in self.optional:
+            self._wait_optional(name, seq)
+            buffer = self.optionalBuffers[name]
+            while buffer and buffer[0].getSequenceNum() <= seq:
+                msg = buffer.popleft()
+                if msg.getSequenceNum() == seq:
+                    bundle[name] = msg
+                else:
+                    self.dropped[name] += 1
+
+        stamps = [self._timestamp(msg) for msg in bundle.values()]
+        self.lastSkew = max(stamps) - min(stamps)
+        self.maxSeenSkew = max(self.maxSeenSkew, self.lastSkew)
+        self.totalSkew += self.lastSkew
+        self.bundles += 1
+        return bundle
+
+    def stats(self):
+        return {"bundles": self.bundles,
+                "incomplete": self.incomplete,
+                "missed": dict(self.missed),
+                "dropped": dict(self.dropped),
+                "skew_ms": self.lastSkew * 1000,
+                "max_skew_ms": self.maxSeenSkew * 1000,
+                "mean_skew_ms": self.totalSkew / self.bundles * 1000 if self.bundles else 0.0}
+
+    def report(self):
+        s = self.stats()
+        return ("Synchronized {} frames, {} incomplete.  Missed {}  Dropped {}  "
+                "Skew mean {:.1f} ms max {:.1f} ms".format(
+                    s["bundles"], s["incomplete"], s["missed"], s["dropped"],
+                    s["mean_skew_ms"], s["max_skew_ms"]))
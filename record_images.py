@@ -4,7 +4,13 @@ import cv2
 import argparse
 import depthai as dai
 import img_helpers as img
+from dataset_helpers import DatasetWriter, AsyncDatasetWriter, FORMATS
 from wpi_helpers import ConfigParser, WPINetworkTables
+from replay_helpers import Recorder, Replay, ReplayFinished
+from startup_helpers import timeline, wait_for_device, watch_network_tables
+
+# Size of the square frames that are recorded
+IMAGE_SIZE = 300
 
 def parse_args():
     """Parse input arguments."""
@@ -24,35 +30,97 @@ def parse_args():
     parser.add_argument(
         '-p', '--mjpeg_port', type=int, default=8080,
         help='MJPEG server port [8080]')    
+    parser.add_argument(
+        '-r', '--record', type=str, default=None,
+        help='record the device output queues to this folder')
+    parser.add_argument(
+        '--replay', type=str, default=None,
+        help='replay a recording from this folder instead of using a device')
+    parser.add_argument(
+        '--loop', action='store_true',
+        help='start the replay over when it finishes [False]')
+    parser.add_argument(
+        '--realtime', action='store_true',
+        help='replay at the recorded rate instead of full speed [False]')
+    parser.add_argument(
+        '--writers', type=int, default=2,
+        help='threads writing images to disk [2]')
+    parser.add_argument(
+        '--queue_size', type=int, default=32,
+        help='most images waiting to be written [32]')
+    parser.add_argument(
+        '--drop_policy', type=str, default='drop_oldest', choices=img.DROP_POLICIES,
+        help='when the queue is full drop the oldest or newest image, or block the capture loop [drop_oldest]')
+    parser.add_argument(
+        '-e', '--device_encode', action='store_true',
+        help='JPEG encode the frames on the camera and write them as they are [False]')
+    parser.add_argument(
+        '-q', '--jpeg_quality', type=int, default=95,
+        help='JPEG quality used on the camera with --device_encode [95]')
+    parser.add_argument(
+        '--dataset', type=str, default=None,
+        help='append the frames to shards in this dataset folder instead of one JPEG file each')
+    parser.add_argument(
+        '--dataset_format', type=str, default='jpeg', choices=FORMATS,
+        help='store the dataset frames as JPEG blobs or raw arrays [jpeg]')
+    parser.add_argument(
+        '--device_timeout', type=float, default=None,
+        help='seconds to wait for the OAK camera before giving up [wait forever]')
     args = parser.parse_args()
     return args
 
-# -------------------------------------------------------------------------
-# Main Program Start
-# -------------------------------------------------------------------------
-def main(args, frc_config):
-    # Create pipeline
+def create_pipeline(deviceEncode=False, quality=95):
+    """Create a pipeline with the 300x300 frames that are recorded.
+
+    # Arguments
+        deviceEncode: JPEG encode the frames on the camera.  They come out of
+            the mjpeg stream instead of as raw BGR preview frames.
+        quality: the JPEG quality used on the camera.
+    """
     pipeline = dai.Pipeline()
 
     # Define source and outputs
     camRgb = pipeline.create(dai.node.ColorCamera)
-    xoutVideo = pipeline.create(dai.node.XLinkOut)
-    xoutPreview = pipeline.create(dai.node.XLinkOut)
-
-    xoutVideo.setStreamName("video")
-    xoutPreview.setStreamName("preview")
-
-    # Properties
-    camRgb.setPreviewSize(300, 300)
     camRgb.setBoardSocket(dai.CameraBoardSocket.RGB)
     camRgb.setResolution(dai.ColorCameraProperties.SensorResolution.THE_1080_P)
-    camRgb.setInterleaved(True)
-    camRgb.setColorOrder(dai.ColorCameraProperties.ColorOrder.BGR)
+
+    if not deviceEncode:
+        xoutPreview = pipeline.create(dai.node.XLinkOut)
+        xoutPreview.setStreamName("preview")
+
+        # Properties
+        camRgb.setPreviewSize(IMAGE_SIZE, IMAGE_SIZE)
+        camRgb.setInterleaved(True)
+        camRgb.setColorOrder(dai.ColorCameraProperties.ColorOrder.BGR)
+
+        # Linking
+        camRgb.preview.link(xoutPreview.input)
+        return pipeline
+
+    # The encoder takes NV12 frames, so the video output is cropped to a
+    # square and scaled down like the preview instead
+    manip = pipeline.create(dai.node.ImageManip)
+    videoEnc = pipeline.create(dai.node.VideoEncoder)
+    xoutJpeg = pipeline.create(dai.node.XLinkOut)
+    xoutJpeg.setStreamName("mjpeg")
+
+    manip.initialConfig.setResize(IMAGE_SIZE, IMAGE_SIZE)
+    manip.initialConfig.setKeepAspectRatio(True)
+    manip.initialConfig.setFrameType(dai.ImgFrame.Type.NV12)
+    manip.setMaxOutputFrameSize(IMAGE_SIZE * IMAGE_SIZE * 3 // 2)
+    videoEnc.setDefaultProfilePreset(camRgb.getFps(), dai.VideoEncoderProperties.Profile.MJPEG)
+    videoEnc.setQuality(quality)
 
     # Linking
-    camRgb.video.link(xoutVideo.input)
-    camRgb.preview.link(xoutPreview.input)
+    camRgb.video.link(manip.inputImage)
+    manip.out.link(videoEnc.input)
+    videoEnc.bitstream.link(xoutJpeg.input)
+    return pipeline
 
+# -------------------------------------------------------------------------
+# Main Program Start
+# -------------------------------------------------------------------------
+def main(args, frc_config):
     # Start the mjpeg server (default)
     try:
         import cscore as cs
@@ -66,40 +134,82 @@ def main(args, frc_config):
 
     print("Using Network Tables")
     networkTables = WPINetworkTables(frc_config.team)    
+    watch_network_tables(networkTables.ntinst)
         
-    # Connect to device and start pipeline
-    with dai.Device(pipeline) as device:
-
-        video = device.getOutputQueue('video')
-        preview = device.getOutputQueue('preview')
+    if args.replay is not None:
+        print("Replaying recording", args.replay)
+        device = Replay(args.replay, loop=args.loop, realtime=args.realtime)
+    else:
+        # Connect to device and start pipeline
+        device = dai.Device(create_pipeline(args.device_encode, args.jpeg_quality), wait_for_device(timeout=args.device_timeout))
+        timeline.mark("Pipeline started")
+
+    if args.dataset is not None:
+        if args.device_encode and args.dataset_format != "jpeg":
+            raise SystemExit('ERROR: --device_encode needs --dataset_format jpeg')
+        print("Writing dataset", args.dataset)
+        datasetWriter = AsyncDatasetWriter(DatasetWriter(args.dataset, args.dataset_format),
+                                           maxQueue=args.queue_size, policy=args.drop_policy)
+        def saveData(frame, speed, rotate):
+            return datasetWriter.submit(None, frame, speed, rotate)
+    else:
+        img.configureWriter(workers=args.writers, maxQueue=args.queue_size, policy=args.drop_policy)
+        saveData = img.saveData
+
+    with device:
+        if args.record is not None:
+            print("Recording to", args.record)
+            device = Recorder(args.record, device)
+
+        if args.device_encode:
+            frames = device.getOutputQueue('mjpeg', maxSize=8, blocking=False)
+        else:
+            frames = device.getOutputQueue('preview')
 
         try:
             while True:
-                videoFrame = video.get()
-                previewFrame = preview.get()
+                inFrame = frames.get()
                 speed, rotate = networkTables.get_drive_data()
-                img.saveData(previewFrame.getFrame(), speed, rotate)
 
-                # Get BGR frame from NV12 encoded video frame to show with opencv
-                # cv2.imshow("video", videoFrame.getCvFrame())
-                # Show 'preview' frame as is (already in correct format, no copy is made)
-                frame = previewFrame.getFrame()
-                if cvSource is False:
+                if args.device_encode:
+                    # The JPEG is written as it came from the camera.  It is
+                    # only decoded when something displays it.
+                    jpeg = inFrame.getData()
+                    saveData(jpeg, speed, rotate)
+                    frame = None
+                    if cvSource is False or cvSource.isEnabled():
+                        frame = cv2.imdecode(jpeg, cv2.IMREAD_COLOR)
+                else:
+                    # Show 'preview' frame as is (already in correct format, no copy is made)
+                    frame = inFrame.getFrame()
+                    saveData(frame, speed, rotate)
+
+                if frame is None:
+                    pass
+                elif cvSource is False:
                     # Display stream to desktop window
                     cv2.imshow("preview", frame)
                 else:               
                     # Display stream to browser
                     cvSource.putFrame(frame)   
 
-                if cv2.waitKey(1) == ord('q'):
+                # Only a desktop window can be closed with the keyboard
+                if cvSource is False and cv2.waitKey(1) == ord('q'):
                     break
 
-        except KeyboardInterrupt:
-            # Keyboard interrupt (Ctrl + C) detected
+        except (KeyboardInterrupt, ReplayFinished):
+            # Keyboard interrupt (Ctrl + C) or end of the replay
             pass
 
-        print("Saving log file")  
-        img.saveLog()   
+        if args.record is not None:
+            device.close()
+
+        if args.dataset is not None:
+            datasetWriter.close()
+            print("Dataset saved:", datasetWriter.stats())
+        else:
+            print("Saving log file")  
+            img.saveLog()   
 
 if __name__ == '__main__':
     print("Running record_images.py")
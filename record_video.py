@@ -2,6 +2,7 @@
 
 import depthai as dai
 import cv2 # Must be imported otherwise cscore import hangs
+from startup_helpers import timeline, wait_for_device
 
 # Create pipeline
 pipeline = dai.Pipeline()
@@ -39,8 +40,10 @@ try:
 except Exception as e:
     cvSource = False
 
-# Connect to device and start pipeline
-with dai.Device(pipeline) as device:
+# Connect to device and start pipeline.  runCameraRecord starts this at boot,
+# when the camera can take a while to enumerate, so wait for it however long
+with dai.Device(pipeline, wait_for_device(timeout=None)) as device:
+    timeline.mark("Pipeline started")
 
     # Print Myriad X Id (MxID), USB speed, and available cameras on the device
     print('MxId:',device.getDeviceInfo().getMxId())
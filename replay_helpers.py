@@ -0,0 +1,519 @@
+"""
+- This module records the messages that come out of depthai output queues
+and plays them back without an OAK device attached.
+- Wrap a device with Recorder to save every message the host reads from
+its output queues, along with the sequence numbers and device timestamps.
+The messages are converted, pickled and written on a writer thread, and the
+files are flushed once a second, so recording adds little to the loop that
+reads the queues.
+- Open a recording with Replay.  Replay.getOutputQueue returns queues that
+look like a dai.DataOutputQueue, so the detection loops run unchanged.
+- Recordings are a folder with one pickle file per stream.  Only load
+recordings that you made yourself.
+"""
+
+import json
+import pickle
+import queue
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+import numpy as np
+
+RECORDING_INFO = "recording.json"
+
+
+class ReplayFinished(RuntimeError):
+    """Raised by ReplayQueue.get() when the recording has no more messages."""
+    pass
+
+
+# -------------------------------------------------------------------------
+# Host side stand-ins for the depthai message types
+# -------------------------------------------------------------------------
+class HostMessage:
+    def __init__(self, seq=0, timestamp=0.0, timestampDevice=None):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.timestampDevice = timestamp if timestampDevice is None else timestampDevice
+
+    def getSequenceNum(self):
+        return self.seq
+
+    def getTimestamp(self):
+        return timedelta(seconds=self.timestamp)
+
+    def getTimestampDevice(self):
+        return timedelta(seconds=self.timestampDevice)
+
+
+class HostImgFrame(HostMessage):
+    def __init__(self, frame, cvFrame=None, **kwargs):
+        super().__init__(**kwargs)
+        self.frame = frame
+        self.cvFrame = frame if cvFrame is None else cvFrame
+
+    def getFrame(self):
+        return self.frame
+
+    def getCvFrame(self):
+        return self.cvFrame
+
+    def getWidth(self):
+        return self.cvFrame.shape[1]
+
+    def getHeight(self):
+        return self.cvFrame.shape[0]
+
+
+class HostBitstream(HostMessage):
+    """An encoded frame, like the bitstream output of a VideoEncoder."""
+    def __init__(self, data, **kwargs):
+        super().__init__(**kwargs)
+        self.data = data
+
+    def getData(self):
+        return self.data
+
+
+class HostPoint:
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x = x
+        self.y = y
+        self.z = z
+
+
+class HostSpatialDetection:
+    def __init__(self, label, confidence, xmin, ymin, xmax, ymax, spatial=(0, 0, 0)):
+        self.label = label
+        self.confidence = confidence
+        self.xmin = xmin
+        self.ymin = ymin
+        self.xmax = xmax
+        self.ymax = ymax
+        self.spatialCoordinates = HostPoint(*spatial)
+
+
+class HostDetections(HostMessage):
+    def __init__(self, detections, **kwargs):
+        super().__init__(**kwargs)
+        self.detections = detections
+
+
+class HostRect:
+    def __init__(self, x, y, width, height, normalized=True):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.normalized = normalized
+
+    def isNormalized(self):
+        return self.normalized
+
+    def denormalize(self, width, height):
+        if not self.normalized:
+            return self
+        return HostRect(self.x * width, self.y * height,
+                        self.width * width, self.height * height, normalized=False)
+
+    def topLeft(self):
+        return HostPoint(self.x, self.y)
+
+    def bottomRight(self):
+        return HostPoint(self.x + self.width, self.y + self.height)
+
+
+class HostConfigData:
+    def __init__(self, roi):
+        self.roi = roi
+
+
+class HostLocationConfig(HostMessage):
+    def __init__(self, configData, **kwargs):
+        super().__init__(**kwargs)
+        self.configData = configData
+
+    def getConfigData(self):
+        return self.configData
+
+
+class HostNNData(HostMessage):
+    def __init__(self, layers, **kwargs):
+        super().__init__(**kwargs)
+        self.layers = layers
+
+    def getAllLayerNames(self):
+        return list(self.layers)
+
+    def getLayerFp16(self, name):
+        return self.layers[name].tolist()
+
+    def getFirstLayerFp16(self):
+        return next(iter(self.layers.values())).tolist()
+
+
+# -------------------------------------------------------------------------
+# Converting messages to and from records
+# -------------------------------------------------------------------------
+def _seconds(td):
+    return td.total_seconds()
+
+
+def message_to_record(msg):
+    """Convert a depthai message into a dictionary that can be pickled."""
+    record = {"seq": msg.getSequenceNum(), "timestamp": _seconds(msg.getTimestamp())}
+    if hasattr(msg, "getTimestampDevice"):
+        record["timestampDevice"] = _seconds(msg.getTimestampDevice())
+
+    if hasattr(msg, "getType") and msg.getType().name == "BITSTREAM":
+        record["type"] = "Bitstream"
+        record["data"] = np.array(msg.getData())
+    elif hasattr(msg, "getCvFrame"):
+        frame = np.array(msg.getFrame())
+        cvFrame = np.array(msg.getCvFrame())
+        record["type"] = "ImgFrame"
+        record["frame"] = frame
+        # Depth frames are the same either way, so don't store them twice
+        same = cvFrame.shape == frame.shape and np.array_equal(cvFrame, frame)
+        record["cvFrame"] = None if same else cvFrame
+    elif hasattr(msg, "detections"):
+        record["type"] = "Detections"
+        record["detections"] = []
+        for d in msg.detections:
+            spatial = (0, 0, 0)
+            if hasattr(d, "spatialCoordinates"):
+                c = d.spatialCoordinates
+                spatial = (c.x, c.y, c.z)
+            record["detections"].append((d.label, d.confidence, d.xmin, d.ymin,
+                                         d.xmax, d.ymax, spatial))
+    elif hasattr(msg, "getConfigData"):
+        record["type"] = "LocationConfig"
+        record["rois"] = [(c.roi.x, c.roi.y, c.roi.width, c.roi.height, c.roi.isNormalized())
+                          for c in msg.getConfigData()]
+    elif hasattr(msg, "getAllLayerNames"):
+        record["type"] = "NNData"
+        record["layers"] = {name: np.array(msg.getLayerFp16(name), dtype=np.float32)
+                            for name in msg.getAllLayerNames()}
+    else:
+        raise ValueError("Can't record message of type {}".format(type(msg).__name__))
+    return record
+
+
+def record_to_message(record, seqOffset=0, timeOffset=0.0):
+    """Create a host stand-in message from a record."""
+    stamps = {"seq": record["seq"] + seqOffset,
+              "timestamp": record["timestamp"] + timeOffset,
+              "timestampDevice": record.get("timestampDevice", record["timestamp"]) + timeOffset}
+    kind = record["type"]
+    if kind == "ImgFrame":
+        return HostImgFrame(record["frame"], record["cvFrame"], **stamps)
+    elif kind == "Bitstream":
+        return HostBitstream(record["data"], **stamps)
+    elif kind == "Detections":
+        return HostDetections([HostSpatialDetection(*d) for d in record["detections"]], **stamps)
+    elif kind == "LocationConfig":
+        return HostLocationConfig([HostConfigData(HostRect(*r)) for r in record["rois"]], **stamps)
+    elif kind == "NNData":
+        return HostNNData(record["layers"], **stamps)
+    raise ValueError("Unknown record type {}".format(kind))
+
+
+# -------------------------------------------------------------------------
+# Recording
+# -------------------------------------------------------------------------
+class RecordWriter:
+    """
+        Pickles messages to their files on a background thread.
+
+    # Arguments
+        maxQueue: the most messages waiting to be written.  Reading a queue
+            waits for room rather than lose a message when the disk falls
+            this far behind.
+        flushInterval: seconds between flushes of the files.
+    """
+    def __init__(self, maxQueue=64, flushInterval=1.0):
+        self.pending = queue.Queue(maxsize=maxQueue)
+        self.flushInterval = flushInterval
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="record-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, file, msg):
+        if self.error is not None:
+            raise self.error
+        self.pending.put((file, msg))
+
+    def _run(self):
+        dirty = set()
+        lastFlush = time.monotonic()
+        while True:
+            try:
+                item = self.pending.get(timeout=self.flushInterval)
+            except queue.Empty:
+                item = None
+            if item is not None and item[0] is None:
+                break
+            if item is not None and self.error is None:
+                file, msg = item
+                try:
+                    pickle.dump(message_to_record(msg), file, pickle.HIGHEST_PROTOCOL)
+                    dirty.add(file)
+                except (OSError, ValueError) as e:
+                    # Raised on the reading thread by the next put
+                    self.error = e
+            now = time.monotonic()
+            if now - lastFlush >= self.flushInterval:
+                for file in dirty:
+                    file.flush()
+                dirty.clear()
+                lastFlush = now
+        for file in dirty:
+            file.flush()
+
+    def close(self):
+        """Write the messages still queued and flush the files."""
+        self.pending.put((None, None))
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class QueueRecorder:
+    """Wraps an output queue and saves every message read from it with a RecordWriter."""
+    def __init__(self, queue, file, writer):
+        self.queue = queue
+        self.file = file
+        self.writer = writer
+        self.count = 0
+
+    def _save(self, msg):
+        if msg is not None:
+            self.writer.put(self.file, msg)
+            self.count += 1
+        return msg
+
+    def get(self):
+        return self._save(self.queue.get())
+
+    def tryGet(self):
+        return self._save(self.queue.tryGet())
+
+    def tryGetAll(self):
+        return [self._save(msg) for msg in self.queue.tryGetAll()]
+
+    def getAll(self):
+        return [self._save(msg) for msg in self.queue.getAll()]
+
+    def has(self):
+        return self.queue.has()
+
+    def getName(self):
+        return self.queue.getName()
+
+
+class Recorder:
+    """
+        Records the output queues of a device to a folder.
+
+    # Arguments
+        path: folder to write the recording to.  It is created if needed.
+        device: the dai.Device (or anything with getOutputQueue) to record.
+    """
+    def __init__(self, path, device):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.device = device
+        self.files = {}
+        self.queues = {}
+        self.writer = RecordWriter()
+
+    def getOutputQueue(self, name, *args, **kwargs):
+        queue = self.device.getOutputQueue(name, *args, **kwargs)
+        self.files[name] = open(self.path / f"{name}.pkl", "wb")
+        self.queues[name] = QueueRecorder(queue, self.files[name], self.writer)
+        with open(self.path / RECORDING_INFO, "w") as f:
+            json.dump({"streams": list(self.files)}, f)
+        return self.queues[name]
+
+    def readCalibration(self):
+        return self.device.readCalibration()
+
+    def close(self):
+        try:
+            self.writer.close()
+        finally:
+            for f in self.files.values():
+                f.close()
+        for name, queue in self.queues.items():
+            print(f"Recorded {queue.count} '{name}' messages")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# -------------------------------------------------------------------------
+# Replay
+# -------------------------------------------------------------------------
+def load_records(file_path):
+    records = []
+    with open(file_path, "rb") as f:
+        while True:
+            try:
+                records.append(pickle.load(f))
+            except EOFError:
+                break
+    return records
+
+
+class ReplayQueue:
+    """
+        Plays back one recorded stream with the dai.DataOutputQueue interface.
+
+        At full speed every call returns the next message.  In realtime mode
+        messages only become available once their recorded time has passed,
+        and a non-blocking queue drops the oldest messages beyond maxSize
+        like the device does.
+    """
+    def __init__(self, name, records, clock, maxSize=4, blocking=True, loop=False):
+        self.name = name
+        self.records = records
+        self.clock = clock
+        self.maxSize = maxSize
+        self.blocking = blocking
+        self.loop = loop
+        self.index = 0
+        self.dropped = 0
+
+        # Offsets used to keep sequence numbers and timestamps increasing when looping
+        self.seqStride = records[-1]["seq"] + 1 if records else 0
+        self.timeStride = clock.duration
+
+    def _due(self, index):
+        lap, i = divmod(index, len(self.records))
+        return self.records[i]["timestamp"] + lap * self.timeStride - self.clock.start
+
+    def _finished(self, index=None):
+        index = self.index if index is None else index
+        return not self.records or (not self.loop and index >= len(self.records))
+
+    def _next(self):
+        lap, i = divmod(self.index, len(self.records))
+        self.index += 1
+        return record_to_message(self.records[i], lap * self.seqStride, lap * self.timeStride)
+
+    def _skip_stale(self):
+        # Drop what a non-blocking device queue would have overwritten
+        if self.blocking or not self.clock.realtime:
+            return
+        ready = self.index
+        while not self._finished(ready) and self._due(ready) <= self.clock.elapsed():
+            ready += 1
+        while ready - self.index > self.maxSize:
+            self.index += 1
+            self.dropped += 1
+
+    def has(self):
+        if self._finished():
+            return False
+        return not self.clock.realtime or self._due(self.index) <= self.clock.elapsed()
+
+    def get(self):
+        if self._finished():
+            raise ReplayFinished(f"Replay of '{self.name}' finished")
+        self._skip_stale()
+        if self.clock.realtime:
+            wait = self._due(self.index) - self.clock.elapsed()
+            if wait > 0:
+                time.sleep(wait)
+        return self._next()
+
+    def tryGet(self):
+        if not self.has():
+            return None
+        self._skip_stale()
+        return self._next()
+
+    def tryGetAll(self):
+        messages = []
+        while self.has():
+            messages.append(self.tryGet())
+            if not self.clock.realtime:
+                break
+        return messages
+
+    def getAll(self):
+        messages = self.tryGetAll()
+        return messages if messages else [self.get()]
+
+    def getName(self):
+        return self.name
+
+    def getMaxSize(self):
+        return self.maxSize
+
+    def getBlocking(self):
+        return self.blocking
+
+    def isClosed(self):
+        return self._finished()
+
+
+class ReplayClock:
+    def __init__(self, start, duration, realtime):
+        self.start = start
+        self.duration = duration
+        self.realtime = realtime
+        self.wallStart = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self.wallStart
+
+
+class Replay:
+    """
+        Opens a recording made with Recorder.  It stands in for dai.Device.
+
+    # Arguments
+        path: the recording folder.
+        loop: start over at the end of the recording instead of finishing.
+        realtime: deliver messages at their recorded rate instead of as
+            fast as the host can read them.
+    """
+    def __init__(self, path, loop=False, realtime=False):
+        self.path = Path(path)
+        if not (self.path / RECORDING_INFO).exists():
+            raise ValueError("{} is not a recording".format(path))
+
+        with open(self.path / RECORDING_INFO) as f:
+            streams = json.load(f)["streams"]
+        self.records = {name: load_records(self.path / f"{name}.pkl") for name in streams}
+
+        stamps = [r["timestamp"] for records in self.records.values() for r in records]
+        start = min(stamps, default=0.0)
+        # Leave one frame interval between laps when looping
+        frames = max((len(r) for r in self.records.values()), default=1)
+        duration = (max(stamps, default=0.0) - start) * (1 + 1 / max(frames - 1, 1))
+        self.clock = ReplayClock(start, duration, realtime)
+        self.loop = loop
+
+    def getOutputQueue(self, name, maxSize=4, blocking=True):
+        if name not in self.records:
+            raise RuntimeError("Stream '{}' was not recorded in {}".format(name, self.path))
+        return ReplayQueue(name, self.records[name], self.clock, maxSize, blocking, self.loop)
+
+    def getOutputQueueNames(self):
+        return list(self.records)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,71 +1,111 @@
 #!/usr/bin/env python3
 
+import argparse
 import depthai as dai
+from startup_helpers import timeline, wait_for_device
+from video_helpers import SegmentedVideoWriter, StreamRecorder, encoder_profile
 
-# Create pipeline
-pipeline = dai.Pipeline()
-
-# Define sources and outputs
-camRgb = pipeline.create(dai.node.ColorCamera)
-monoLeft = pipeline.create(dai.node.MonoCamera)
-monoRight = pipeline.create(dai.node.MonoCamera)
-ve1 = pipeline.create(dai.node.VideoEncoder)
-ve2 = pipeline.create(dai.node.VideoEncoder)
-ve3 = pipeline.create(dai.node.VideoEncoder)
-
-ve1Out = pipeline.create(dai.node.XLinkOut)
-ve2Out = pipeline.create(dai.node.XLinkOut)
-ve3Out = pipeline.create(dai.node.XLinkOut)
-
-ve1Out.setStreamName('ve1Out')
-ve2Out.setStreamName('ve2Out')
-ve3Out.setStreamName('ve3Out')
-
-# Properties
-camRgb.setBoardSocket(dai.CameraBoardSocket.RGB)
-monoLeft.setBoardSocket(dai.CameraBoardSocket.LEFT)
-monoRight.setBoardSocket(dai.CameraBoardSocket.RIGHT)
-# Create encoders, one for each camera, consuming the frames and encoding them using H.264 / H.265 encoding
-ve1.setDefaultProfilePreset(30, dai.VideoEncoderProperties.Profile.H264_MAIN)
-ve2.setDefaultProfilePreset(30, dai.VideoEncoderProperties.Profile.H265_MAIN)
-ve3.setDefaultProfilePreset(30, dai.VideoEncoderProperties.Profile.H264_MAIN)
-
-# Linking
-monoLeft.out.link(ve1.input)
-camRgb.video.link(ve2.input)
-monoRight.out.link(ve3.input)
-ve1.bitstream.link(ve1Out.input)
-ve2.bitstream.link(ve2Out.input)
-ve3.bitstream.link(ve3Out.input)
-
-# Connect to device and start pipeline
-with dai.Device(pipeline) as dev:
-
-    # Output queues will be used to get the encoded data from the outputs defined above
-    outQ1 = dev.getOutputQueue(name='ve1Out', maxSize=30, blocking=True)
-    outQ2 = dev.getOutputQueue(name='ve2Out', maxSize=30, blocking=True)
-    outQ3 = dev.getOutputQueue(name='ve3Out', maxSize=30, blocking=True)
-
-    # The .h264 / .h265 files are raw stream files (not playable yet)
-    with open('mono1.h264', 'wb') as fileMono1H264, open('color.h265', 'wb') as fileColorH265, open('mono2.h264', 'wb') as fileMono2H264:
+def parse_args():
+    """Parse input arguments."""
+    desc = 'Record the color and both mono cameras into MP4 segments'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument(
+        '-f', '--folder', type=str, default="videos",
+        help='folder the video segments are written to [videos]')
+    parser.add_argument(
+        '--segment_seconds', type=float, default=60.0,
+        help='start a new segment after this many seconds, 0 for no limit [60]')
+    parser.add_argument(
+        '--device_timeout', type=float, default=None,
+        help='seconds to wait for the OAK camera before giving up [wait forever]')
+    args = parser.parse_args()
+    return args
+
+# Stream name, codec and segment file prefix of each encoder
+STREAMS = (('ve1Out', 'h264', 'mono1'),
+           ('ve2Out', 'h265', 'color'),
+           ('ve3Out', 'h264', 'mono2'))
+
+def create_pipeline():
+    # Create pipeline
+    pipeline = dai.Pipeline()
+
+    # Define sources and outputs
+    camRgb = pipeline.create(dai.node.ColorCamera)
+    monoLeft = pipeline.create(dai.node.MonoCamera)
+    monoRight = pipeline.create(dai.node.MonoCamera)
+    ve1 = pipeline.create(dai.node.VideoEncoder)
+    ve2 = pipeline.create(dai.node.VideoEncoder)
+    ve3 = pipeline.create(dai.node.VideoEncoder)
+
+    ve1Out = pipeline.create(dai.node.XLinkOut)
+    ve2Out = pipeline.create(dai.node.XLinkOut)
+    ve3Out = pipeline.create(dai.node.XLinkOut)
+
+    ve1Out.setStreamName('ve1Out')
+    ve2Out.setStreamName('ve2Out')
+    ve3Out.setStreamName('ve3Out')
+
+    # Properties
+    camRgb.setBoardSocket(dai.CameraBoardSocket.RGB)
+    monoLeft.setBoardSocket(dai.CameraBoardSocket.LEFT)
+    monoRight.setBoardSocket(dai.CameraBoardSocket.RIGHT)
+    # Create encoders, one for each camera, consuming the frames and encoding them using H.264 / H.265 encoding
+    ve1.setDefaultProfilePreset(30, encoder_profile('h264'))
+    ve2.setDefaultProfilePreset(30, encoder_profile('h265'))
+    ve3.setDefaultProfilePreset(30, encoder_profile('h264'))
+
+    # Linking
+    monoLeft.out.link(ve1.input)
+    camRgb.video.link(ve2.input)
+    monoRight.out.link(ve3.input)
+    ve1.bitstream.link(ve1Out.input)
+    ve2.bitstream.link(ve2Out.input)
+    ve3.bitstream.link(ve3Out.input)
+
+    # Frame size of each stream, for the MP4 headers
+    sizes = {'ve1Out': (monoLeft.getResolutionWidth(), monoLeft.getResolutionHeight()),
+             've2Out': camRgb.getVideoSize(),
+             've3Out': (monoRight.getResolutionWidth(), monoRight.getResolutionHeight())}
+    return pipeline, sizes
+
+# -------------------------------------------------------------------------
+# Main Program Start
+# -------------------------------------------------------------------------
+def main(args):
+    pipeline, sizes = create_pipeline()
+
+    # Connect to device and start pipeline
+    with dai.Device(pipeline, wait_for_device(timeout=args.device_timeout)) as dev:
+        timeline.mark("Pipeline started")
+
+        # One writer per stream, each muxing into its own MP4 segments with
+        # the device timestamps
+        streams = []
+        for name, codec, prefix in STREAMS:
+            width, height = sizes[name]
+            queue = dev.getOutputQueue(name=name, maxSize=30, blocking=True)
+            writer = SegmentedVideoWriter(args.folder, codec, fps=30, width=width, height=height,
+                                          segmentSeconds=args.segment_seconds or None, prefix=prefix)
+            streams.append((queue, writer))
+
+        # Each queue is read by a thread that sleeps until a packet arrives
+        recorder = StreamRecorder(streams)
         print("Press Ctrl+C to stop encoding...")
-        while True:
-            try:
-                # Empty each queue
-                while outQ1.has():
-                    outQ1.get().getData().tofile(fileMono1H264)
-
-                while outQ2.has():
-                    outQ2.get().getData().tofile(fileColorH265)
-
-                while outQ3.has():
-                    outQ3.get().getData().tofile(fileMono2H264)
-            except KeyboardInterrupt:
-                # Keyboard interrupt (Ctrl + C) detected
-                break
-
-    print("To view the encoded data, convert the stream file (.h264/.h265) into a video file (.mp4), using commands below:")
-    cmd = "ffmpeg -framerate 30 -i {} -c copy {}"
-    print(cmd.format("mono1.h264", "mono1.mp4"))
-    print(cmd.format("mono2.h264", "mono2.mp4"))
-    print(cmd.format("color.h265", "color.mp4"))
\ No newline at end of file
+        try:
+            recorder.wait()
+        except KeyboardInterrupt:
+            # Keyboard interrupt (Ctrl + C) detected
+            pass
+
+    # The device is closed, so the readers have stopped
+    recorder.close()
+    for queue, writer in streams:
+        print("{}: {packets} packets in {segments} segments".format(writer.prefix, **writer.stats()))
+
+
+if __name__ == '__main__':
+    print("Running rgb_mono_encoding.py")
+    args = parse_args()
+
+    main(args)
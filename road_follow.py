@@ -13,6 +13,13 @@ import cv2
 import depthai as dai
 
 from wpi_helpers import ConfigParser, WPINetworkTables, ModelConfigParser, WPINetworkTables
+from replay_helpers import Recorder, Replay
+from startup_helpers import timeline, wait_for_device, watch_network_tables
+from perf_helpers import LatencyTracker
+from pipeline_builder import load_profile
+
+# The input size of the steering model
+INPUT_SIZE = (200, 66)
 
 '''
 Spatial Tiny-yolo example
@@ -54,10 +61,29 @@ def parse_args():
     parser.add_argument(
         '-p', '--mjpeg_port', type=int, default=8080,
         help='MJPEG server port [8080]')    
+    parser.add_argument(
+        '--profile', type=str, default=None,
+        help=('pipeline profile from <model>-config.json or built in: default, low-latency, '
+              'max-fps or max-accuracy [the config\'s profile, or default]'))
+    parser.add_argument(
+        '--device_timeout', type=float, default=None,
+        help='seconds to wait for the OAK camera before giving up [wait forever]')
+    parser.add_argument(
+        '-r', '--record', type=str, default=None,
+        help='record the device output queues to this folder')
+    parser.add_argument(
+        '--replay', type=str, default=None,
+        help='replay a recording from this folder instead of using a device')
+    parser.add_argument(
+        '--loop', action='store_true',
+        help='start the replay over when it finishes [False]')
+    parser.add_argument(
+        '--realtime', action='store_true',
+        help='replay at the recorded rate instead of full speed [False]')
     args = parser.parse_args()
     return args
            
-def loop_and_detect(previewQueue, detectionNNQueue, networkTables, cvSource):
+def loop_and_detect(previewQueue, detectionNNQueue, networkTables, cvSource, latency=None):
     """Continuously capture images from camera and do object detection.
 
     # Arguments
@@ -68,6 +94,8 @@ def loop_and_detect(previewQueue, detectionNNQueue, networkTables, cvSource):
       labelMap: Map of labelled classes
       nt: the WPI Network Tables.
       cvSource: The source going out to the mjpeg server
+      latency: Optional LatencyTracker that measures the latency of each
+        frame from capture to publish, and reports it to the log and Network Tables
     """
     startTime = time.monotonic()
     counter = 0
@@ -78,6 +106,7 @@ def loop_and_detect(previewQueue, detectionNNQueue, networkTables, cvSource):
     while True:
         inRgb = previewQueue.get()
         inDet = detectionNNQueue.get()
+        received = dai.Clock.now()
 
         counter+=1
         current_time = time.monotonic()
@@ -104,8 +133,18 @@ def loop_and_detect(previewQueue, detectionNNQueue, networkTables, cvSource):
                 cv2.FONT_HERSHEY_TRIPLEX, 0.5, color)
 
             # Put data to Network Tables
+            publishStart = dai.Clock.now()
             if networkTables:
-                networkTables.put_spacial_data(steeringData)
+                networkTables.put_drive_data(steeringData[0])
+                timeline.mark_once("First steering published")
+
+            if latency is not None:
+                latency.frame(inDet.getTimestamp(), received, publishStart, dai.Clock.now())
+                if latency.due():
+                    summary = latency.summary()
+                    print(latency.format(summary))
+                    if networkTables:
+                        networkTables.put_latency(summary)
         
         if cvSource is False:
             # Display stream to desktop window
@@ -114,38 +153,16 @@ def loop_and_detect(previewQueue, detectionNNQueue, networkTables, cvSource):
             # Display stream to browser
             cvSource.putFrame(frame)   
 
-        if cv2.waitKey(1) == ord('q'):
+        # Only a desktop window can be closed with the keyboard
+        if cvSource is False and cv2.waitKey(1) == ord('q'):
             break
 
-# -------------------------------------------------------------------------
-# Main Program Start
-# -------------------------------------------------------------------------
-def main(args, config_parser):
-    
-    # Get the model blob file
-    if not os.path.isfile('%s.blob' % args.model):
-        raise SystemExit('ERROR: file (%s.blob) not found!' % args.model)
-
-    blob_file = f"{args.model}.blob"
-    nnPath = str((Path(__file__).parent / Path(blob_file)).resolve().absolute())
-    print(f"Running model at path {nnPath}")
-
-    if not Path(nnPath).exists():
-        print(f"No model found at path {nnPath}")
-
-    print("Connecting to Network Tables")
-    hardware_type = "OAK-D Camera"
-    if args.no_network_tables == False:
-        print("Using Network Tables")
-        networkTables = WPINetworkTables(config_parser.team, hardware_type)
-    else:
-        print("No Network Tables requested")
-        networkTables = False    
-
+def create_pipeline(nnPath, profile=None):
+    """Create the steering model pipeline from a PipelineProfile, by default the default profile."""
     syncNN = True
+    if profile is None:
+        profile = load_profile()
 
-    # Configure and load the camera pipeline
-    print("Loading camera and model")
     pipeline = dai.Pipeline()
 
     # Define sources and outputs
@@ -159,17 +176,13 @@ def main(args, config_parser):
 
 
     # Properties
-    frame_width = 200
-    frame_height = 66
-    camRgb.setPreviewSize(frame_width, frame_height)
-    camRgb.setResolution(dai.ColorCameraProperties.SensorResolution.THE_1080_P)
+    profile.configure_color_camera(camRgb, INPUT_SIZE)
     camRgb.setInterleaved(False)
     camRgb.setColorOrder(dai.ColorCameraProperties.ColorOrder.BGR)
 
     # Setting node configs
     nn.setBlobPath(nnPath)
-    nn.setNumInferenceThreads(2)
-    nn.input.setBlocking(False)
+    profile.configure_network(nn)
 
     # Linking
     camRgb.preview.link(nn.input)
@@ -179,19 +192,72 @@ def main(args, config_parser):
         camRgb.preview.link(xoutRgb.input)
     nn.out.link(xoutNN.input)
 
-    # Connect to device and start pipeline
-    print("Connecting to device and starting pipeline")
-    with dai.Device(pipeline) as device:
+    return pipeline
+
+# -------------------------------------------------------------------------
+# Main Program Start
+# -------------------------------------------------------------------------
+def main(args, config_parser):
+    timeline.mark("Modules loaded")
+
+    # Get the model blob file.  A replay doesn't need it.
+    if args.replay is None and not os.path.isfile('%s.blob' % args.model):
+        raise SystemExit('ERROR: file (%s.blob) not found!' % args.model)
+
+    blob_file = f"{args.model}.blob"
+    nnPath = str((Path(__file__).parent / Path(blob_file)).resolve().absolute())
+    print(f"Running model at path {nnPath}")
+
+    if not Path(nnPath).exists():
+        print(f"No model found at path {nnPath}")
+
+    # The steering model has no config file unless its pipeline is tuned
+    configPath = Path(__file__).parent / f"{args.model}-config.json"
+    model_config = ModelConfigParser(configPath) if configPath.exists() else None
+    try:
+        profile = load_profile(model_config, args.profile)
+    except ValueError as e:
+        raise SystemExit('ERROR: {}'.format(e))
+    print("Pipeline profile {}: {}".format(profile.name, profile.settings()))
+
+    print("Connecting to Network Tables")
+    hardware_type = "OAK-D Camera"
+    if args.no_network_tables == False:
+        print("Using Network Tables")
+        networkTables = WPINetworkTables(config_parser.team, hardware_type)
+        watch_network_tables(networkTables.ntinst)
+    else:
+        print("No Network Tables requested")
+        networkTables = False    
+
+    if args.replay is not None:
+        print("Replaying recording", args.replay)
+        device = Replay(args.replay, loop=args.loop, realtime=args.realtime)
+    else:
+        # Configure and load the camera pipeline
+        print("Loading camera and model")
+        pipeline = create_pipeline(nnPath, profile)
+
+        # Connect to device and start pipeline
+        print("Connecting to device and starting pipeline")
+        device = dai.Device(pipeline, wait_for_device(timeout=args.device_timeout))
+        timeline.mark("Pipeline started")
+
+    with device:
+        if args.record is not None:
+            print("Recording to", args.record)
+            device = Recorder(args.record, device)
 
         # Output queues will be used to get the rgb frames and nn data from the outputs defined above
-        previewQueue = device.getOutputQueue(name="rgb", maxSize=4, blocking=False)
-        detectionNNQueue = device.getOutputQueue(name="detections", maxSize=4, blocking=False)
+        previewQueue = profile.output_queue(device, "rgb")
+        detectionNNQueue = profile.output_queue(device, "detections")
         
         # Run the inference loop
         if args.gui is True:
             print("Gui requested")
             try:
-                loop_and_detect(previewQueue, detectionNNQueue, networkTables, cvSource=False)
+                loop_and_detect(previewQueue, detectionNNQueue, networkTables, cvSource=False,
+                                latency=LatencyTracker())
             except Exception as e:
                 print(e)
             finally:
@@ -204,12 +270,16 @@ def main(args, config_parser):
             mjpeg_server.setSource(cvSource)
             print('MJPEG server started on port', args.mjpeg_port)
             try:
-                loop_and_detect(previewQueue, detectionNNQueue, networkTables, cvSource=cvSource)
+                loop_and_detect(previewQueue, detectionNNQueue, networkTables, cvSource=cvSource,
+                                latency=LatencyTracker())
             except Exception as e:
                 print(e)
             finally:
                 print("Finished")         
 
+        if args.record is not None:
+            device.close()
+
 
 if __name__ == '__main__':
     print("Running oak_yolo_spacial_wpi.py")
@@ -0,0 +1,102 @@
+"""
+- This module gets the scripts publishing as soon as possible after the
+robot powers on.
+- wait_for_device polls for the OAK camera instead of sleeping for a fixed
+time, so the pipeline starts as soon as the camera has enumerated.
+- watch_network_tables logs when the Network Tables server is reached.  It
+doesn't hold anything up: values put before then are sent once connected.
+- timeline prints the time of each startup step since the process started,
+including the time the interpreter took to start and import the modules.
+"""
+
+import os
+import time
+
+
+def process_age():
+    """Seconds since this process started, or 0 if it can't be read."""
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name can hold spaces, the fields after it can't
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"), 0.0)
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class StartupTimeline:
+    def __init__(self):
+        self.start = time.monotonic() - process_age()
+        self.events = []
+        self.seen = set()
+
+    def mark(self, event):
+        elapsed = time.monotonic() - self.start
+        self.events.append((event, elapsed))
+        print("[startup {:7.3f}s] {}".format(elapsed, event))
+
+    def mark_once(self, event):
+        """Mark an event the first time it happens.  Cheap enough to call every frame."""
+        if event not in self.seen:
+            self.seen.add(event)
+            self.mark(event)
+
+
+# Shared by the modules of one script
+timeline = StartupTimeline()
+
+
+def wait_for_device(mxid=None, timeout=30.0, poll=0.1):
+    """
+    Wait until an OAK device is available and return its DeviceInfo.
+
+    # Arguments
+        mxid: the MxId of the device to wait for.  Any device when None.
+        timeout: seconds to wait before giving up.  None waits forever.
+    """
+    import depthai as dai
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    announced = False
+    while True:
+        for info in dai.Device.getAllAvailableDevices():
+            if mxid is None or info.getMxId() == mxid:
+                timeline.mark("OAK device {} found".format(info.getMxId()))
+                return info
+        if deadline is not None and time.monotonic() > deadline:
+            raise RuntimeError("No OAK device found after {:.0f} seconds".format(timeout))
+        if not announced:
+            print("Waiting for the OAK device...")
+            announced = True
+        time.sleep(poll)
+
+
+def wait_for_devices(mxids=None, timeout=30.0, settle=1.0, poll=0.1):
+    """
+    Wait for several OAK devices and return their DeviceInfos sorted by MxId.
+
+    # Arguments
+        mxids: the MxIds of the devices to wait for.  When None, every device
+            available settle seconds after the first one is found.
+        timeout: seconds to wait for the devices.  None waits forever.
+    """
+    import depthai as dai
+
+    if mxids is None:
+        wait_for_device(timeout=timeout, poll=poll)
+        # Cameras plugged into the same hub enumerate a moment apart
+        time.sleep(settle)
+        devices = dai.Device.getAllAvailableDevices()
+    else:
+        devices = [wait_for_device(mxid, timeout, poll) for mxid in mxids]
+    return sorted(devices, key=lambda info: info.getMxId())
+
+
+def watch_network_tables(ntinst):
+    """Log when the Network Tables client connects to the server."""
+    def connection_changed(connected, info):
+        if connected:
+            timeline.mark_once("Network Tables connected")
+    ntinst.addConnectionListener(connection_changed, immediateNotify=True)
@@ -0,0 +1,218 @@
+"""
+- This module follows spatial detections from frame to frame so each
+object keeps the same track id and gets a velocity.
+- Each track has a constant velocity Kalman filter on X, Y and Z.  The axes
+are independent, so the filter is kept as three 2x2 covariances per track
+and every track is predicted and updated at once with NumPy array operations.
+- Detections are matched to tracks of the same label by the overlap (IoU)
+of their boxes and the 3D distance to the predicted position.  The cheapest
+pairs are matched first.
+- A track is reported once it has been matched minHits times.  It keeps
+being reported at its predicted position when it isn't matched, and is
+dropped after maxMisses frames without a match.
+"""
+
+import numpy as np
+
+# Columns of Tracker.state: box, position, velocity, the three covariance
+# terms of each axis and the confidence
+STATE_COLUMNS = 20
+# Columns of Tracker.counts: id, label, hits, misses and age
+COUNT_COLUMNS = 5
+
+
+def box_iou(boxes1, boxes2):
+    """IoU of every box in boxes1 with every box in boxes2.  Boxes are rows of xmin, ymin, xmax, ymax."""
+    xmin = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    ymin = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    xmax = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    ymax = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    intersection = np.clip(xmax - xmin, 0, None) * np.clip(ymax - ymin, 0, None)
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union = area1[:, None] + area2[None, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-12), 0.0)
+
+
+def greedy_match(cost):
+    """Match rows to columns cheapest first.  Infinite costs are never matched.
+
+    Returns the matched row and column indices.
+    """
+    rows, cols = np.nonzero(np.isfinite(cost))
+    order = np.argsort(cost[rows, cols], kind="stable")
+    usedRows = np.zeros(cost.shape[0], dtype=bool)
+    usedCols = np.zeros(cost.shape[1], dtype=bool)
+    matchedRows, matchedCols = [], []
+    for row, col in zip(rows[order].tolist(), cols[order].tolist()):
+        if not usedRows[row] and not usedCols[col]:
+            usedRows[row] = usedCols[col] = True
+            matchedRows.append(row)
+            matchedCols.append(col)
+    return np.array(matchedRows, dtype=int), np.array(matchedCols, dtype=int)
+
+
+class Track:
+    """A confirmed track.  Positions are in mm and velocities in mm per second."""
+    def __init__(self, id, label, confidence, box, position, velocity, age, misses):
+        self.id = id
+        self.label = label
+        self.confidence = confidence
+        self.box = box
+        self.position = position
+        self.velocity = velocity
+        self.age = age
+        self.misses = misses
+
+
+class Tracker:
+    """
+        Tracks spatial detections with a Kalman filter per object.
+
+    # Arguments
+        iouThreshold: the least box overlap that matches a detection to a track.
+        maxDistance: the largest distance in mm between a detection and
+            a track's predicted position that matches them.
+        minHits: the matches needed before a track is reported.
+        maxMisses: the frames a track is kept without a match.
+        accelNoise: the standard deviation of the acceleration in mm/s^2
+            allowed by the constant velocity model.
+        measurementNoise: the standard deviation of the depth camera's
+            position measurements in mm.
+    """
+    def __init__(self, iouThreshold=0.2, maxDistance=500, minHits=3, maxMisses=5,
+                 accelNoise=2000.0, measurementNoise=50.0):
+        self.iouThreshold = iouThreshold
+        self.maxDistance = maxDistance
+        self.minHits = minHits
+        self.maxMisses = maxMisses
+        self.accelVariance = accelNoise ** 2
+        self.measurementVariance = measurementNoise ** 2
+        self.nextId = 1
+        self.lastTime = None
+
+        # One row per track.  Keeping the state in two arrays means adding and
+        # removing tracks is two concatenations however many fields there are.
+        self.state = np.zeros((0, STATE_COLUMNS))
+        self.counts = np.zeros((0, COUNT_COLUMNS), dtype=int)
+        self._bind()
+
+    def _bind(self):
+        """Point the named fields at the columns of the state arrays."""
+        state, counts = self.state, self.counts
+        self.boxes = state[:, 0:4]
+        self.pos = state[:, 4:7]
+        self.vel = state[:, 7:10]
+        # Covariance of each axis: position, position-velocity and velocity terms
+        self.p00 = state[:, 10:13]
+        self.p01 = state[:, 13:16]
+        self.p11 = state[:, 16:19]
+        self.confidences = state[:, 19]
+        self.ids = counts[:, 0]
+        self.labels = counts[:, 1]
+        self.hits = counts[:, 2]
+        self.misses = counts[:, 3]
+        self.ages = counts[:, 4]
+
+    def predict(self, dt):
+        """Move every track forward dt seconds."""
+        q = self.accelVariance
+        self.pos += self.vel * dt
+        self.p00 += dt * (2 * self.p01 + dt * self.p11) + q * dt ** 4 / 4
+        self.p01 += dt * self.p11 + q * dt ** 3 / 2
+        self.p11 += q * dt ** 2
+
+    def correct(self, tracks, measured):
+        """Update the given tracks with measured positions."""
+        p00, p01, p11 = self.p00[tracks], self.p01[tracks], self.p11[tracks]
+        s = p00 + self.measurementVariance
+        k0 = p00 / s
+        k1 = p01 / s
+        innovation = measured - self.pos[tracks]
+        self.pos[tracks] += k0 * innovation
+        self.vel[tracks] += k1 * innovation
+        self.p00[tracks] = (1 - k0) * p00
+        self.p01[tracks] = (1 - k0) * p01
+        self.p11[tracks] = p11 - k1 * p01
+
+    def association_cost(self, labels, boxes, positions, hasDepth):
+        """Cost of matching each track to each detection.  Pairs that can't match are infinite."""
+        iou = box_iou(self.boxes, boxes)
+        distance = np.linalg.norm(self.pos[:, None, :] - positions[None, :, :], axis=2)
+        # Without depth a detection can only be matched by its box
+        distance[:, ~hasDepth] = np.inf
+        near = distance <= self.maxDistance
+        allowed = (self.labels[:, None] == labels[None, :]) & ((iou >= self.iouThreshold) | near)
+        cost = (1 - iou) + np.where(near, distance / self.maxDistance, 1.0)
+        return np.where(allowed, cost, np.inf)
+
+    def update(self, detections, timestamp):
+        """
+        Match a frame's detections to the tracks and return the confirmed tracks.
+
+        # Arguments
+            detections: the `detections` list of a SpatialImgDetections message.
+            timestamp: the frame time in seconds.
+        """
+        dt = 0.0 if self.lastTime is None else max(timestamp - self.lastTime, 0.0)
+        self.lastTime = timestamp
+        if not detections and len(self.state) == 0:
+            return []
+
+        rows = np.array([(d.label, d.confidence, d.xmin, d.ymin, d.xmax, d.ymax,
+                          d.spatialCoordinates.x, d.spatialCoordinates.y, d.spatialCoordinates.z)
+                         for d in detections], dtype=float).reshape(-1, 9)
+        labels = rows[:, 0].astype(int)
+        boxes = rows[:, 2:6]
+        positions = rows[:, 6:9]
+        # The spatial calculator reports 0, 0, 0 when there was no valid depth
+        hasDepth = positions[:, 2] > 0
+
+        self.predict(dt)
+        trackIdx, detIdx = greedy_match(self.association_cost(labels, boxes, positions, hasDepth))
+
+        withDepth = hasDepth[detIdx]
+        self.correct(trackIdx[withDepth], positions[detIdx[withDepth]])
+        self.boxes[trackIdx] = boxes[detIdx]
+        self.confidences[trackIdx] = rows[detIdx, 1]
+        self.hits[trackIdx] += 1
+        self.misses += 1
+        self.misses[trackIdx] = 0
+        self.ages += 1
+
+        keep = self.misses <= self.maxMisses
+        new = np.ones(len(rows), dtype=bool)
+        new[detIdx] = False
+        if not keep.all() or new.any():
+            self._remove_and_add(keep, rows[new], labels[new], hasDepth[new])
+        return self.tracks()
+
+    def _remove_and_add(self, keep, rows, labels, hasDepth):
+        n = len(rows)
+        # A new track starts at the measured position with an unknown velocity.
+        # Without depth its position is unknown too.
+        unknown = (self.maxDistance * 10.0) ** 2
+        state = np.zeros((n, STATE_COLUMNS))
+        state[:, 0:4] = rows[:, 2:6]
+        state[:, 4:7] = rows[:, 6:9]
+        state[:, 10:13] = np.where(hasDepth, self.measurementVariance, unknown)[:, None]
+        state[:, 16:19] = unknown
+        state[:, 19] = rows[:, 1]
+        counts = np.zeros((n, COUNT_COLUMNS), dtype=int)
+        counts[:, 0] = np.arange(self.nextId, self.nextId + n)
+        counts[:, 1] = labels
+        counts[:, 2] = 1
+        counts[:, 4] = 1
+        self.nextId += n
+
+        self.state = np.concatenate([self.state[keep], state])
+        self.counts = np.concatenate([self.counts[keep], counts])
+        self._bind()
+
+    def tracks(self):
+        """The tracks that have been matched at least minHits times."""
+        confirmed = np.nonzero(self.hits >= self.minHits)[0]
+        return [Track(int(self.ids[i]), int(self.labels[i]), float(self.confidences[i]),
+                      self.boxes[i].tolist(), self.pos[i].tolist(), self.vel[i].tolist(),
+                      int(self.ages[i]), int(self.misses[i]))
+                for i in confirmed]
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+import argparse
+import itertools
+import json
+import time
+from pathlib import Path
+import numpy as np
+
+import oak_yolo_spacial
+from pipeline_builder import (MONO_RESOLUTIONS, STEREO_PRESETS, PipelineProfile,
+                              consumed_streams, load_profile, parse_size)
+from replay_helpers import Replay, ReplayFinished
+from wpi_helpers import ModelConfigParser
+
+'''
+Pipeline tuner
+  Builds the spatial detection pipeline with every combination of the
+  settings given, runs each for a while and measures the network and host
+  frame rates and the latency from capture to the host.  Prints the
+  combinations ranked and writes the best as a pipeline profile, see
+  pipeline_builder, that oak_yolo_spacial.py runs with --profile tuned.
+
+  With --replay the trials read a recording at its recorded rate instead of
+  a device.  Only the host side settings, the queue size and blocking, can
+  change then, so the tuner can be tried without a camera.
+'''
+
+# Settings that change the pipeline on the device, which a replay can't
+DEVICE_SETTINGS = ("inference_threads", "stereo_preset", "mono_resolution", "preview_size")
+RANKINGS = ("latency", "fps")
+TUNED_PROFILE = "tuned"
+
+# Seconds between polls of the queues while a trial waits for a frame
+POLL_INTERVAL = 0.001
+
+def parse_args():
+    """Parse input arguments."""
+    desc = 'Try pipeline settings and rank them by frame rate and latency'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument(
+        '-m', '--model', type=str, default='rapid-react',
+        help='the model, loaded from <model>.blob and <model>-config.json [rapid-react]')
+    parser.add_argument(
+        '-c', '--config', type=str, default=None,
+        help='the model config file [<model>-config.json]')
+    parser.add_argument(
+        '--replay', type=str, default=None,
+        help='try the host side settings on a recording from this folder instead of a device')
+    parser.add_argument(
+        '--profile', type=str, default=None,
+        help='the profile the settings not tried are taken from [the config\'s profile]')
+    parser.add_argument(
+        '--threads', type=str, default='1,2',
+        help='comma separated inference thread counts [1,2]')
+    parser.add_argument(
+        '--queue_sizes', type=str, default='1,4,8',
+        help='comma separated output queue sizes [1,4,8]')
+    parser.add_argument(
+        '--blocking', type=str, default='false,true',
+        help='comma separated output queue blocking modes [false,true]')
+    parser.add_argument(
+        '--stereo_presets', type=str, default=','.join(STEREO_PRESETS),
+        help='comma separated stereo presets [%s]' % ','.join(STEREO_PRESETS))
+    parser.add_argument(
+        '--mono_resolutions', type=str, default='400p,800p',
+        help='comma separated mono resolutions of %s [400p,800p]' % ', '.join(MONO_RESOLUTIONS))
+    parser.add_argument(
+        '--preview_sizes', type=str, default=None,
+        help='comma separated WxH preview sizes, which the network has to accept [the profile\'s]')
+    parser.add_argument(
+        '-s', '--seconds', type=float, default=10,
+        help='seconds each combination is measured for [10]')
+    parser.add_argument(
+        '-w', '--warmup', type=float, default=2,
+        help='seconds each combination runs before it is measured [2]')
+    parser.add_argument(
+        '--headless', action='store_true',
+        help='only read the detections, like oak_yolo_spacial.py --headless [False]')
+    parser.add_argument(
+        '--depth', action='store_true',
+        help='also read the depth frames, like with a depth stream [False]')
+    parser.add_argument(
+        '--host_ms', type=float, default=0,
+        help='milliseconds of other host work for each frame, like rendering [0]')
+    parser.add_argument(
+        '-r', '--rank', type=str, default='latency', choices=RANKINGS,
+        help='rank by the p95 latency or by the host frame rate [latency]')
+    parser.add_argument(
+        '--min_fps', type=float, default=0,
+        help='rank combinations under this host frame rate last [0]')
+    parser.add_argument(
+        '-o', '--output', type=str, default='tuned-pipeline.json',
+        help='file the best profile is written to [tuned-pipeline.json]')
+    parser.add_argument(
+        '--update_config', action='store_true',
+        help='also add the best profile to the model config and make it its profile [False]')
+    args = parser.parse_args()
+    return args
+
+def parse_bool(text):
+    return text.strip().lower() in ("true", "1", "yes")
+
+def sweep(args, base):
+    """The settings of each combination to try, from the base PipelineProfile."""
+    grid = {"inference_threads": [int(v) for v in args.threads.split(',')],
+            "stereo_preset": args.stereo_presets.split(','),
+            "mono_resolution": args.mono_resolutions.split(','),
+            "preview_size": ([parse_size(v) for v in args.preview_sizes.split(',')]
+                             if args.preview_sizes else [base.preview_size]),
+            "queue_size": [int(v) for v in args.queue_sizes.split(',')],
+            "queue_blocking": [parse_bool(v) for v in args.blocking.split(',')]}
+    if args.replay is not None:
+        # A recording was made with its device settings
+        for key in DEVICE_SETTINGS:
+            grid[key] = [getattr(base, key)]
+    for values in itertools.product(*grid.values()):
+        settings = base.settings()
+        settings.update(zip(grid, values))
+        yield PipelineProfile(TUNED_PROFILE, settings).settings()
+
+def capture_clock(device):
+    """
+    A function giving the time.monotonic() time a message was captured.
+    Device timestamps are on that clock.  A replay delivers each message
+    its recorded time after the replay started.
+    """
+    clock = getattr(device, "clock", None)
+    if clock is None:
+        return lambda msg: msg.getTimestamp().total_seconds()
+    return lambda msg: clock.wallStart + msg.getTimestamp().total_seconds() - clock.start
+
+def measure(device, profile, streams, seconds, warmup, hostWork=0.0):
+    """
+    Read the device's queues as the profile opens them and return the
+    frame rates and latencies.  None if fewer than two frames arrived,
+    which includes a device that stops sending, as the queues are polled
+    only until the trial's time is up.
+
+    # Arguments
+        device: the dai.Device, or a Replay, running.
+        profile: the PipelineProfile tried.
+        streams: the streams read.
+        seconds: how long to measure for, after warmup seconds.
+        hostWork: seconds of other work for each frame.
+    """
+    queues = {name: profile.output_queue(device, name) for name in streams}
+    synchronizer = oak_yolo_spacial.create_synchronizer(queues.get("rgb"), queues["detections"],
+                                                        queues.get("depth"),
+                                                        queues.get("boundingBoxDepthMapping"))
+    captured = capture_clock(device)
+    start = time.monotonic()
+    deadline = start + warmup + seconds
+    latencies, first, last = [], None, None
+    try:
+        while time.monotonic() < deadline:
+            bundle = synchronizer.tryGet()
+            if bundle is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+            received = time.monotonic()
+            # The frames are copied to the host like in the detection loop
+            for name in ("rgb", "depth"):
+                if name in bundle:
+                    bundle[name].getFrame()
+            if hostWork:
+                time.sleep(hostWork)
+            if received - start < warmup:
+                continue
+            detections = bundle["detections"]
+            latencies.append(received - captured(detections))
+            last = (detections.getSequenceNum(), captured(detections), received)
+            if first is None:
+                first = last
+    except ReplayFinished:
+        pass
+    if len(latencies) < 2:
+        return None
+
+    frames = last[0] - first[0] + 1
+    ms = np.percentile(np.array(latencies) * 1000, (50, 95))
+    return {"nn_fps": (frames - 1) / max(last[1] - first[1], 1e-9),
+            "host_fps": (len(latencies) - 1) / max(last[2] - first[2], 1e-9),
+            "latency_p50_ms": float(ms[0]),
+            "latency_p95_ms": float(ms[1]),
+            "dropped": frames - len(latencies)}
+
+def run_trial(args, settings, model_config, nnPath, streams):
+    """Build the pipeline, or open the replay, with the settings and measure it."""
+    profile = PipelineProfile(TUNED_PROFILE, settings)
+    try:
+        if args.replay is not None:
+            device = Replay(args.replay, loop=True, realtime=True)
+        else:
+            import depthai as dai
+            from startup_helpers import wait_for_device
+            pipeline = oak_yolo_spacial.create_pipeline(nnPath, model_config, streams, profile)
+            device = dai.Device(pipeline, wait_for_device())
+        with device:
+            result = measure(device, profile, streams, args.seconds, args.warmup, args.host_ms / 1000)
+    except Exception as e:
+        return {"settings": settings, "error": str(e)}
+    if result is None:
+        return {"settings": settings,
+                "error": "no frames in {:.0f} seconds".format(args.warmup + args.seconds)}
+    result["settings"] = settings
+    return result
+
+def rank(results, by="latency", minFps=0):
+    """The results that ran, best first, then those that failed."""
+    ran = [r for r in results if "error" not in r]
+    if by == "latency":
+        key = lambda r: (r["host_fps"] < minFps, r["latency_p95_ms"], -r["host_fps"])
+    else:
+        key = lambda r: (r["host_fps"] < minFps, -r["host_fps"], r["latency_p95_ms"])
+    return sorted(ran, key=key) + [r for r in results if "error" in r]
+
+def changed_settings(settings):
+    """The settings that differ from PROFILE_DEFAULTS, as a profile in a model config lists them."""
+    defaults = PipelineProfile(TUNED_PROFILE, {}).settings()
+    return {key: value for key, value in settings.items() if value != defaults[key]}
+
+def print_table(ranked):
+    print("{:>4} {:>7} {:>5} {:>8} {:>13} {:>5} {:>8} {:>7} {:>8} {:>7} {:>7} {:>7}".format(
+        "rank", "threads", "queue", "blocking", "stereo", "mono", "preview",
+        "nn fps", "host fps", "p50 ms", "p95 ms", "dropped"))
+    for i, r in enumerate(ranked, 1):
+        s = r["settings"]
+        line = "{:>4} {:>7} {:>5} {:>8} {:>13} {:>5} {:>8}".format(
+            i, s["inference_threads"], s["queue_size"], str(s["queue_blocking"]).lower(),
+            s["stereo_preset"], s["mono_resolution"], s["preview_size"] or "input")
+        if "error" in r:
+            print(line, " failed:", r["error"])
+        else:
+            print(line + " {nn_fps:>7.1f} {host_fps:>8.1f} {latency_p50_ms:>7.1f} "
+                         "{latency_p95_ms:>7.1f} {dropped:>7}".format(**r))
+
+def write_profile(settings, outputPath, configPath=None):
+    """
+    Write the settings as the tuned profile of a "pipeline" section.  With
+    configPath they are also added to that model config as its profile.
+    """
+    pipeline = {"profile": TUNED_PROFILE, "profiles": {TUNED_PROFILE: changed_settings(settings)}}
+    with open(outputPath, "w") as f:
+        json.dump({"pipeline": pipeline}, f, indent=4)
+    print("Wrote the best profile to", outputPath)
+    if configPath is not None:
+        with open(configPath) as f:
+            config = json.load(f)
+        section = config.setdefault("pipeline", {})
+        section["profile"] = TUNED_PROFILE
+        section.setdefault("profiles", {})[TUNED_PROFILE] = pipeline["profiles"][TUNED_PROFILE]
+        with open(configPath, "w") as f:
+            json.dump(config, f, indent=4)
+        print("Made it the profile of", configPath)
+
+# -------------------------------------------------------------------------
+# Main Program Start
+# -------------------------------------------------------------------------
+def main(args):
+    configPath = args.config or str(Path(__file__).parent / f"{args.model}-config.json")
+    nnPath = str((Path(__file__).parent / f"{args.model}.blob").resolve())
+    if args.replay is None and not Path(nnPath).exists():
+        raise SystemExit('ERROR: file (%s) not found!' % nnPath)
+
+    model_config = ModelConfigParser(configPath)
+    try:
+        base = load_profile(model_config, args.profile)
+    except ValueError as e:
+        raise SystemExit('ERROR: {}'.format(e))
+    streams = consumed_streams(mjpeg=not args.headless, depthStream=args.depth)
+
+    trials = list(sweep(args, base))
+    print("Trying {} combinations for {:.0f} seconds each, reading {}".format(
+        len(trials), args.warmup + args.seconds, ", ".join(streams)))
+    if args.replay is not None:
+        print("Replaying", args.replay, "so only the queue settings change")
+
+    results = []
+    for i, settings in enumerate(trials, 1):
+        result = run_trial(args, settings, model_config, nnPath, streams)
+        summary = result.get("error") or "{host_fps:.1f} fps, p95 {latency_p95_ms:.1f} ms".format(**result)
+        print("[{}/{}] {}: {}".format(i, len(trials), changed_settings(settings), summary))
+        results.append(result)
+
+    ranked = rank(results, args.rank, args.min_fps)
+    print_table(ranked)
+    if not ranked or "error" in ranked[0]:
+        raise SystemExit('ERROR: no combination ran')
+    write_profile(ranked[0]["settings"], args.output, configPath if args.update_config else None)
+
+
+if __name__ == '__main__':
+    print("Running tune.py")
+    args = parse_args()
+
+    main(args)
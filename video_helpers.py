@@ -0,0 +1,297 @@
+"""
+- This module writes the bitstream of an OAK VideoEncoder into MP4 files.
+- SegmentedVideoWriter muxes on its own thread, so the thread reading the
+device queue only hands packets over and never waits on the disk.  Its
+queue blocks instead of dropping when full, so a slow card holds the
+encoder back rather than losing packets.
+- Packets are stamped with the device timestamp of the encoded frame,
+which doesn't jitter with host load like the time they were dequeued.
+- The recording is split into segments by duration or size.  A new segment
+starts at a keyframe so each file plays on its own, and is closed, which
+finalizes it, before the next one is opened.
+- Segments are fragmented MP4s, so the one being written is readable up to
+its last fragment if the process is killed.
+- StreamRecorder records several encoded streams at once.  Each queue is
+read by a thread blocked in get(), so nothing runs while no packets are
+pending, and each stream has its own writer.
+"""
+
+import os
+import threading
+from collections import deque
+from fractions import Fraction
+
+CODECS = ("h264", "h265", "mjpeg")
+
+# Names of the codecs in FFmpeg
+AV_CODECS = {"h264": "h264", "h265": "hevc", "mjpeg": "mjpeg"}
+
+# Writes a fragment at every keyframe, with the header at the start of the file
+MP4_OPTIONS = {"movflags": "frag_keyframe+empty_moov+default_base_moof"}
+
+
+def encoder_profile(codec):
+    """The VideoEncoder profile for a codec name."""
+    import depthai as dai
+
+    profiles = {"h264": dai.VideoEncoderProperties.Profile.H264_MAIN,
+                "h265": dai.VideoEncoderProperties.Profile.H265_MAIN,
+                "mjpeg": dai.VideoEncoderProperties.Profile.MJPEG}
+    return profiles[codec]
+
+
+def is_keyframe(data, codec):
+    """
+    True if an encoded packet starts a group of pictures the decoder can
+    start from.  Every MJPEG frame is one.  For H.264 and H.265 the Annex B
+    NAL units are read up to the first slice.
+    """
+    if codec == "mjpeg":
+        return True
+    data = bytes(data[:4096])
+    start = data.find(b"\x00\x00\x01")
+    while start >= 0 and start + 3 < len(data):
+        header = data[start + 3]
+        if codec == "h264":
+            nalType = header & 0x1f
+            # SPS, PPS or an IDR slice
+            if nalType in (5, 7, 8):
+                return True
+            if 1 <= nalType <= 4:
+                return False
+        else:
+            nalType = (header >> 1) & 0x3f
+            # VPS, SPS, PPS or an IRAP slice
+            if 16 <= nalType <= 23 or 32 <= nalType <= 34:
+                return True
+            if nalType < 16:
+                return False
+        start = data.find(b"\x00\x00\x01", start + 3)
+    return False
+
+
+class SegmentedVideoWriter:
+    """
+        Muxes encoded packets into numbered MP4 segments on a background thread.
+
+    # Arguments
+        folder: where the segments are written.  It is created if needed.
+        codec: one of CODECS.
+        fps: the encoder frame rate.
+        width, height: the encoded frame size.
+        segmentSeconds: start a new segment after this many seconds.  None
+            for no limit.
+        segmentBytes: start a new segment after this many bytes.  None for
+            no limit.
+        maxQueue: the most packets waiting to be written.  write waits for
+            room when it is full.
+        prefix: the start of the segment file names.
+    """
+    def __init__(self, folder, codec="h264", fps=30, width=1920, height=1080,
+                 segmentSeconds=60.0, segmentBytes=None, maxQueue=256, prefix="video"):
+        if codec not in CODECS:
+            raise ValueError("codec must be one of {}".format(CODECS))
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.codec = codec
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.segmentSeconds = segmentSeconds
+        self.segmentBytes = segmentBytes
+        self.maxQueue = maxQueue
+        self.prefix = prefix
+
+        self.pending = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.error = None
+        self.maxQueued = 0
+        self.lastSeq = None
+        self.skipped = 0
+
+        # Only used by the writer thread
+        self.container = None
+        self.stream = None
+        self.segmentStart = None
+        self.segmentSize = 0
+        self.lastPts = -1
+        self.segmentNumber = 0
+        self.segments = []
+        self.packets = 0
+        self.bytes = 0
+        self.discarded = 0
+
+        self.thread = threading.Thread(target=self._run, name="writer-" + prefix, daemon=True)
+        self.thread.start()
+
+    def write(self, packet):
+        """
+        Queue a packet from the encoder's bitstream output.  Waits if the
+        queue is full.  Gaps in the sequence numbers are counted as skipped.
+        """
+        seq = packet.getSequenceNum()
+        if self.lastSeq is not None and seq > self.lastSeq + 1:
+            self.skipped += seq - self.lastSeq - 1
+        self.lastSeq = seq
+        item = (packet.getData(), packet.getTimestampDevice().total_seconds())
+        with self.cond:
+            if self.error is not None:
+                raise self.error
+            if self.closed:
+                raise ValueError("the writer is closed")
+            self.cond.wait_for(lambda: len(self.pending) < self.maxQueue or self.error is not None)
+            self.pending.append(item)
+            self.maxQueued = max(self.maxQueued, len(self.pending))
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.closed)
+                if not self.pending:
+                    break
+                data, timestamp = self.pending.popleft()
+                # Let a waiting write know there is room
+                self.cond.notify_all()
+            try:
+                self._mux(data, timestamp)
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+                    self.pending.clear()
+                    self.cond.notify_all()
+                print("Video writer stopped:", e)
+                break
+        self._close_segment()
+
+    def _mux(self, data, timestamp):
+        import av
+
+        keyframe = is_keyframe(data, self.codec)
+        if self.container is not None and keyframe and self._segment_full(timestamp):
+            self._close_segment()
+        if self.container is None:
+            if not keyframe:
+                # A segment can't be played from before its first keyframe
+                self.discarded += 1
+                return
+            self._open_segment(timestamp)
+
+        packet = av.Packet(data)
+        pts = int(round((timestamp - self.segmentStart) * 1000000))
+        # The muxer needs increasing timestamps
+        pts = max(pts, self.lastPts + 1)
+        packet.pts = packet.dts = pts
+        packet.time_base = self.stream.time_base
+        packet.stream = self.stream
+        packet.is_keyframe = keyframe
+        self.container.mux(packet)
+        self.lastPts = pts
+        self.segmentSize += len(data)
+        self.packets += 1
+        self.bytes += len(data)
+
+    def _segment_full(self, timestamp):
+        if self.segmentSeconds is not None and timestamp - self.segmentStart >= self.segmentSeconds:
+            return True
+        return self.segmentBytes is not None and self.segmentSize >= self.segmentBytes
+
+    def _open_segment(self, timestamp):
+        import av
+
+        while True:
+            path = os.path.join(self.folder, "{}_{:04d}.mp4".format(self.prefix, self.segmentNumber))
+            self.segmentNumber += 1
+            if not os.path.exists(path):
+                break
+        self.container = av.open(path, "w", options=MP4_OPTIONS)
+        self.stream = self.container.add_stream(AV_CODECS[self.codec], rate=self.fps)
+        self.stream.width = self.width
+        self.stream.height = self.height
+        self.stream.time_base = Fraction(1, 1000000) # Microseconds
+        if self.codec == "mjpeg":
+            # We need to set pixel format for MJEPG, for H264/H265 it's yuv420p by default
+            self.stream.pix_fmt = "yuvj420p"
+        self.segmentStart = timestamp
+        self.segmentSize = 0
+        self.lastPts = -1
+        self.segments.append(path)
+        print("Recording", path)
+
+    def _close_segment(self):
+        if self.container is not None:
+            self.container.close()
+            self.container = None
+            self.stream = None
+
+    def close(self):
+        """Write the packets still queued and finalize the last segment."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stats(self):
+        with self.cond:
+            return {"segments": len(self.segments), "packets": self.packets, "bytes": self.bytes,
+                    "skipped": self.skipped, "discarded": self.discarded,
+                    "queued": len(self.pending), "max_queued": self.maxQueued}
+
+
+class StreamRecorder:
+    """
+        Reads several encoder output queues and writes each to its own
+        SegmentedVideoWriter.
+
+    # Arguments
+        streams: a list of (queue, writer) pairs.
+    """
+    def __init__(self, streams):
+        self.streams = streams
+        self.errors = {}
+        self.threads = [threading.Thread(target=self._read, args=(queue, writer),
+                                         name="reader-" + queue.getName(), daemon=True)
+                        for queue, writer in streams]
+        for thread in self.threads:
+            thread.start()
+
+    def _read(self, queue, writer):
+        while True:
+            try:
+                # Blocks without using the CPU until a packet arrives
+                packet = queue.get()
+            except RuntimeError:
+                # The device was closed, or a replay finished
+                return
+            try:
+                writer.write(packet)
+            except Exception as e:
+                self.errors[queue.getName()] = e
+                return
+
+    def wait(self, poll=0.5):
+        """Wait until every queue stops.  Waking every poll seconds keeps Ctrl+C working."""
+        while any(thread.is_alive() for thread in self.threads):
+            for thread in self.threads:
+                thread.join(poll)
+
+    def close(self):
+        """Finalize every writer.  Close the device first, so the readers stop."""
+        for thread in self.threads:
+            thread.join()
+        for queue, writer in self.streams:
+            try:
+                writer.close()
+            except Exception as e:
+                self.errors.setdefault(queue.getName(), e)
+        for name, error in self.errors.items():
+            print("Recording of", name, "failed:", error)
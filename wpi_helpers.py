@@ -1,18 +1,14 @@
 #!/usr/bin/env python3
 
 import json
+import math
 import time
 from time import sleep
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from io import BytesIO
-from pathlib import Path
-from socketserver import ThreadingMixIn
-from PIL import Image
 from pathlib import Path
 import sys
 import cv2
+import numpy as np
 import os
-from networktables import NetworkTablesInstance
 
 # Constants
 FRAME_WIDTH = 416
@@ -55,34 +51,164 @@ class ConfigParser:
             self.cameras = j["cameras"]
         except KeyError:
             self.parseError("could not read cameras", config_path)
+            self.cameras = []
+
+        # OAK cameras are the entries with the MxId of the device
+        self.oak_cameras = {c.get("name") or c["mxid"]: c["mxid"]
+                            for c in self.cameras if isinstance(c, dict) and c.get("mxid")}
 
     def parseError(self, str, config_file):
         """Report parse error."""
         print("config error in '" + config_file + "': " + str, file=sys.stderr)     
 
 
-# HTTPServer MJPEG
-class VideoStreamHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'multipart/x-mixed-replace; boundary=--jpgboundary')
-        self.end_headers()
-        while True:
-            sleep(0.1)
-            if hasattr(self.server, 'frametosend'):
-                image = Image.fromarray(cv2.cvtColor(self.server.frametosend, cv2.COLOR_BGR2RGB))
-                stream_file = BytesIO()
-                image.save(stream_file, 'JPEG')
-                self.wfile.write("--jpgboundary".encode())
-
-                self.send_header('Content-type', 'image/jpeg')
-                self.send_header('Content-length', str(stream_file.getbuffer().nbytes))
-                self.end_headers()
-                image.save(self.wfile, 'JPEG')
-
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in a separate thread."""
-    pass
+class StreamOutput:
+    """
+        Scales, paces and compresses the frames sent to an MJPEG stream.
+
+        Frames are resized to the stream resolution before they are put to
+        the source, so cscore doesn't rescale them.  Frames
+        arrive at the rate of the neural network and are only sent at the
+        target frame rate.  With a bandwidth budget the JPEG quality is
+        adjusted once a second to keep the stream under it, and when the
+        quality is already at its lowest the frame rate is lowered instead.
+
+    # Arguments
+        source: a cscore CvSource or an MjpegStreamServer.
+        server: the cscore MjpegServer or MjpegStreamServer streaming the
+            source.  Its setCompression() sets the JPEG quality.
+        width, height: the output resolution.
+        fps: the most frames sent per second.  0 sends every frame.
+        kbps: the bandwidth budget in kilobits per second.  0 keeps the
+            quality fixed.
+        quality: the starting JPEG quality from 0 to 100.
+        minQuality, maxQuality: the range the quality is adjusted over.
+    """
+    def __init__(self, source, server=None, width=320, height=240, fps=30, kbps=0,
+                 quality=80, minQuality=20, maxQuality=90):
+        self.source = source
+        self.server = server
+        self.size = (width, height)
+        self.fps = fps
+        self.kbps = kbps
+        self.minQuality = minQuality
+        self.maxQuality = maxQuality
+        self.quality = None
+        self.set_quality(quality)
+
+        self.sendFps = fps
+        self.budgetFps = None
+        self.nextDue = 0.0
+        self.windowStart = time.monotonic()
+        self.windowFrames = 0
+        self.windowBytes = 0
+        self.sampleSize = None
+
+    def set_quality(self, quality):
+        quality = int(min(max(quality, self.minQuality), self.maxQuality))
+        if quality != self.quality and self.server is not None:
+            self.server.setCompression(quality)
+        self.quality = quality
+
+    def isEnabled(self):
+        return self.source.isEnabled()
+
+    def wants_frame(self):
+        """True when a client is connected and the next frame is due."""
+        if not self.source.isEnabled():
+            return False
+        if self.sendFps <= 0:
+            return True
+        # A quarter of a frame early is close enough, so a 30 fps input isn't
+        # thinned to 10 fps by jitter when the target is 15 fps.
+        return time.monotonic() >= self.nextDue - 0.25 / self.sendFps
+
+    def putFrame(self, frame):
+        if not self.wants_frame():
+            return
+        now = time.monotonic()
+        if self.sendFps > 0:
+            self.nextDue = max(self.nextDue + 1.0 / self.sendFps, now)
+
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            # INTER_AREA avoids aliasing when shrinking by 2x or more.  Below that
+            # INTER_LINEAR looks the same and is several times faster.
+            shrink = min(frame.shape[1] / self.size[0], frame.shape[0] / self.size[1])
+            interpolation = cv2.INTER_AREA if shrink >= 2 else cv2.INTER_LINEAR
+            frame = cv2.resize(frame, self.size, interpolation=interpolation)
+        self.source.putFrame(frame)
+
+        if self.kbps > 0:
+            self.measure(frame, now)
+
+    def measure(self, frame, now):
+        """Count the bytes sent and adjust the quality and frame rate once a second."""
+        self.windowFrames += 1
+        if hasattr(self.server, "frameSize"):
+            self.windowBytes += self.server.frameSize()
+        elif self.sampleSize is None:
+            # cscore encodes the frames itself, so encode one a second to estimate the size
+            ok, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            self.sampleSize = len(buffer) if ok else 0
+
+        elapsed = now - self.windowStart
+        if elapsed < 1.0:
+            return
+        sentBytes = self.windowBytes
+        if self.sampleSize is not None:
+            sentBytes = self.sampleSize * self.windowFrames
+        measuredFps = self.windowFrames / elapsed
+        self.adapt(sentBytes * 8 / 1000 / elapsed, measuredFps)
+
+        self.windowStart = now
+        self.windowFrames = 0
+        self.windowBytes = 0
+        self.sampleSize = None
+
+    def adapt(self, kbps, measuredFps):
+        """Move the quality, or the frame rate, towards the bandwidth budget."""
+        if kbps <= 0:
+            return
+        ratio = self.kbps / kbps
+        if ratio < 1.0:
+            if self.quality > self.minQuality:
+                # The JPEG size grows roughly exponentially with the quality
+                self.set_quality(self.quality + max(-15, round(10 * math.log2(ratio))))
+            else:
+                self.budgetFps = max(1.0, measuredFps * ratio)
+        elif ratio > 1.2:
+            if self.budgetFps is not None:
+                # Give the frame rate back before raising the quality
+                self.budgetFps *= 1.25
+                if self.budgetFps > measuredFps * 1.5 or (self.fps > 0 and self.budgetFps >= self.fps):
+                    self.budgetFps = None
+            else:
+                self.set_quality(self.quality + min(5, round(10 * math.log2(ratio))))
+        self.sendFps = self.fps
+        if self.budgetFps is not None:
+            self.sendFps = self.budgetFps if self.fps <= 0 else min(self.fps, self.budgetFps)
+
+    def stats(self):
+        return {"quality": self.quality, "fps": self.sendFps}
+
+
+def start_mjpeg_source(name, port, width=320, height=240, fps=30, kbps=0):
+    """Start an MJPEG stream and return the StreamOutput that frames are put to.
+
+    Uses a cscore MjpegServer when cscore is installed and MjpegStreamServer
+    otherwise.
+    """
+    try:
+        import cscore as cs
+    except ImportError:
+        print("cscore not installed, using the built in MJPEG server")
+        from mjpeg_helpers import MjpegStreamServer
+        server = MjpegStreamServer(port)
+        return StreamOutput(server, server, width, height, fps, kbps)
+    cvSource = cs.CvSource(name, cs.VideoMode.PixelFormat.kMJPEG, width, height, fps)
+    mjpeg_server = cs.MjpegServer(name + "server", port)
+    mjpeg_server.setSource(cvSource)
+    return StreamOutput(cvSource, mjpeg_server, width, height, fps, kbps)
 
 class ModelConfigParser:
     def __init__(self, path):
@@ -117,7 +243,16 @@ class ModelConfigParser:
                 self.inputSize = tuple(map(int, nnConfig.get("input_size").split('x')))
 
             self.confidence_threshold = metadata.get("confidence_threshold", nnConfig.get("confidence_threshold", None))
+            self.iou_threshold = metadata.get("iou_threshold", None)
+            self.anchors = metadata.get("anchors", None)
+            self.anchor_masks = metadata.get("anchor_masks", None)
+            # How host side decoding turns the raw outputs into boxes, see yolo_helpers
+            self.box_decode = metadata.get("box_decode", "v3")
+            # The model applies the sigmoids the host decoding would
+            self.activated_outputs = metadata.get("activated_outputs", False)
             self.classes = metadata.get("classes", None)
+            # Pipeline profiles, see pipeline_builder
+            self.pipeline = configJson.get("pipeline", {})
 
 class Camera():
     def __init__(self, config_parser):
@@ -158,6 +293,46 @@ class Camera():
             self.mjpegServer.putFrame(frame)        
 
 
+def spacial_entry(detection, label):
+    """Convert a spatial detection into the dictionary sent to Network Tables."""
+    x_coord = int(detection.spatialCoordinates.x)   
+    y_coord = int(detection.spatialCoordinates.y)
+    z_coord = int(detection.spatialCoordinates.z)
+    return {"label": label, 
+            "box": {"ymin": detection.ymin, "xmin": detection.xmin, "ymax": detection.ymax, "xmax": detection.xmax}, 
+            "spacial": {"X": x_coord, "Y": y_coord, "Z": z_coord},
+            "confidence": int(detection.confidence * 100)}
+
+
+def track_entry(track, label):
+    """Convert a tracking_helpers Track into the dictionary sent to Network Tables."""
+    xmin, ymin, xmax, ymax = track.box
+    x_coord, y_coord, z_coord = track.position
+    x_vel, y_vel, z_vel = track.velocity
+    return {"id": track.id,
+            "label": label,
+            "box": {"ymin": ymin, "xmin": xmin, "ymax": ymax, "xmax": xmax},
+            "spacial": {"X": int(x_coord), "Y": int(y_coord), "Z": int(z_coord)},
+            "velocity": {"X": int(x_vel), "Y": int(y_vel), "Z": int(z_vel)},
+            "confidence": int(track.confidence * 100),
+            "age": track.age,
+            "misses": track.misses}
+
+
+def start_network_tables(team):
+    """
+    Start the Network Tables client of the team and return its instance.
+    Start it once and pass the instance to the WPINetworkTables of each
+    camera when several publish.
+    """
+    # Imported here so scripts run without it load faster
+    from networktables import NetworkTablesInstance
+    ntinst = NetworkTablesInstance.getDefault()
+    ntinst.startClientTeam(team)
+    ntinst.startDSClient()
+    return ntinst
+
+
 class WPINetworkTables():
     """
         The WPINetworkTables class is used to send inference data back to the WPI program.
@@ -165,17 +340,23 @@ class WPINetworkTables():
     # Arguments
         team: FRC team number
         labelMap: a dictionary used to translate class id to its name.
+        table_name: the table the data is put in.  Each camera of a multi
+            camera robot uses its own subtable, like "ML/front".
+        ntinst: the NetworkTablesInstance to put the data through, from
+            start_network_tables, so several cameras share one client.
+            None to start the team's client.
     """    
     def __init__(self,  team, 
                         hardware_type="OAK-D Camera", 
-                        labelMap=["BlueBall","Redball"]):
+                        labelMap=["BlueBall","Redball"],
+                        table_name="ML",
+                        ntinst=None):
 
         self.labelMap = labelMap
 
         # Connect to Network Tables
-        ntinst = NetworkTablesInstance.getDefault()
-        ntinst.startClientTeam(team)
-        ntinst.startDSClient()
+        if ntinst is None:
+            ntinst = start_network_tables(team)
 
         # Setup access to the SmartDashboard
         self.sd = ntinst.getTable("SmartDashboard")
@@ -183,12 +364,18 @@ class WPINetworkTables():
         self.zaxisRotateEntry = self.sd.getEntry("ArcadeDrive zaxisRotate")
 
         # Create Network Table to put Machine Learning data
-        mlTable = ntinst.getTable("ML")
+        mlTable = ntinst.getTable(table_name)
         
         self.hardware_entry = mlTable.getEntry("device")
         self.fps_entry = mlTable.getEntry("fps")
         self.resolution_entry = mlTable.getEntry("resolution")
         self.detections_entry = mlTable.getEntry("detections")
+        self.frame_entry = mlTable.getEntry("frame")
+        self.tracks_entry = mlTable.getEntry("tracks")
+        self.latencyTable = mlTable.getSubTable("latency")
+        self.statsTable = mlTable.getSubTable("stats")
+        self.ntinst = ntinst
+        self.frame_number = 0
 
         self.speedEntry = self.sd.getEntry("xaxisSpeed")
         self.rotateEntry = self.sd.getEntry("zaxisRotate")
@@ -196,8 +383,6 @@ class WPINetworkTables():
         # Put static data
         self.hardware_entry.setString(hardware_type)
         self.resolution_entry.setString(str(FRAME_WIDTH) + ", " + str(FRAME_HEIGHT)) 
-        self.startTime = time.monotonic()
-        self.fps = 0
 
     def get_drive_data(self):
         xaxisSpeed = self.xaxisSpeedEntry.getNumber(0)
@@ -214,27 +399,68 @@ class WPINetworkTables():
                                 "box": {"ymin": int(ymin), "xmin": int(xmin), "ymax": int(ymax), "xmax": int(xmax)}, 
                                 "confidence": float(cf)})                      
             self.detections_entry.setString(json.dumps(temp_entry))
-          
-            if self.fps % 100 == 0:
-                print("Completed", self.fps, "frames. FPS:", (1 / (time.monotonic() - self.startTime)))
-
-            # if self.fps % 10 == 0:
-                # self.fps_entry.setNumber((1 / (time.monotonic() - self.startTime)))
-            self.fps += 1    
 
     def put_spacial_data(self, detection, label, fps):        
         temp_entry = []
-        x_coord = int(detection.spatialCoordinates.x)   
-        y_coord = int(detection.spatialCoordinates.y)
-        z_coord = int(detection.spatialCoordinates.z)
-        temp_entry.append({"label": label, 
-                            "box": {"ymin": detection.ymin, "xmin": detection.xmin, "ymax": detection.ymax, "xmax": detection.xmax}, 
-                            "spacial": {"X": x_coord, "Y": y_coord, "Z": z_coord},
-                            "confidence": int(detection.confidence * 100)}) 
-        # self.fps_entry.setNumber(fps)  # setNumber is NOT WORKING
+        temp_entry.append(spacial_entry(detection, label)) 
         self.detections_entry.setString(json.dumps(temp_entry))    
 
+    def put_spacial_detections(self, detections, sequence_num=None, tracks=None):
+        """
+        Publish all of the detections for one frame as a single update.
+
+        The detections are encoded into one JSON list and written to 
+        `ML/detections` together with the frame number in `ML/frame`, then 
+        flushed so the robot receives both values in the same update.
+
+        # Arguments
+            detections: the `detections` list of a SpatialImgDetections message.
+            sequence_num: the frame sequence number.  Defaults to a counter.
+            tracks: optional list of tracking_helpers Tracks written to
+                `ML/tracks` in the same update.
+        """
+        if sequence_num is None:
+            sequence_num = self.frame_number + 1
+        self.frame_number = sequence_num
+
+        payload = json.dumps([spacial_entry(detection, self.get_label(detection.label))
+                              for detection in detections])
+        self.frame_entry.setNumber(sequence_num)
+        self.detections_entry.setString(payload)
+        if tracks is not None:
+            self.tracks_entry.setString(json.dumps([track_entry(track, self.get_label(track.label))
+                                                    for track in tracks]))
+        self.ntinst.flush()
+
+    def put_stats(self, stats):
+        """
+        Publish a RuntimeStats report to the `stats` subtable, one number per
+        statistic, and the NN fps to `fps`, in one update.
+        """
+        for name, value in stats.items():
+            self.statsTable.getEntry(name).setNumber(value)
+        self.fps_entry.setNumber(stats["nn_fps"])
+        self.ntinst.flush()
+
+    def put_latency(self, summary):
+        """
+        Publish a LatencyTracker summary to the `latency` subtable, one
+        number per stage and percentile like `latency/total_p95`, in ms.
+        """
+        for stage, percentiles in summary.items():
+            for name, value in percentiles.items():
+                self.latencyTable.getEntry(stage + "_" + name).setNumber(value)
+        self.ntinst.flush()
+
+    def get_label(self, class_id):
+        try:
+            return self.labelMap[class_id]
+        except (IndexError, KeyError, TypeError):
+            return class_id
+
     def put_drive_data(self, steering):
+        """Publish the steering, with a fixed speed, to the SmartDashboard in one update."""
         self.speedEntry.setNumber(5.0)
         self.rotateEntry.setNumber(steering)
+        self.ntinst.flush()
             
\ No newline at end of file
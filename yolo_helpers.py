@@ -0,0 +1,351 @@
+"""
+- This module decodes the raw output tensors of YOLO models on the host,
+for YOLO variants that the YoloSpatialDetectionNetwork on the device can't
+parse.  Use it with a plain NeuralNetwork node and getLayerFp16, or with
+OpenCV DNN in host_inference.
+- YoloDecoder takes the anchors, anchor masks, confidence and IoU
+thresholds from the model config file (ModelConfigParser).
+- Each output head is decoded with NumPy array operations.  Class scores
+can't be higher than the objectness, so only the cells whose objectness
+passes the threshold are decoded any further.
+- class_nms suppresses overlapping boxes of the same class with OpenCV's
+NMSBoxes, one class at a time.
+- Box decoding:
+    v3  YOLOv3 and YOLOv4: sigmoid offsets and exp sizes, like the device
+    v5  YOLOv5 and YOLOv7: 2 * sigmoid - 0.5 offsets and (2 * sigmoid)^2 sizes
+- Some converted models already apply the sigmoids, like a RegionYolo
+layer of OpenVINO does to the offsets, objectness and classes of v3 and v4
+heads, or a YOLOv5 export to every output.  With "activated_outputs" in
+the model config the decoder takes those values as they are instead of
+applying the sigmoid again.  The exp of the v3 sizes is always taken.
+- If runs independent, benchmarks the decoder and NMS against a naive
+loop over the boxes.
+"""
+
+import argparse
+import math
+import time
+import cv2
+import numpy as np
+
+BOX_DECODES = ("v3", "v5")
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def class_nms(boxes, scores, classes, iouThreshold):
+    """
+    Non maximum suppression within each class.  Boxes are rows of xmin,
+    ymin, xmax, ymax.  Returns the indexes of the boxes kept, highest score
+    first.
+    """
+    order = np.argsort(-scores, kind="stable")
+    if len(order) < 2:
+        return order
+    xywh = np.concatenate([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]], axis=1)
+    scores = np.asarray(scores, dtype=np.float32)
+    keep = []
+    # NMSBoxes compares each box with the boxes kept so far, which are
+    # fewer for one class at a time
+    for label in np.unique(classes):
+        members = np.flatnonzero(classes == label)
+        kept = cv2.dnn.NMSBoxes(xywh[members], scores[members], 0.0, iouThreshold)
+        keep.append(members[np.asarray(kept, dtype=int).reshape(-1)])
+    keep = np.concatenate(keep)
+    return keep[np.argsort(-scores[keep], kind="stable")]
+
+
+class YoloDecoder:
+    """
+        Decodes raw YOLO output heads into boxes, scores and classes.
+
+    # Arguments
+        inputSize: the network input width and height.
+        numClasses: the number of classes.
+        anchors: flat list of anchor widths and heights in input pixels.
+        anchorMasks: dictionary of "side<grid size>" to the anchor indexes
+            of that head, like {"side13": [3, 4, 5]}.
+        confThreshold: the least score of a detection.
+        iouThreshold: the overlap above which a box of the same class is
+            suppressed.
+        boxDecode: one of BOX_DECODES.
+        activated: the outputs the decode takes the sigmoid of already
+            have it applied.
+    """
+    def __init__(self, inputSize, numClasses, anchors, anchorMasks, confThreshold=0.5,
+                 iouThreshold=0.5, boxDecode="v3", activated=False):
+        if boxDecode not in BOX_DECODES:
+            raise ValueError("boxDecode must be one of {}".format(BOX_DECODES))
+        self.inputSize = np.array(inputSize, dtype=np.float32)
+        self.numClasses = numClasses
+        self.anchors = np.array(anchors, dtype=np.float32).reshape(-1, 2)
+        self.masks = {int(side[len("side"):]): list(mask) for side, mask in anchorMasks.items()}
+        self.anchorsPerHead = len(next(iter(self.masks.values())))
+        self.confThreshold = confThreshold
+        self.iouThreshold = iouThreshold
+        self.boxDecode = boxDecode
+        self.activated = activated
+        # The least objectness a detection can have, as the head holds it
+        if activated:
+            self.objectnessThreshold = confThreshold
+        else:
+            self.objectnessThreshold = (math.log(confThreshold / (1 - confThreshold))
+                                        if 0 < confThreshold < 1 else -np.inf)
+
+    def activate(self, x):
+        """The sigmoid of head values, unless the model applied it already."""
+        return x if self.activated else sigmoid(x)
+
+    def head_anchors(self, gridSize):
+        try:
+            return self.anchors[self.masks[gridSize]]
+        except KeyError:
+            raise ValueError("no anchor mask for side{}".format(gridSize)) from None
+
+    def decode_head(self, head):
+        """
+        Decode one output head of shape (batch, anchors * (5 + classes),
+        grid, grid) holding logits, or sigmoids when activated.  Returns the
+        frame index, box, score and class of every candidate above the
+        confidence threshold.
+        """
+        batch, _, gridH, gridW = head.shape
+        anchors = self.head_anchors(gridW)
+        head = head.reshape(batch, len(anchors), 5 + self.numClasses, gridH, gridW)
+
+        # Comparing the logits saves taking the sigmoid of every cell
+        frame, anchor, gy, gx = np.nonzero(head[:, :, 4] >= self.objectnessThreshold)
+        cells = head[frame, anchor, :, gy, gx]
+
+        # The best class by its logit, which unlike the float32 sigmoid
+        # doesn't round near ties up to the same score
+        classes = cells[:, 5:].argmax(axis=1)
+        scores = self.activate(cells[:, 4]) * self.activate(cells[np.arange(len(cells)), 5 + classes])
+        found = scores >= self.confThreshold
+        frame, anchor, gy, gx = frame[found], anchor[found], gy[found], gx[found]
+        cells, scores, classes = cells[found], scores[found], classes[found]
+
+        grid = np.stack([gx, gy], axis=1).astype(np.float32)
+        xy = self.activate(cells[:, 0:2])
+        if self.boxDecode == "v3":
+            center = (xy + grid) / (gridW, gridH)
+            size = np.exp(cells[:, 2:4]) * anchors[anchor] / self.inputSize
+        else:
+            center = (xy * 2 - 0.5 + grid) / (gridW, gridH)
+            size = (self.activate(cells[:, 2:4]) * 2) ** 2 * anchors[anchor] / self.inputSize
+        boxes = np.concatenate([center - size / 2, center + size / 2], axis=1)
+        return frame, boxes, scores, classes
+
+    def decode(self, outputs):
+        """
+        Decode the output heads of a batch of frames and suppress the
+        overlapping boxes.  Returns a list with (boxes, scores, classes) for
+        each frame.  Boxes are normalized rows of xmin, ymin, xmax, ymax.
+        """
+        heads = [self.decode_head(head) for head in outputs]
+        frames = np.concatenate([h[0] for h in heads])
+        boxes = np.concatenate([h[1] for h in heads])
+        scores = np.concatenate([h[2] for h in heads])
+        classes = np.concatenate([h[3] for h in heads])
+
+        results = []
+        for i in range(len(outputs[0])):
+            inFrame = frames == i
+            frameBoxes, frameScores, frameClasses = boxes[inFrame], scores[inFrame], classes[inFrame]
+            keep = class_nms(frameBoxes, frameScores, frameClasses, self.iouThreshold)
+            results.append((frameBoxes[keep], frameScores[keep], frameClasses[keep]))
+        return results
+
+    def decode_layers(self, layers):
+        """
+        Decode the flat layers of one frame, like the getLayerFp16 lists of
+        a NeuralNetwork NNData message.  The grid size of each layer is found
+        from its length.  Returns (boxes, scores, classes).
+        """
+        channels = self.anchorsPerHead * (5 + self.numClasses)
+        heads = []
+        for layer in layers:
+            layer = np.asarray(layer, dtype=np.float32)
+            grid = int(round(math.sqrt(len(layer) / channels)))
+            if grid * grid * channels != len(layer):
+                raise ValueError("a layer of {} values isn't a square YOLO head".format(len(layer)))
+            heads.append(layer.reshape(1, channels, grid, grid))
+        return self.decode(heads)[0]
+
+
+def decoder_from_config(model_config, boxDecode=None, activated=None):
+    """Create a YoloDecoder from a ModelConfigParser.  boxDecode and activated override the config's."""
+    return YoloDecoder(model_config.inputSize, model_config.classes, model_config.anchors,
+                       model_config.anchor_masks,
+                       model_config.confidence_threshold or 0.5, model_config.iou_threshold or 0.5,
+                       boxDecode or model_config.box_decode,
+                       model_config.activated_outputs if activated is None else activated)
+
+
+# -------------------------------------------------------------------------
+# Benchmark
+# -------------------------------------------------------------------------
+def naive_sigmoid(x):
+    return 1 / (1 + math.exp(-x))
+
+
+def naive_decode(decoder, outputs):
+    """The decoder written as a loop over every box, to check and time the NumPy version."""
+    act = (lambda x: x) if decoder.activated else naive_sigmoid
+    results = []
+    for frame in range(len(outputs[0])):
+        boxes, scores, classes = [], [], []
+        for head in outputs:
+            _, _, gridH, gridW = head.shape
+            anchors = decoder.head_anchors(gridW)
+            cells = head[frame].reshape(len(anchors), 5 + decoder.numClasses, gridH, gridW)
+            for a in range(len(anchors)):
+                for gy in range(gridH):
+                    for gx in range(gridW):
+                        cell = [float(v) for v in cells[a, :, gy, gx]]
+                        best = 0
+                        for c in range(1, decoder.numClasses):
+                            if cell[5 + c] > cell[5 + best]:
+                                best = c
+                        score = act(cell[4]) * act(cell[5 + best])
+                        if score < decoder.confThreshold:
+                            continue
+                        if decoder.boxDecode == "v3":
+                            x = (act(cell[0]) + gx) / gridW
+                            y = (act(cell[1]) + gy) / gridH
+                            w = math.exp(cell[2]) * anchors[a][0] / decoder.inputSize[0]
+                            h = math.exp(cell[3]) * anchors[a][1] / decoder.inputSize[1]
+                        else:
+                            x = (act(cell[0]) * 2 - 0.5 + gx) / gridW
+                            y = (act(cell[1]) * 2 - 0.5 + gy) / gridH
+                            w = (act(cell[2]) * 2) ** 2 * anchors[a][0] / decoder.inputSize[0]
+                            h = (act(cell[3]) * 2) ** 2 * anchors[a][1] / decoder.inputSize[1]
+                        boxes.append((x - w / 2, y - h / 2, x + w / 2, y + h / 2))
+                        scores.append(score)
+                        classes.append(best)
+        keep = naive_nms(boxes, scores, classes, decoder.iouThreshold)
+        results.append(([boxes[i] for i in keep], [scores[i] for i in keep], [classes[i] for i in keep]))
+    return results
+
+
+def naive_nms(boxes, scores, classes, iouThreshold):
+    order = sorted(range(len(boxes)), key=lambda i: -scores[i])
+    keep = []
+    for i in order:
+        suppressed = False
+        for j in keep:
+            if classes[i] != classes[j]:
+                continue
+            x1, y1 = max(boxes[i][0], boxes[j][0]), max(boxes[i][1], boxes[j][1])
+            x2, y2 = min(boxes[i][2], boxes[j][2]), min(boxes[i][3], boxes[j][3])
+            intersection = max(x2 - x1, 0) * max(y2 - y1, 0)
+            areaI = (boxes[i][2] - boxes[i][0]) * (boxes[i][3] - boxes[i][1])
+            areaJ = (boxes[j][2] - boxes[j][0]) * (boxes[j][3] - boxes[j][1])
+            if intersection / max(areaI + areaJ - intersection, 1e-12) > iouThreshold:
+                suppressed = True
+                break
+        if not suppressed:
+            keep.append(i)
+    return keep
+
+
+def logit(p):
+    return np.log(p / (1 - p))
+
+
+def synthetic_outputs(decoder, batch, objects, seed=2928):
+    """
+    Random logits for each head with the given number of objects per frame.
+    Like a trained network, each object is found by the anchors close to
+    its shape at the cell of its center, which regress to about its box.
+    YOLOv5 also trains the neighbouring cells to find it, YOLOv3 mostly
+    not.  The NMS has to reduce them to one box.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0.1, 0.9, (batch, objects, 2))
+    sizes = np.exp(rng.uniform(np.log(0.03), np.log(0.6), (batch, objects, 2)))
+    labels = rng.integers(0, decoder.numClasses, (batch, objects))
+    neighbour = -1.0 if decoder.boxDecode == "v3" else 2.0
+    outputs = []
+    for grid in sorted(decoder.masks, reverse=True):
+        anchors = decoder.head_anchors(grid) / decoder.inputSize
+        head = rng.normal(0, 1, (batch, len(anchors), 5 + decoder.numClasses, grid, grid))
+        head[:, :, 4] = -6.0
+        for frame in range(batch):
+            for center, size, label in zip(centers[frame], sizes[frame], labels[frame]):
+                # The anchors within a factor of 4 of the object's size,
+                # like YOLOv5 assigns them
+                ratio = size / anchors
+                matched = np.flatnonzero(np.maximum(ratio, 1 / ratio).max(axis=1) < 4)
+                gx, gy = (center * grid).astype(int)
+                for y in range(max(gy - 1, 0), min(gy + 2, grid)):
+                    for x in range(max(gx - 1, 0), min(gx + 2, grid)):
+                        offset = center * grid - (x, y)
+                        if decoder.boxDecode == "v3":
+                            xy = logit(np.clip(offset, 0.02, 0.98))
+                            wh = np.log(ratio[matched])
+                        else:
+                            xy = logit((np.clip(offset, -0.45, 1.45) + 0.5) / 2)
+                            wh = logit(np.sqrt(ratio[matched]) / 2)
+                        found = 3.0 if (x, y) == (gx, gy) else neighbour
+                        cells = head[frame, matched, :, y, x]
+                        cells[:, 0:2] = xy + rng.normal(0, 0.1, (len(matched), 2))
+                        cells[:, 2:4] = wh + rng.normal(0, 0.1, (len(matched), 2))
+                        cells[:, 4] = rng.normal(found, 1.0, len(matched))
+                        cells[:, 5 + label] += 4.0
+                        head[frame, matched, :, y, x] = cells
+        if decoder.activated:
+            # Like RegionYolo, v3 sizes stay logs
+            channels = slice(None) if decoder.boxDecode == "v5" else [0, 1] + list(range(4, head.shape[2]))
+            head[:, :, channels] = sigmoid(head[:, :, channels])
+        outputs.append(head.reshape(batch, -1, grid, grid).astype(np.float32))
+    return outputs
+
+
+def time_call(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return np.median(times) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the YOLO decoder and NMS against a naive loop')
+    parser.add_argument('-c', '--config', type=str, default='rapid-react-config.json',
+                        help='the model config file with the anchors [rapid-react-config.json]')
+    parser.add_argument('-o', '--objects', type=str, default='1,5,20,50',
+                        help='comma separated objects per frame [1,5,20,50]')
+    parser.add_argument('-b', '--box_decode', type=str, default=None, choices=BOX_DECODES,
+                        help='decode the boxes this way instead of as the config says')
+    parser.add_argument('-a', '--activated', action='store_true',
+                        help='make the synthetic outputs already activated, whatever the config says [False]')
+    parser.add_argument('-r', '--repeat', type=int, default=20,
+                        help='runs timed for each count [20]')
+    args = parser.parse_args()
+
+    from wpi_helpers import ModelConfigParser
+    model_config = ModelConfigParser(args.config)
+    decoder = decoder_from_config(model_config, args.box_decode, args.activated or None)
+
+    cells = sum(decoder.anchorsPerHead * side ** 2 for side in decoder.masks)
+    print("Decoding {} candidate boxes per frame, {} style{}".format(
+        cells, decoder.boxDecode, ", activated" if decoder.activated else ""))
+    print("{:>8} {:>10} {:>6} {:>10} {:>10} {:>10} {:>8}".format(
+        "objects", "above", "kept", "nms ms", "numpy ms", "naive ms", "speedup"))
+    for objects in [int(c) for c in args.objects.split(',')]:
+        outputs = synthetic_outputs(decoder, 1, objects)
+        heads = [decoder.decode_head(head) for head in outputs]
+        boxes, scores, classes = (np.concatenate([h[i] for h in heads]) for i in (1, 2, 3))
+        fast = decoder.decode(outputs)[0]
+        slow = naive_decode(decoder, outputs)[0]
+        if len(fast[0]) != len(slow[0]) or not np.allclose(fast[0], np.array(slow[0]).reshape(-1, 4), atol=1e-4):
+            raise SystemExit("ERROR: the NumPy and naive results differ")
+        nmsMs = time_call(lambda: class_nms(boxes, scores, classes, decoder.iouThreshold), args.repeat)
+        fastMs = time_call(lambda: decoder.decode(outputs), args.repeat)
+        slowMs = time_call(lambda: naive_decode(decoder, outputs), max(args.repeat // 10, 1))
+        print("{:>8} {:>10} {:>6} {:>10.3f} {:>10.3f} {:>10.1f} {:>7.0f}x".format(
+            objects, len(boxes), len(fast[0]), nmsMs, fastMs, slowMs, slowMs / fastMs))